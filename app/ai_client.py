@@ -1,23 +1,41 @@
-import time
+import asyncio
 from client import ChatClient
-import select
-import sys
-from openai import OpenAI
+from async_client import DEFAULT_ROOM, room_of, sender_of
+from protocol import PROTOCOL_V2
+from model_gateway import OpenAIBackend, GatewayClient
+from response_cache import prompt_key, is_cacheable
+from history import ConversationHistory, DEFAULT_MAX_MESSAGES, DEFAULT_MAX_TOKENS
+
+# Model calls in flight at once across every bot sharing the client loop
+MAX_IN_FLIGHT_CALLS = 8
+shared_model_slots = None
+# Direct messages are answered to their sender from a short history per user
+DIRECT_HISTORY_MESSAGES = 20
+MAX_DIRECT_CONVERSATIONS = 100  # the least recently active is forgotten beyond that
+
+
+def model_slots():
+    # Created lazily: every sync client runs on the same loop, so one semaphore bounds them all
+    global shared_model_slots
+    if shared_model_slots is None:
+        shared_model_slots = asyncio.Semaphore(MAX_IN_FLIGHT_CALLS)
+    return shared_model_slots
 
 
 def retry(retry_count=5, initial_delay=20):
+    # The backoff awaits instead of sleeping, so the bot keeps reading while it waits
     def decorator(func):
-        def wrapper(*args, **kwargs):
+        async def wrapper(*args, **kwargs):
             retries = 0
             current_delay = initial_delay
             while True:
                 try:
-                    return func(*args, **kwargs)
+                    return await func(*args, **kwargs)
                 except Exception as e:
                     if retries < retry_count:
                         retries += 1
                         print(f'Waiting: {current_delay} seconds')
-                        time.sleep(current_delay)
+                        await asyncio.sleep(current_delay)
                         current_delay = min(current_delay * 2, 60)  # exponential backoff
                     else:
                         print(f'Maximum attempts made. Error: {e}')
@@ -26,9 +44,44 @@ def retry(retry_count=5, initial_delay=20):
     return decorator
 
 
+class ReplyStream:
+    # Relays a streamed completion into the chat as the parts of one message
+    def __init__(self, client, switch_room=False):
+        self.client = client
+        self.switch_room = switch_room
+        self.stream_id = None
+        self.sent_chunks = 0
+
+    async def relay(self, deltas):
+        parts = []
+        try:
+            async for delta in deltas:
+                if not delta:
+                    continue
+                if self.stream_id is None:
+                    if self.switch_room:
+                        self.client.switch_to_reply_room()
+                    self.stream_id = self.client.start_stream()
+                self.client.send_chunk(self.stream_id, delta)
+                self.sent_chunks += 1
+                parts.append(delta)
+        finally:
+            if self.stream_id is not None:
+                # A stream cut short is closed with what arrived; a retry starts a new message
+                self.client.end_stream(self.stream_id)
+                self.stream_id = None
+        return ''.join(parts).strip() or None
+
+
 class AIClient(ChatClient):
-    def __init__(self, username, mode, interval, api_key, host='localhost', port=8080, test_mode=False):
-        super().__init__(username, host, port, test_mode)
+    reads_input = False
+
+    def __init__(self, username, mode, interval, api_key, host='localhost', port=8080, test_mode=False, max_frame_size=None,
+                 rooms=None, base_url=None, max_in_flight=None, history_messages=DEFAULT_MAX_MESSAGES,
+                 history_tokens=DEFAULT_MAX_TOKENS, summarize=False, cache=None,
+                 gateway=None, stream=False, protocol=PROTOCOL_V2, replay_history=0, reconnect=True, persona=None,
+                 model_backend=None, call_slots=None, scheduler=None):
+        super().__init__(username, host, port, test_mode, max_frame_size, protocol, reconnect)
 
         if mode != 'lines' and mode != 'time':
             raise f'Unallowed mode was entered: {mode}, supporing only lines or time'
@@ -36,97 +89,243 @@ class AIClient(ChatClient):
         self.mode = mode
         self.interval = interval
         self.message_count = 0
-        self.last_response_time = time.time()
-        self.conversation_history = []
+        self.timer = None
+        self.summarize = summarize
+        self.conversation_history = ConversationHistory(history_messages, history_tokens, keep_evicted=summarize)
         self.received_messages = [] if test_mode else None
+        self.rooms = list(rooms) if rooms else [DEFAULT_ROOM]
+        self.reply_room = self.rooms[0]
         self.api_key = api_key
-        self.openai_client = OpenAI(
-            # This is the default and can be omitted
-            api_key=api_key,
-        )
+        self.persona = persona  # who the bot is, put in front of its prompts
+        self.owns_backend = model_backend is None
+        if model_backend is not None:
+            # Shared with the other bots of a BotHost, which closes it
+            self.model_backend = model_backend
+        elif gateway:
+            # Calls go through the shared model gateway listening on this socket path
+            self.model_backend = GatewayClient(gateway)
+        else:
+            # base_url None reads OPENAI_BASE_URL, then the public API
+            self.model_backend = OpenAIBackend(api_key, base_url)
+        # call_slots is a semaphore shared with other bots; max_in_flight makes one for this bot alone
+        self.model_slots = call_slots or (asyncio.Semaphore(max_in_flight) if max_in_flight else None)
+        self.scheduler = scheduler  # runs time mode posts instead of a timer of our own
+        self.pending_calls = {}  # trigger kind -> task running its model call
+        self.follow_ups = set()  # kinds triggered again while their call was running
+        self.model_requests = 0
+        self.coalesced_triggers = 0
+        self.cache = cache  # MemoryCache or SqliteCache, used for temperature 0 calls
+        self.stream = stream  # relay replies into the chat while they are generated
+        self.replay_history = replay_history  # logged messages per room to load as context at start
+        self.history_tokens = history_tokens
+        self.direct_conversations = {}  # username -> ConversationHistory, most recently active last
+
+    def start(self):
+        super().start()
+        for room in self.rooms:
+            if room != DEFAULT_ROOM:
+                self.join_room(room)
+        if DEFAULT_ROOM not in self.rooms:
+            self.leave_room(DEFAULT_ROOM)
+        if self.replay_history:
+            # Context from before this bot started, if the server keeps a log
+            for room in self.rooms:
+                self.request_history(last=self.replay_history, room=room)
+        if self.mode == 'time':
+            # Scheduled on the loop instead of checked on every poll
+            if self.scheduler is not None:
+                self.loop_thread.call(self.scheduler.add, self, self.interval)
+            else:
+                self.timer = self.call_every(self.interval, self.generate_unrelated_message)
 
-    def handle_receive(self):
-        message = self.receive_message()
+    def handle_message(self, message):
         if message:
             if self.test_mode:
                 self.received_messages.append(message)
             
             print(message)
-            self.message_count += 1
+            if message.direct:
+                self.handle_direct(message)
+                return
             self.conversation_history.append(message)
+            if message.replayed:
+                return  # context only, nothing to answer
+            self.message_count += 1
+            self.reply_room = room_of(message)
+            if self.summarize and self.conversation_history.evicted and not self.test_mode:
+                self.trigger('summary', self.summarize_history)
 
             if self.mode == 'lines' and self.message_count % self.interval == 0:
                 self.generate_response()
-    
-    def handle_input(self):
-        pass
-
-    def listen_for_events(self):
-        while self.listening:
-            try:
-                if self.mode == 'time' and time.time() - self.last_response_time >= self.interval:
-                    self.generate_unrelated_message()
-                
-                    self.last_response_time = time.time()
-
-                read_sockets, _, _ = select.select([self.client_socket], [], [], 0.1)
-                for notified_socket in read_sockets:
-                    if notified_socket == self.client_socket:
-                        self.handle_receive()
-
-            except Exception as e:
-                print(f"Error in select: {str(e)}")
-                sys.exit()
 
-    def generate_response(self):
+    def handle_direct(self, message):
+        # Answered to the sender alone, whatever the mode, so a question to
+        # the bot does not turn into a reply to the whole room
+        sender = sender_of(message)
+        history = self.direct_conversations.pop(sender, None)
+        if history is None:
+            history = ConversationHistory(DIRECT_HISTORY_MESSAGES, self.history_tokens)
+        self.direct_conversations[sender] = history
+        if len(self.direct_conversations) > MAX_DIRECT_CONVERSATIONS:
+            del self.direct_conversations[next(iter(self.direct_conversations))]
+        history.append(message)
         if self.test_mode:
-            self.send_message("related message by lines")
+            self.send_direct(sender, "direct reply")
         else:
-            previous_chat_messages = '\n'.join(self.conversation_history[-self.interval:])
-            system_prompt = f"You are in a chat room. The following is a conversation. Respond to it: \n recent message: {previous_chat_messages}"
+            self.trigger(('direct', sender), lambda: self.respond_direct(sender))
+
+    def with_persona(self, system_prompt):
+        return f"{self.persona}\n{system_prompt}" if self.persona else system_prompt
 
-            model_response = self.call_open_ai_api(
-                system_prompt=system_prompt,
-                user_prompt="Generate a relevent response to the chat",
-                temperature=0
-            )
+    def switch_to_reply_room(self):
+        # Answer in the room the conversation is happening in
+        if self.reply_room != self.current_room and self.reply_room in self.joined_rooms:
+            self.join_room(self.reply_room)
 
-            if model_response != None:
-                return self.send_message(model_response)
+    def send_reply(self, message):
+        self.switch_to_reply_room()
+        return self.send_message(message)
+    
+    def generate_response(self):
+        if self.test_mode:
+            self.send_reply("related message by lines")
+        else:
+            self.trigger('response', self.respond)
             
     def generate_unrelated_message(self):
         if self.test_mode:
             self.send_message("related message by time")
         else:
-            model_response = self.call_open_ai_api(
-                system_prompt="You are in a chat room.",
-                user_prompt="Generate a random, interesting message for the chat room, that you have never sent before",
-                temperature=0.9
-            )
-
-            if model_response != None:
-                return self.send_message(model_response)
-            
+            self.trigger('unrelated', self.post_unrelated_message)
+
+    def trigger(self, kind, make_reply):
+        # Runs on the client loop. While a call of this kind is in flight, new
+        # triggers collapse into a single follow-up call made once it returns.
+        if kind in self.pending_calls:
+            self.coalesced_triggers += 1
+            self.follow_ups.add(kind)
+            return
+        self.pending_calls[kind] = self.client.loop.create_task(self.run_calls(kind, make_reply))
+
+    async def run_calls(self, kind, make_reply):
+        try:
+            while True:
+                self.follow_ups.discard(kind)
+                await make_reply()
+                if kind not in self.follow_ups:
+                    break
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Model call failed: {e}")
+        finally:
+            self.pending_calls.pop(kind, None)
+            self.follow_ups.discard(kind)
+
+    async def respond(self):
+        # The window is read when the call starts, so a follow-up sees the newest messages
+        previous_chat_messages = '\n'.join(self.conversation_history.recent(self.interval))
+        system_prompt = f"You are in a chat room. The following is a conversation. Respond to it: \n recent message: {previous_chat_messages}"
+        if self.conversation_history.summary:
+            system_prompt = f"Earlier in the chat: {self.conversation_history.summary}\n{system_prompt}"
+        system_prompt = self.with_persona(system_prompt)
+
+        reply_stream = ReplyStream(self, switch_room=True) if self.stream else None
+        model_response = await self.call_open_ai_api(
+            system_prompt=system_prompt,
+            user_prompt="Generate a relevent response to the chat",
+            temperature=0,
+            reply_stream=reply_stream
+        )
+
+        if model_response != None and not (reply_stream and reply_stream.sent_chunks):
+            return self.send_reply(model_response)
+
+    async def respond_direct(self, sender):
+        history = self.direct_conversations.get(sender)
+        if history is None:
+            return  # forgotten since the call was triggered
+        conversation = '\n'.join(history.recent(DIRECT_HISTORY_MESSAGES))
+        model_response = await self.call_open_ai_api(
+            system_prompt=self.with_persona(
+                f"You are {self.username} in a chat room. {sender} is talking to you privately: \n{conversation}"),
+            user_prompt=f"Generate a relevent reply to {sender}",
+            temperature=0
+        )
+        if model_response != None:
+            history.append(f"{self.username}: {model_response}")
+            return self.send_direct(sender, model_response)
+
+    async def post_unrelated_message(self):
+        reply_stream = ReplyStream(self) if self.stream else None
+        model_response = await self.call_open_ai_api(
+            system_prompt=self.with_persona("You are in a chat room."),
+            user_prompt="Generate a random, interesting message for the chat room, that you have never sent before",
+            temperature=0.9,
+            reply_stream=reply_stream
+        )
+
+        if model_response != None and not (reply_stream and reply_stream.sent_chunks):
+            return self.send_message(model_response)
+
+    async def summarize_history(self):
+        # Fold the messages that fell out of the history into the rolling summary
+        evicted = self.conversation_history.take_evicted()
+        if not evicted:
+            return
+        previous_summary = self.conversation_history.summary or "(nothing yet)"
+        evicted_messages = '\n'.join(evicted)
+        summary = await self.call_open_ai_api(
+            system_prompt=f"Summary of the chat so far: {previous_summary}\nNewer messages:\n{evicted_messages}",
+            user_prompt="Update the summary to include the newer messages, in at most three sentences",
+            temperature=0
+        )
+        if summary:
+            self.conversation_history.summary = summary
 
     @retry(retry_count=5, initial_delay=20)
-    def call_open_ai_api(self, system_prompt, user_prompt, model="gpt-3.5-turbo", temperature=0):
+    async def call_open_ai_api(self, system_prompt, user_prompt, model="gpt-3.5-turbo", temperature=0, reply_stream=None):
+        key = None
+        if self.cache is not None and is_cacheable(temperature):
+            key = prompt_key(model, system_prompt, user_prompt, temperature)
+            cached_response = await self.cache.fetch(key)
+            if cached_response is not None:
+                return cached_response
+
         try:
-            chat_completion_response = self.openai_client.chat.completions.create(
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                model=model,
-                temperature=temperature
-            )
-
-            if chat_completion_response.choices:
-                return chat_completion_response.choices[0].message.content.strip()
-            return None
+            self.model_requests += 1
+            messages = [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ]
+            # A slot per attempt: the retry backoff waits without holding one
+            async with self.model_slots or model_slots():
+                if reply_stream is not None:
+                    model_response = await reply_stream.relay(
+                        self.model_backend.stream(messages=messages, model=model, temperature=temperature))
+                else:
+                    model_response = await self.model_backend.complete(messages=messages, model=model,
+                                                                       temperature=temperature)
+
+            if model_response is not None and key is not None:
+                await self.cache.store(key, model_response)
+            return model_response
         except Exception as e:
             print(f"Error calling OpenAI API: {e}")
             raise  # Re-raise the exception to trigger the retry
 
+    def cancel_calls(self):
+        for task in list(self.pending_calls.values()):
+            task.cancel()
+
+    def close(self):
+        if self.scheduler is not None:
+            self.loop_thread.call(self.scheduler.remove, self)
+        self.loop_thread.call(self.cancel_calls)
+        if self.owns_backend:
+            self.loop_thread.call(self.model_backend.close)
+        super().close()
+
 
 if __name__ == "__main__":
     username = input("Enter AI bot name: ")
@@ -135,7 +334,11 @@ if __name__ == "__main__":
         print("only two modes are supported: lines or time")
         mode = input("Enter mode (lines/time): ")
     interval = int(input("Enter interval: "))
-    api_key = input("Enter your OpenAI API key: ") 
+    rooms = [room.strip() for room in input(f"Enter rooms (comma separated, empty for {DEFAULT_ROOM}): ").split(',') if room.strip()]
+    gateway = input("Enter the model gateway socket (empty to call OpenAI directly): ").strip()
+    api_key = '' if gateway else input("Enter your OpenAI API key: ")
+    stream = input("Show replies while they are generated? (y/n): ").strip().lower().startswith('y')
     
-    ai_client = AIClient(username, mode, interval, api_key)
-    ai_client.start()
\ No newline at end of file
+    ai_client = AIClient(username, mode, interval, api_key, rooms=rooms, gateway=gateway or None, stream=stream)
+    ai_client.start()
+    ai_client.wait_closed()
\ No newline at end of file
@@ -0,0 +1,439 @@
+# async_client.py
+import struct
+import random
+import asyncio
+from framing import FrameDecoder, FrameTooLargeError, encode_frame
+from framing import DEFAULT_MAX_FRAME_SIZE
+from protocol import (PROTOCOL_V1, PROTOCOL_V2, V2_HEADER_SIZE, TEXT, JOIN, LEAVE, DISCONNECT, STREAM, STREAM_END,
+                      HELLO, HISTORY, PING, PONG, RECONNECT, DIRECT, CODECS, CompressionError, now, hello_offer,
+                      history_request, direct_message, reserved_username,
+                      parse_reconnect_hint, split_frames, encode_v1, encode_v2, decode_v1, decode_v2, decompress_payload)
+
+DEFAULT_ROOM = 'lobby'
+MAX_OPEN_STREAMS = 64  # partial messages kept per client, the oldest is dropped beyond that
+HELLO_TIMEOUT = 1.0  # seconds to wait for the server to accept v2 before falling back to v1
+# After a lost connection each attempt waits a random time up to a window that
+# starts at the server's reconnect hint, or RECONNECT_DELAY, and doubles per failure
+RECONNECT_DELAY = 0.5  # seconds
+MAX_RECONNECT_DELAY = 30
+RECONNECT_ATTEMPTS = 10
+
+
+def room_of(message):
+    # Messages from rooms other than the default one arrive as "[room] username: text"
+    if message.startswith('[') and '] ' in message:
+        return message[1:message.index('] ')]
+    return DEFAULT_ROOM
+
+
+def sender_of(message):
+    # The username a received message starts with, after any "[room] "
+    if message.startswith('[') and '] ' in message:
+        message = message[message.index('] ') + 2:]
+    return message.partition(': ')[0]
+
+
+class ChatMessage(str):
+    # A received message. Over v2 it also carries the sender's message id, the
+    # server's id for the sender and the monotonic time the message was sent.
+    message_id = 0
+    sender_id = 0
+    timestamp = None
+    replayed = False  # sent from the server's log in answer to request_history()
+    direct = False  # sent to us alone with send_direct(), not to a room
+
+    def latency(self):
+        # Seconds since the message was sent. Monotonic clocks are per host, so
+        # this is only meaningful when sender and receiver share one.
+        if self.timestamp is None or self.replayed:
+            return None
+        return (now() - self.timestamp) / 1e9
+
+
+def chat_message(text, message_id=0, sender_id=0, timestamp=None):
+    message = ChatMessage(text)
+    message.message_id = message_id
+    message.sender_id = sender_id
+    message.timestamp = timestamp
+    return message
+
+
+class ChatProtocol(asyncio.BufferedProtocol):
+    # The loop reads straight into the FrameDecoder buffer, the same zero-copy
+    # path the server gets from recv_into
+    def __init__(self, client):
+        self.client = client
+        self.decoder = FrameDecoder(client.max_frame_size)
+        self.transport = None
+        self.resumed = None  # set while the transport's write buffer is full
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        self.decoder.make_room()
+        return self.decoder.view[self.decoder.end:]
+
+    def buffer_updated(self, nbytes):
+        self.decoder.end += nbytes
+        try:
+            for frame in self.decoder.frames():
+                try:
+                    self.client.receive(frame)
+                except (CompressionError, struct.error) as e:
+                    # The framing is intact, so only this message is lost
+                    print(f"Error receiving message: {str(e)}")
+        except FrameTooLargeError as e:
+            print(f"Error receiving message: {str(e)}")
+            self.transport.close()
+
+    def pause_writing(self):
+        self.resumed = asyncio.get_running_loop().create_future()
+
+    def resume_writing(self):
+        resumed, self.resumed = self.resumed, None
+        if resumed and not resumed.done():
+            resumed.set_result(None)
+
+    def connection_lost(self, exc):
+        self.resume_writing()
+        if self.client.protocol is self:  # not an abandoned v2 attempt
+            self.client.connection_lost(exc)
+
+
+class RepeatingTimer:
+    # Fires every interval seconds on the loop. Each run is scheduled from the
+    # planned time of the previous one, so the timer does not drift.
+    def __init__(self, loop, interval, callback):
+        self.loop = loop
+        self.interval = interval
+        self.callback = callback
+        self.when = loop.time() + interval
+        self.handle = loop.call_at(self.when, self.run)
+
+    def run(self):
+        self.when = max(self.when + self.interval, self.loop.time())
+        self.handle = self.loop.call_at(self.when, self.run)
+        self.callback()
+
+    def cancel(self):
+        self.handle.cancel()
+
+
+class AsyncChatClient:
+    # Event-driven chat client: incoming messages go to the on_message callbacks
+    # and to messages(), timers run on the loop, nothing is polled
+    def __init__(self, username, host='localhost', port=8080, max_frame_size=None, protocol=PROTOCOL_V2,
+                 compression=tuple(CODECS), reconnect=False):
+        self.username = str(username)
+        if reserved_username(self.username.encode('utf-8')):
+            raise ValueError(f"Usernames cannot start with a control prefix such as __: {self.username}")
+        self.host = host
+        self.port = port
+        self.max_frame_size = max_frame_size
+        self.requested_version = protocol
+        self.version = protocol  # PROTOCOL_V1 once a server turns v2 down
+        self.hello = None  # resolved with our sender id when the server accepts v2
+        self.sender_id = None
+        self.compression = [codec for codec in compression if codec in CODECS]  # codecs offered to the server
+        self.codec = None  # the one the server picked
+        self.loop = None
+        self.transport = None
+        self.protocol = None
+        self.closed = None  # done once the connection is gone for good
+        self.reconnect = reconnect  # come back after the connection drops, until close()
+        self.reconnect_window = None  # set by a server that is going away
+        self.reconnecting = None  # task trying to get a new connection
+        self.reconnects = 0
+        self.closing = False
+        self.callbacks = []
+        self.chunk_callbacks = []
+        self.streams = {}  # (sender prefix, stream id) -> parts received so far
+        self.next_stream_id = 0
+        self.next_message_id = 0
+        self.last_message_id = 0  # newest message id received, for request_history(since=...)
+        self.inbox = None  # created by the first messages() call
+        self.timers = set()
+        self.sent_messages = 0
+        self.send_calls = 0
+        self.joined_rooms = {DEFAULT_ROOM}
+        self.current_room = DEFAULT_ROOM
+
+    async def connect(self):
+        self.loop = asyncio.get_running_loop()
+        self.closed = self.loop.create_future()
+        await self.log_in()
+
+    async def log_in(self):
+        self.version = self.requested_version
+        if self.version == PROTOCOL_V2:
+            # Offer v2 in the login frame; a v1 server does not answer with a hello
+            self.hello = self.loop.create_future()
+            await self.open()
+            self.send_buffers([encode_frame(hello_offer(self.username.encode('utf-8'), self.compression))], 1)
+            try:
+                self.sender_id = await asyncio.wait_for(asyncio.shield(self.hello), HELLO_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.sender_id = None
+            if self.sender_id is not None:
+                return
+            self.version = PROTOCOL_V1
+            protocol, self.protocol = self.protocol, None
+            protocol.transport.abort()
+        await self.open()
+        self.send_buffers([encode_frame(self.username.encode('utf-8'))], 1)
+
+    async def open(self):
+        self.transport, self.protocol = await self.loop.create_connection(
+            lambda: ChatProtocol(self), self.host, self.port)
+
+    def on_message(self, callback):
+        self.callbacks.append(callback)
+        return callback
+
+    def on_chunk(self, callback):
+        # Called with (sender prefix, stream id, text) for every part of a streamed message
+        self.chunk_callbacks.append(callback)
+        return callback
+
+    def receive(self, frame, replayed=False):
+        if self.hello is not None and not self.hello.done():
+            # The first frame answers the v2 offer
+            kind = frame[0] if len(frame) >= V2_HEADER_SIZE else None
+            if kind == HELLO:
+                _, _, _, sender_id, _, codec = decode_v2(frame)
+                self.codec = str(codec, 'ascii') or None
+                self.hello.set_result(sender_id)
+            else:
+                self.hello.set_result(None)
+            return
+        if self.version == PROTOCOL_V2:
+            kind, flags, message_id, sender_id, timestamp, payload = decode_v2(frame)
+        else:
+            (kind, message_id, payload), sender_id, timestamp = decode_v1(frame), 0, None
+        if kind == TEXT:
+            # Counted before anything can fail, so a bad record is not asked for again
+            self.last_message_id = max(self.last_message_id, message_id)
+        if self.version == PROTOCOL_V2:
+            payload = decompress_payload(flags, payload, self.max_frame_size or DEFAULT_MAX_FRAME_SIZE)
+            if kind == HISTORY:
+                for logged in split_frames(payload):
+                    try:
+                        self.receive(logged, True)
+                    except Exception as e:
+                        # Skipped: failing the batch would replay it on every reconnect
+                        print(f"Error replaying message: {str(e)}")
+                return
+            if kind == PING:
+                # The server checks that we are still there
+                if not self.transport.is_closing():
+                    self.send_buffers([self.encode(PONG, '', 0)], 0)
+                return
+        if kind == RECONNECT:
+            # The server is going away; leaving now lets it finish sooner
+            self.reconnect_window = parse_reconnect_hint(payload)
+            self.transport.close()
+            return
+        # The server relays text unchecked; one client's bad bytes must not cut off everyone else
+        message = chat_message(str(payload, 'utf-8', 'replace'), message_id, sender_id, timestamp)
+        message.replayed = replayed
+        message.direct = kind == DIRECT
+        if kind == STREAM or kind == STREAM_END:
+            message = self.reassemble(message, kind == STREAM_END)
+            if message is None:
+                return
+        elif kind != TEXT and kind != DIRECT:
+            return
+        self.deliver(message)
+
+    def deliver(self, message):
+        for callback in self.callbacks:
+            callback(message)
+        if self.inbox is not None:
+            self.inbox.put_nowait(message)
+
+    def reassemble(self, part, end):
+        # Parts arrive as "username: text" with the stream id as message id; the
+        # complete message is returned with the last part and delivered like any other
+        stream_id = part.message_id
+        split = part.find(': ') + 2
+        sender, text = part[:split], part[split:]
+
+        key = (sender, stream_id)
+        parts = self.streams.pop(key, [])
+        parts.append(text)
+        for callback in self.chunk_callbacks:
+            callback(sender, stream_id, text)
+        if end:
+            message = chat_message(sender + ''.join(parts), stream_id, part.sender_id, part.timestamp)
+            message.replayed = part.replayed
+            return message
+
+        self.streams[key] = parts  # re-inserted last, so the front holds the stalest stream
+        if len(self.streams) > MAX_OPEN_STREAMS:
+            del self.streams[next(iter(self.streams))]
+        return None
+
+    async def messages(self):
+        # Every message received from now on, until the connection closes
+        if self.inbox is None:
+            self.inbox = asyncio.Queue()
+        while True:
+            message = await self.inbox.get()
+            if message is None:
+                return
+            yield message
+
+    def encode(self, kind, text='', message_id=None):
+        # One frame in the protocol agreed with the server
+        if message_id is None:
+            self.next_message_id += 1
+            message_id = self.next_message_id
+        payload = str(text).encode('utf-8')
+        if self.version == PROTOCOL_V2:
+            return encode_v2(kind, payload, message_id)
+        return encode_v1(kind, payload, message_id)
+
+    def send_message(self, message):
+        self.send_buffers([self.encode(TEXT, message)], 1)
+
+    def send_many(self, messages):
+        # Frame a whole batch and hand it to the transport in one write
+        buffers = [self.encode(TEXT, message) for message in messages]
+        self.send_buffers(buffers, len(buffers))
+
+    def send_buffers(self, buffers, message_count):
+        if self.transport is None or self.transport.is_closing():
+            raise ConnectionError(f"{self.username} is not connected")
+        self.transport.writelines(buffers)
+        self.send_calls += 1
+        self.sent_messages += message_count
+
+    def send_direct(self, recipients, text):
+        # Only the named users get the message, a username or a list of them.
+        # It arrives as "username: text" with direct set.
+        if isinstance(recipients, str):
+            recipients = [recipients]
+        self.send_buffers([self.encode(DIRECT, direct_message(recipients, text))], 1)
+
+    def start_stream(self):
+        # A message sent in parts with send_chunk and end_stream
+        self.next_stream_id += 1
+        return self.next_stream_id
+
+    def send_chunk(self, stream_id, text):
+        self.send_buffers([self.encode(STREAM, text, stream_id)], 1)
+
+    def end_stream(self, stream_id, text=''):
+        self.send_buffers([self.encode(STREAM_END, text, stream_id)], 1)
+
+    def writing_paused(self):
+        return self.protocol is not None and self.protocol.resumed is not None
+
+    async def drain(self):
+        # Wait until the transport's write buffer is below its high-water mark
+        if self.writing_paused():
+            await self.protocol.resumed
+
+    def join_room(self, room):
+        # The server sends our messages to the room we joined last
+        room = str(room)
+        self.send_buffers([self.encode(JOIN, room, 0)], 1)
+        self.joined_rooms.add(room)
+        self.current_room = room
+
+    def leave_room(self, room):
+        room = str(room)
+        self.send_buffers([self.encode(LEAVE, room, 0)], 1)
+        self.joined_rooms.discard(room)
+        if self.current_room == room:
+            self.current_room = DEFAULT_ROOM if DEFAULT_ROOM in self.joined_rooms else next(iter(self.joined_rooms), None)
+
+    def request_history(self, last=None, since=None, room=None):
+        # Ask for logged messages of one of our rooms, the current one by default:
+        # the last N, or those after message id since. They arrive through the
+        # usual callbacks with replayed set, if the server keeps a log.
+        self.send_buffers([self.encode(HISTORY, history_request(last, since, room), 0)], 1)
+
+    def call_later(self, delay, callback, *args):
+        def run():
+            self.timers.discard(handle)
+            callback(*args)
+
+        handle = self.loop.call_later(delay, run)
+        self.timers.add(handle)
+        return handle
+
+    def call_every(self, interval, callback):
+        timer = RepeatingTimer(self.loop, interval, callback)
+        self.timers.add(timer)
+        return timer
+
+    def cancel_timers(self):
+        for timer in self.timers:
+            timer.cancel()
+        self.timers.clear()
+
+    def connection_lost(self, exc):
+        if self.hello is not None and not self.hello.done():
+            self.hello.set_result(None)
+        window, self.reconnect_window = self.reconnect_window, None
+        if self.reconnect and not self.closing:
+            if self.reconnecting is None or self.reconnecting.done():
+                self.reconnecting = self.loop.create_task(self.reconnect_later(window))
+            return
+        self.finish(exc)
+
+    async def reconnect_later(self, window):
+        # Full jitter: every client waits a random part of the window, so
+        # clients dropped together do not all come back at the same moment
+        delay = RECONNECT_DELAY if window is None else window
+        for _ in range(RECONNECT_ATTEMPTS):
+            await asyncio.sleep(random.uniform(0, delay))
+            try:
+                await self.log_in()
+            except OSError:
+                delay = min(max(delay * 2, RECONNECT_DELAY), MAX_RECONNECT_DELAY)
+                continue
+            self.reconnects += 1
+            self.restore_session()
+            return
+        self.finish(ConnectionError(f"{self.username} could not reconnect"))
+
+    def restore_session(self):
+        # A new connection starts out in the default room only: rejoin ours,
+        # the current one last, and ask for what was said while we were away
+        for room in self.joined_rooms:
+            if room != DEFAULT_ROOM and room != self.current_room:
+                self.send_buffers([self.encode(JOIN, room, 0)], 1)
+        if DEFAULT_ROOM not in self.joined_rooms:
+            self.send_buffers([self.encode(LEAVE, DEFAULT_ROOM, 0)], 1)
+        if self.current_room is not None:
+            self.send_buffers([self.encode(JOIN, self.current_room, 0)], 1)
+        if self.last_message_id:
+            for room in self.joined_rooms:
+                self.request_history(since=self.last_message_id, room=room)
+
+    def finish(self, exc):
+        self.cancel_timers()
+        if self.inbox is not None:
+            self.inbox.put_nowait(None)
+        if not self.closed.done():
+            self.closed.set_result(exc)
+
+    def close(self):
+        self.closing = True
+        self.cancel_timers()
+        if self.reconnecting is not None and not self.reconnecting.done():
+            self.reconnecting.cancel()
+            if self.transport is not None:
+                self.transport.close()
+            self.finish(None)
+            return
+        if self.transport is not None and not self.transport.is_closing():
+            self.send_buffers([self.encode(DISCONNECT, '', 0)], 1)
+            self.transport.close()  # buffered frames are still written first
+
+    async def wait_closed(self):
+        if self.closed is not None:
+            await asyncio.shield(self.closed)
@@ -0,0 +1,339 @@
+# benchmark.py
+import os
+import sys
+import json
+import math
+import time
+import socket
+import argparse
+import selectors
+import multiprocessing
+from array import array
+from framing import FrameDecoder, encode_frame, FRAME_HEADER
+from server import create_server, raise_fd_limit, ENGINES
+from sharded_server import ShardedChatServer
+from outbound import BLOCK, POLICIES
+
+# Payloads start with the send time so receivers can measure end-to-end latency
+TIMESTAMP_DIGITS = 20
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def process_usage(pids):
+    # CPU seconds and memory of the server processes, read from /proc (Linux only)
+    usage = {"cpu_seconds": 0.0, "rss_bytes": 0, "peak_rss_bytes": 0}
+    ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat') as stat_file:
+                fields = stat_file.read().rsplit(')', 1)[1].split()
+            usage["cpu_seconds"] += (int(fields[11]) + int(fields[12])) / ticks
+            with open(f'/proc/{pid}/status') as status_file:
+                for line in status_file:
+                    if line.startswith('VmRSS:'):
+                        usage["rss_bytes"] += int(line.split()[1]) * 1024
+                    elif line.startswith('VmHWM:'):
+                        usage["peak_rss_bytes"] += int(line.split()[1]) * 1024
+        except (OSError, IndexError, ValueError):
+            return None
+    return usage
+
+
+def serve(engine, host, port, server_kwargs):
+    sys.stdout = open(os.devnull, 'w')
+    create_server(engine, host=host, port=port, **server_kwargs).run()
+
+
+def wait_for_port(host, port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port)).close()
+            return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+class BenchmarkServer:
+    # The server under test, in its own processes so its CPU and memory can be measured
+    def __init__(self, engine, host, port, workers=1, **server_kwargs):
+        self.sharded = None
+        self.process = None
+        if engine == 'sharded':
+            self.sharded = ShardedChatServer(host, port, workers, quiet=True, **server_kwargs)
+            self.sharded.start()
+            self.sharded.wait_ready()
+        else:
+            self.process = multiprocessing.Process(target=serve, args=(engine, host, port, server_kwargs))
+            self.process.daemon = True
+            self.process.start()
+            wait_for_port(host, port)
+
+    def pids(self):
+        if self.sharded:
+            return [process.pid for process in self.sharded.processes]
+        return [self.process.pid]
+
+    def stop(self):
+        if self.sharded:
+            self.sharded.stop()
+        else:
+            self.process.terminate()
+            self.process.join(timeout=5)
+
+
+def room_members(clients, room_size):
+    # Client i is in room i // room_size; room_size 0 keeps everyone in the lobby
+    if not room_size:
+        return [clients] * clients
+    return [min(room_size, clients - (i // room_size) * room_size) for i in range(clients)]
+
+
+def run_clients(host, port, first_id, count, members, messages, rate, size, room_size,
+                ready, start, results, timeout):
+    # One load-generator process driving `count` simulated clients
+    selector = selectors.DefaultSelector()
+    clients = []
+    for i in range(first_id, first_id + count):
+        client_socket = socket.create_connection((host, port))
+        setup = [encode_frame(f"bench{i}".encode('utf-8'))]
+        if room_size:
+            setup += [encode_frame(f"__JOIN__ room{i // room_size}".encode('utf-8')), encode_frame(b"__LEAVE__ lobby")]
+        client_socket.sendall(b''.join(setup))
+        client_socket.setblocking(False)
+        client = {
+            "socket": client_socket,
+            "decoder": FrameDecoder(max_frame_size=None),
+            "out": bytearray(),
+            "sent": 0,
+            "received": 0,
+            "expected": (members[i] - 1) * messages,
+        }
+        clients.append(client)
+        selector.register(client_socket, selectors.EVENT_READ, client)
+    ready.put(count)
+    start.wait()
+
+    padding = b'x' * max(0, size - TIMESTAMP_DIGITS)
+    latencies = array('d')
+    began = time.monotonic()
+    interval = 1.0 / rate if rate else 0.0
+    next_round = began
+    unsent = count * messages
+    unfinished = sum(1 for client in clients if client["expected"])
+    deadline = began + (messages * interval if rate else 0) + timeout
+
+    while (unsent or unfinished) and time.monotonic() < deadline:
+        now = time.monotonic()
+        if unsent and now >= next_round:
+            # Every client sends its next message; with a rate this happens
+            # once per interval, otherwise as fast as the server takes them
+            for client in clients:
+                if client["sent"] < messages and (rate or len(client["out"]) < 65536):
+                    payload = b'%020d' % time.monotonic_ns() + padding
+                    client["out"] += FRAME_HEADER.pack(len(payload)) + payload
+                    client["sent"] += 1
+                    unsent -= 1
+                    selector.modify(client["socket"], selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+            next_round += interval
+
+        wait = max(0.0, next_round - time.monotonic()) if unsent and rate else (0 if unsent else 0.1)
+        for key, mask in selector.select(timeout=wait):
+            client = key.data
+            client_socket = client["socket"]
+            if mask & selectors.EVENT_WRITE and client["out"]:
+                try:
+                    sent = client_socket.send(client["out"])
+                    del client["out"][:sent]
+                except BlockingIOError:
+                    pass
+                if not client["out"]:
+                    selector.modify(client_socket, selectors.EVENT_READ, client)
+            if mask & selectors.EVENT_READ:
+                try:
+                    if not client["decoder"].recv_into(client_socket):
+                        selector.unregister(client_socket)
+                        continue
+                except BlockingIOError:
+                    continue
+                received_at = time.monotonic_ns()
+                for frame in client["decoder"].frames():
+                    start_index = bytes(frame[:64]).find(b': ') + 2
+                    sent_at = int(bytes(frame[start_index:start_index + TIMESTAMP_DIGITS]))
+                    latencies.append((received_at - sent_at) / 1e6)
+                    client["received"] += 1
+                    if client["received"] == client["expected"]:
+                        unfinished -= 1
+
+    results.put({
+        "sent": sum(client["sent"] for client in clients),
+        "received": sum(client["received"] for client in clients),
+        "elapsed": time.monotonic() - began,
+        "latencies": latencies,
+    })
+    for client in clients:
+        client["socket"].close()
+
+
+def run_benchmark(engine='selectors', clients=100, messages=100, rate=0, size=64, room_size=10,
+                  processes=None, workers=1, policy=BLOCK, host='localhost', port=9200, timeout=30):
+    processes = max(1, min(processes or os.cpu_count() or 1, clients))
+    members = room_members(clients, room_size)
+    server = BenchmarkServer(engine, host, port, workers, slow_consumer_policy=policy)
+    try:
+        context = multiprocessing.get_context()
+        ready, results, start = context.Queue(), context.Queue(), context.Event()
+        generators = []
+        first_id = 0
+        for i in range(processes):
+            count = clients // processes + (1 if i < clients % processes else 0)
+            generator = context.Process(target=run_clients, args=(
+                host, port, first_id, count, members, messages, rate, size, room_size, ready, start, results, timeout))
+            generator.start()
+            generators.append(generator)
+            first_id += count
+
+        for _ in generators:
+            ready.get()
+        time.sleep(0.5)  # let the server finish logins and room joins
+
+        usage_before = process_usage(server.pids())
+        start.set()
+        reports = [results.get() for _ in generators]
+        usage_after = process_usage(server.pids())
+        for generator in generators:
+            generator.join()
+    finally:
+        server.stop()
+
+    latencies = sorted(latency for report in reports for latency in report["latencies"])
+    elapsed = max(report["elapsed"] for report in reports)
+    delivered = sum(report["received"] for report in reports)
+    result = {
+        "engine": engine,
+        "workers": workers if engine == 'sharded' else 1,
+        "clients": clients,
+        "room_size": room_size or clients,
+        "messages_per_client": messages,
+        "rate_per_client": rate,
+        "message_size": size,
+        "sent": sum(report["sent"] for report in reports),
+        "delivered": delivered,
+        "expected": sum((m - 1) * messages for m in members),
+        "elapsed": round(elapsed, 4),
+        "delivered_per_sec": round(delivered / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50),
+            "p99": percentile(latencies, 0.99),
+            "p999": percentile(latencies, 0.999),
+            "max": latencies[-1] if latencies else None,
+        },
+        "server": None,
+    }
+    if usage_before and usage_after:
+        cpu_seconds = usage_after["cpu_seconds"] - usage_before["cpu_seconds"]
+        result["server"] = {
+            "cpu_seconds": round(cpu_seconds, 3),
+            "cpu_percent": round(100 * cpu_seconds / elapsed, 1) if elapsed else 0.0,
+            "rss_bytes": usage_after["rss_bytes"],
+            "peak_rss_bytes": usage_after["peak_rss_bytes"],
+        }
+    return result
+
+
+def idle_memory(engine='selectors', clients=1000, host='localhost', port=9300, settle=1.0):
+    # Server memory growth per logged in client that sends nothing
+    raise_fd_limit()
+    server = BenchmarkServer(engine, host, port)
+    sockets = []
+    try:
+        time.sleep(settle)
+        before = process_usage(server.pids())
+        for i in range(clients):
+            client_socket = socket.create_connection((host, port))
+            client_socket.sendall(encode_frame(f"idle{i}".encode('utf-8')))
+            sockets.append(client_socket)
+        time.sleep(settle)  # let the server finish the logins
+        after = process_usage(server.pids())
+    finally:
+        for client_socket in sockets:
+            client_socket.close()
+        server.stop()
+
+    result = {"engine": engine, "clients": clients, "server": None}
+    if before and after:
+        result["server"] = {
+            "rss_bytes_before": before["rss_bytes"],
+            "rss_bytes_after": after["rss_bytes"],
+            "rss_bytes_per_client": round((after["rss_bytes"] - before["rss_bytes"]) / clients),
+        }
+    return result
+
+
+def shard_scaling(max_workers, clients, messages, size, processes, room_size=0, port=9100, host='localhost'):
+    results = []
+    for workers in range(1, max_workers + 1):
+        result = run_benchmark('sharded', clients, messages, 0, size, room_size, processes, workers,
+                               host=host, port=port + workers)
+        results.append(result)
+        print(json.dumps(result))
+    return results
+
+
+def write_results(results, output):
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat server benchmarks (loopback only)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    load = commands.add_parser('load', help="latency and throughput under a simulated client load")
+    load.add_argument('--engine', choices=sorted(ENGINES) + ['sharded'], default='selectors')
+    load.add_argument('--workers', type=int, default=os.cpu_count(), help="worker processes for the sharded engine")
+    load.add_argument('--clients', type=int, default=1000)
+    load.add_argument('--messages', type=int, default=20, help="messages each client sends")
+    load.add_argument('--rate', type=float, default=2, help="messages per second per client, 0 for as fast as possible")
+    load.add_argument('--size', type=int, default=64, help="message size in bytes")
+    load.add_argument('--room-size', type=int, default=10, help="clients per room, 0 for everyone in the lobby")
+    load.add_argument('--policy', choices=POLICIES, default=BLOCK, help="server slow consumer policy")
+    load.add_argument('--processes', type=int, default=os.cpu_count(), help="load generator processes")
+    load.add_argument('--port', type=int, default=9200)
+    load.add_argument('--output', help="also write the JSON results to this file")
+
+    idle = commands.add_parser('idle', help="server memory per idle connection")
+    idle.add_argument('--engine', choices=sorted(ENGINES), default='selectors')
+    idle.add_argument('--clients', type=int, default=1000)
+    idle.add_argument('--port', type=int, default=9300)
+    idle.add_argument('--output', help="also write the JSON results to this file")
+
+    shards = commands.add_parser('shards', help="throughput of the sharded server from 1 to N workers")
+    shards.add_argument('--max-workers', type=int, default=os.cpu_count())
+    shards.add_argument('--clients', type=int, default=50)
+    shards.add_argument('--messages', type=int, default=200)
+    shards.add_argument('--size', type=int, default=64)
+    shards.add_argument('--room-size', type=int, default=0)
+    shards.add_argument('--processes', type=int, default=os.cpu_count())
+    shards.add_argument('--output', help="also write the JSON results to this file")
+    args = parser.parse_args()
+
+    if args.command == 'load':
+        results = run_benchmark(args.engine, args.clients, args.messages, args.rate, args.size, args.room_size,
+                                args.processes, args.workers, args.policy, port=args.port)
+        print(json.dumps(results, indent=2))
+    elif args.command == 'idle':
+        results = idle_memory(args.engine, args.clients, port=args.port)
+        print(json.dumps(results, indent=2))
+    else:
+        results = shard_scaling(args.max_workers, args.clients, args.messages, args.size, args.processes,
+                                args.room_size)
+    write_results(results, args.output)
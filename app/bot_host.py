@@ -0,0 +1,142 @@
+# bot_host.py
+import json
+import asyncio
+import argparse
+from client import shared_loop
+from async_client import RepeatingTimer
+from ai_client import AIClient, MAX_IN_FLIGHT_CALLS
+from model_gateway import OpenAIBackend, GatewayClient
+from response_cache import MemoryCache
+from timer_wheel import TimerWheel
+
+SCHEDULER_TICK = 0.1  # seconds
+SCHEDULER_SLOTS = 1024  # a turn of the wheel is about 100 seconds
+# Settings a persona in the config file may have, besides its name
+PERSONA_SETTINGS = ('mode', 'interval', 'persona', 'rooms', 'stream', 'summarize', 'history_messages',
+                    'history_tokens', 'replay_history', 'protocol')
+
+
+class BotScheduler:
+    # One loop timer drives the posts of every time mode bot: bots wait in a
+    # timer wheel and each tick only looks at those due, however many there
+    # are. Runs on the client loop.
+    def __init__(self, loop, tick=SCHEDULER_TICK, slots=SCHEDULER_SLOTS):
+        self.loop = loop
+        self.tick = tick
+        self.wheel = TimerWheel(tick, slots, loop.time())
+        self.intervals = {}  # bot -> seconds between its posts
+        self.timer = None  # only while there are bots
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def add(self, bot, interval):
+        self.intervals[bot] = interval
+        self.wheel.schedule(bot, self.loop.time() + interval)
+        if self.timer is None:
+            self.timer = RepeatingTimer(self.loop, self.tick, self.run_due)
+
+    def remove(self, bot):
+        # Its entry stays in the wheel and is skipped when it comes due
+        self.intervals.pop(bot, None)
+        if not self.intervals and self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def run_due(self):
+        now = self.loop.time()
+        for bot in self.wheel.advance(now):
+            interval = self.intervals.get(bot)
+            if interval is None:
+                continue
+            self.wheel.schedule(bot, now + interval)
+            try:
+                bot.generate_unrelated_message()
+            except Exception as e:
+                print(f"Bot {bot.username} failed to post: {e}")
+
+
+def load_personas(path):
+    # The bot host config: a JSON object with a "bots" list, and optionally
+    # "host", "port", "gateway", "base_url", "max_in_flight" and "cache_entries"
+    with open(path, encoding='utf-8') as config_file:
+        config = json.load(config_file)
+    for persona in config.get("bots", []):
+        if 'name' not in persona:
+            raise ValueError(f"Every bot needs a name: {persona}")
+        unknown = set(persona) - set(PERSONA_SETTINGS) - {'name'}
+        if unknown:
+            raise ValueError(f"Unknown settings for bot {persona['name']}: {', '.join(sorted(unknown))}, "
+                             f"supporting only {', '.join(PERSONA_SETTINGS)}")
+    return config
+
+
+class BotHost:
+    # Many AIClient personas in one process: they share the client loop, one
+    # model backend and its connection pool, one limit on model calls in
+    # flight, one response cache and one scheduler for time mode posts. Each
+    # bot still has its own server connection, as the protocol logs in one
+    # username per connection.
+    def __init__(self, personas, host='localhost', port=8080, api_key=None, base_url=None, gateway=None,
+                 max_in_flight=MAX_IN_FLIGHT_CALLS, cache=None, test_mode=False):
+        self.loop_thread = shared_loop()
+        if gateway:
+            self.model_backend = GatewayClient(gateway)
+        else:
+            self.model_backend = OpenAIBackend(api_key, base_url)
+        self.call_slots = asyncio.Semaphore(max_in_flight)
+        self.scheduler = self.loop_thread.call(BotScheduler, self.loop_thread.loop)
+        self.cache = cache
+        self.bots = []
+        for persona in personas:
+            settings = dict(persona)
+            name = settings.pop('name')
+            mode = settings.pop('mode', 'lines')
+            interval = settings.pop('interval', 5)
+            self.bots.append(AIClient(name, mode, interval, api_key, host, port, test_mode, cache=cache,
+                                      model_backend=self.model_backend, call_slots=self.call_slots,
+                                      scheduler=self.scheduler, **settings))
+
+    @classmethod
+    def from_config(cls, path, api_key=None, **kwargs):
+        config = load_personas(path)
+        cache_entries = config.get("cache_entries")
+        options = dict(host=config.get("host", 'localhost'), port=config.get("port", 8080),
+                       base_url=config.get("base_url"), gateway=config.get("gateway"),
+                       max_in_flight=config.get("max_in_flight", MAX_IN_FLIGHT_CALLS),
+                       cache=MemoryCache(cache_entries) if cache_entries else None)
+        options.update(kwargs)
+        return cls(config["bots"], api_key=api_key, **options)
+
+    def start(self):
+        for bot in self.bots:
+            bot.start()
+
+    def wait_closed(self, timeout=None):
+        for bot in self.bots:
+            bot.wait_closed(timeout)
+
+    def close(self):
+        for bot in self.bots:
+            bot.close()
+        self.loop_thread.call(self.model_backend.close)
+
+    def stats(self):
+        return {
+            "bots": len(self.bots),
+            "scheduled": len(self.scheduler),
+            "model_requests": sum(bot.model_requests for bot in self.bots),
+            "coalesced_triggers": sum(bot.coalesced_triggers for bot in self.bots),
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run many AI bots in one process")
+    parser.add_argument('config', help="JSON file with the bots and where to connect them")
+    parser.add_argument('--api-key', default=None, help="OpenAI API key, default OPENAI_API_KEY")
+    args = parser.parse_args()
+
+    bot_host = BotHost.from_config(args.config, args.api_key)
+    bot_host.start()
+    print(f"Running {len(bot_host.bots)} bots")
+    bot_host.wait_closed()
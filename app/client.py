@@ -1,82 +1,181 @@
-import socket
-import struct
-import threading
 import sys
-import select
-import os
+import asyncio
+import threading
+import concurrent.futures
+from async_client import AsyncChatClient
+from protocol import PROTOCOL_V2
+
+
+class LoopThread:
+    # One asyncio loop on a daemon thread. Every sync ChatClient in the process
+    # shares it, so idle clients cost no threads and no wakeups.
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='chat-client-loop', daemon=True)
+        self.thread.start()
+
+    def call(self, function, *args):
+        # Run function on the loop and return its result to the calling thread
+        if threading.get_ident() == self.thread.ident:
+            return function(*args)
+
+        future = concurrent.futures.Future()
+
+        def run():
+            try:
+                future.set_result(function(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+        self.loop.call_soon_threadsafe(run)
+        return future.result()
+
+    def run(self, coroutine, timeout=None):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+
+shared_loop_thread = None
+shared_loop_lock = threading.Lock()
+
+
+def shared_loop():
+    global shared_loop_thread
+    with shared_loop_lock:
+        if shared_loop_thread is None:
+            shared_loop_thread = LoopThread()
+        return shared_loop_thread
+
 
 class ChatClient:
-    def __init__(self, username, host='localhost', port=8080, test_mode=False):
-        self.username = str(username)
+    # Blocking wrapper around AsyncChatClient for callers without an event loop.
+    # handle_message and timer callbacks run on the shared loop thread, so they
+    # must not block.
+    reads_input = True
+
+    def __init__(self, username, host='localhost', port=8080, test_mode=False, max_frame_size=None,
+                 protocol=PROTOCOL_V2, reconnect=True):
+        # reconnect: come back with jittered backoff when the connection drops
+        # or the server restarts, until close()
+        self.client = AsyncChatClient(username, host, port, max_frame_size, protocol, reconnect=reconnect)
+        self.username = self.client.username
         self.host = host
         self.port = port
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.test_mode = test_mode
-        self.listening = False
-        self.listen_thread = None
         self.received_messages = [] if test_mode else None
+        self.loop_thread = shared_loop()
+        self.client.on_message(self.handle_message)
+
+    @property
+    def sent_messages(self):
+        return self.client.sent_messages
+
+    @property
+    def send_calls(self):
+        return self.client.send_calls
+
+    @property
+    def reconnects(self):
+        return self.client.reconnects
+
+    @property
+    def joined_rooms(self):
+        return self.client.joined_rooms
+
+    @property
+    def current_room(self):
+        return self.client.current_room
 
     def send_message(self, message):
-        message = str(message).encode('utf-8')
-        message_header = struct.pack('!I', len(message))
-        self.client_socket.send(message_header + message)
-
-    def receive_message(self):
-        try:
-            message_header = self.client_socket.recv(4)
-            if not len(message_header):
-                return None  # Connection closed by the server
-            message_length = struct.unpack('!I', message_header)[0]
-            return self.client_socket.recv(message_length).decode('utf-8')
-        except IOError:
-            return None
-        except Exception as e:
-            print(f"Error receiving message: {str(e)}")
-            return None
-    
-    def handle_receive(self):
-        message = self.receive_message()
+        self.loop_thread.call(self.client.send_message, message)
+        self.wait_for_room()
+
+    def send_many(self, messages):
+        # Frame a whole batch and hand it to the kernel in one write
+        self.loop_thread.call(self.client.send_many, messages)
+        self.wait_for_room()
+
+    def send_direct(self, recipients, text):
+        # To the named users only, a username or a list of them
+        self.loop_thread.call(self.client.send_direct, recipients, text)
+        self.wait_for_room()
+
+    def start_stream(self):
+        return self.loop_thread.call(self.client.start_stream)
+
+    def send_chunk(self, stream_id, text):
+        self.loop_thread.call(self.client.send_chunk, stream_id, text)
+        self.wait_for_room()
+
+    def end_stream(self, stream_id, text=''):
+        self.loop_thread.call(self.client.end_stream, stream_id, text)
+        self.wait_for_room()
+
+    def wait_for_room(self):
+        # Block a sending thread while the connection's write buffer is full
+        if threading.get_ident() != self.loop_thread.thread.ident and self.client.writing_paused():
+            self.loop_thread.run(self.client.drain())
+
+    def join_room(self, room):
+        self.loop_thread.call(self.client.join_room, room)
+
+    def leave_room(self, room):
+        self.loop_thread.call(self.client.leave_room, room)
+
+    def request_history(self, last=None, since=None, room=None):
+        self.loop_thread.call(self.client.request_history, last, since, room)
+
+    def call_later(self, delay, callback, *args):
+        return self.loop_thread.call(self.client.call_later, delay, callback, *args)
+
+    def call_every(self, interval, callback):
+        return self.loop_thread.call(self.client.call_every, interval, callback)
+
+    def handle_message(self, message):
         if message:
             if self.test_mode:
                 self.received_messages.append(message)
             
-            print(message)
+            print(f"(direct) {message}" if message.direct else message)
             
     def handle_input(self):
         line = sys.stdin.readline().strip()
-        if line:
+        if line.startswith('/join '):
+            self.join_room(line[len('/join '):].strip())
+        elif line.startswith('/leave '):
+            self.leave_room(line[len('/leave '):].strip())
+        elif line.startswith('/dm '):
+            names, _, text = line[len('/dm '):].strip().partition(' ')
+            if names and text:
+                self.send_direct(names.split(','), text)
+        elif line.startswith('/history '):
+            count = line[len('/history '):].strip()
+            if count.isdigit():
+                self.request_history(last=int(count))
+        elif line:
             self.send_message(line)
 
-    def listen_for_events(self):
-        while self.listening:
-            try:
-                read_sockets, _, _ = select.select([self.client_socket, sys.stdin], [], [], 0.1)
-                for notified_socket in read_sockets:
-                    if notified_socket == self.client_socket:
-                        self.handle_receive()
-                    elif notified_socket == sys.stdin and not self.test_mode:
-                        self.handle_input()
-            except Exception as e:
-                print(f"Error in select: {str(e)}")
-                sys.exit()
+    def watch_input(self):
+        self.client.loop.add_reader(sys.stdin, self.handle_input)
+        self.client.closed.add_done_callback(lambda _: self.client.loop.remove_reader(sys.stdin))
 
     def start(self):
-        self.client_socket.connect((self.host, self.port))
-        self.client_socket.setblocking(False)
-        self.listening = True
-        self.send_message(self.username)
-        self.listen_thread = threading.Thread(target=self.listen_for_events)
-        self.listen_thread.start()
+        self.loop_thread.run(self.client.connect())
+        if self.reads_input and not self.test_mode:
+            self.loop_thread.call(self.watch_input)
+
+    def wait_closed(self, timeout=None):
+        # Block until the connection is gone for good or close() is called
+        self.loop_thread.run(self.client.wait_closed(), timeout)
     
     def close(self):
-        self.listening = False
-        if self.listen_thread:
-            self.listen_thread.join(timeout=1)
-            self.send_message("__DISCONNECT__")  # Send disconnect message
-        self.client_socket.close()
+        self.loop_thread.call(self.client.close)
 
 if __name__ == "__main__":
     username = input("Enter your Username: ")
     print("Waiting for your message write it and press enter to send")
+    print("Use /join <room> to join or switch to a room and /leave <room> to leave it")
+    print("Use /history <count> to see the last messages of the current room")
+    print("Use /dm <user>[,<user>...] <message> to send a message to those users only")
     client = ChatClient(username)
-    client.start()
\ No newline at end of file
+    client.start()
+    client.wait_closed()
\ No newline at end of file
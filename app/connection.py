@@ -0,0 +1,86 @@
+# connection.py
+import sys
+
+
+class Connection:
+    # One client socket and everything the server keeps about it, in slots:
+    # the loop reads attributes instead of looking the socket up in a dict
+    # per structure, and an idle connection stays small.
+    __slots__ = ('socket', 'fd', 'address', 'id', 'username', 'name', 'protocol', 'codec', 'rooms', 'room',
+                 'decoder', 'outbound', 'last_seen', 'logged_in', 'messages_received', 'bytes_received', 'bucket',
+                 'streams')
+
+    def __init__(self, client_socket, address, decoder):
+        self.socket = client_socket
+        self.fd = client_socket.fileno()  # kept, the socket forgets it once closed
+        self.address = address
+        self.id = 0  # sender id carried in v2 frames
+        self.username = b''  # as sent at login
+        self.name = ''  # decoded once, for logs and stats
+        self.protocol = None
+        self.codec = None
+        self.rooms = {}  # room name -> pre-encoded "username: " prefix broadcast puts in front of messages
+        self.room = None  # where the client's messages go
+        self.decoder = decoder
+        self.outbound = None  # OutboundQueue, from login until the connection is released
+        self.last_seen = None  # loop time of the last read, while the idle timer watches it
+        self.logged_in = False
+        self.messages_received = 0
+        self.bytes_received = 0
+        self.bucket = None  # TokenBucket, when the server limits each client's rate
+        self.streams = None  # stream id -> text so far, of streams being logged
+
+    def __repr__(self):
+        return f'<Connection fd={self.fd} id={self.id} user={self.name!r}>'
+
+    def memory(self):
+        # Bytes of Python objects this connection holds; the socket's kernel buffers are not counted.
+        # Called from the metrics thread while the loop changes the connection:
+        # each attribute is read once and containers are copied before summing.
+        size = sys.getsizeof(self) + sys.getsizeof(self.username) + sys.getsizeof(self.name)
+        rooms = self.rooms
+        size += sys.getsizeof(rooms) + sum(sys.getsizeof(prefix) for prefix in list(rooms.values()))
+        size += sys.getsizeof(self.decoder) + sys.getsizeof(self.decoder.buffer)
+        outbound = self.outbound
+        if outbound is not None:
+            size += sys.getsizeof(outbound) + sys.getsizeof(outbound.frames) + outbound.queued_bytes
+        streams = self.streams
+        if streams:
+            size += sys.getsizeof(streams) + sum(sys.getsizeof(text) for text in list(streams.values()))
+        return size
+
+
+class ConnectionRegistry:
+    # Connections by file descriptor. The kernel hands out the lowest free
+    # descriptor, so the table stays about as long as the number of open
+    # sockets, and add, remove and lookup are one list index each.
+    def __init__(self):
+        self.table = []
+        self.count = 0
+
+    def add(self, connection):
+        if connection.fd >= len(self.table):
+            self.table.extend([None] * (connection.fd + 1 - len(self.table)))
+        self.table[connection.fd] = connection
+        self.count += 1
+
+    def remove(self, connection):
+        # False if it was not registered (any more)
+        if self.get(connection.fd) is not connection:
+            return False
+        self.table[connection.fd] = None
+        self.count -= 1
+        return True
+
+    def get(self, fd):
+        return self.table[fd] if 0 <= fd < len(self.table) else None
+
+    def __contains__(self, connection):
+        return self.get(connection.fd) is connection
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        # A snapshot, so connections can be removed while iterating
+        return iter([connection for connection in self.table if connection is not None])
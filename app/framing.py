@@ -0,0 +1,93 @@
+import struct
+
+# Every frame is a 4-byte big-endian length followed by the payload
+FRAME_HEADER = struct.Struct('!I')
+HEADER_SIZE = FRAME_HEADER.size
+DEFAULT_MAX_FRAME_SIZE = 1 << 20
+DEFAULT_BUFFER_SIZE = 4096
+
+
+class FrameTooLargeError(ValueError):
+    pass
+
+
+def encode_frame(payload):
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+class FrameDecoder:
+    # Incremental decoder over a preallocated buffer. Reads land directly in
+    # the buffer with recv_into and frames() hands out memoryviews of it, so a
+    # frame is only copied if the caller keeps it. Views stay valid until the
+    # next recv_into/feed call.
+    __slots__ = ('max_frame_size', 'buffer_size', 'buffer', 'view', 'start', 'end')
+
+    def __init__(self, max_frame_size=DEFAULT_MAX_FRAME_SIZE, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer_size = max(buffer_size, HEADER_SIZE)
+        self.buffer = bytearray(self.buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # first byte not yet handed out as a frame
+        self.end = 0  # end of received data
+
+    def __len__(self):
+        return self.end - self.start
+
+    def make_room(self):
+        # Leave free space after end, enough for the incomplete frame at start
+        pending = self.end - self.start
+        if not pending:
+            if len(self.buffer) > self.buffer_size:
+                # Give back the memory of an oversized frame
+                self.buffer = bytearray(self.buffer_size)
+                self.view = memoryview(self.buffer)
+            self.start = self.end = 0
+            return
+
+        wanted = pending + 1
+        if pending >= HEADER_SIZE:
+            frame_length = FRAME_HEADER.unpack_from(self.buffer, self.start)[0]
+            if self.max_frame_size is None or frame_length <= self.max_frame_size:
+                wanted = max(wanted, HEADER_SIZE + frame_length)
+        if self.start + wanted <= len(self.buffer) and self.end < len(self.buffer):
+            return
+
+        if wanted > len(self.buffer):
+            buffer = bytearray(max(wanted, 2 * len(self.buffer)))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer, self.view = buffer, memoryview(buffer)
+        else:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+        self.start, self.end = 0, pending
+
+    def recv_into(self, client_socket):
+        # Returns the number of bytes read, 0 when the peer closed the connection
+        self.make_room()
+        received = client_socket.recv_into(self.view[self.end:])
+        self.end += received
+        return received
+
+    def feed(self, data):
+        data = memoryview(data)
+        while data:
+            self.make_room()
+            chunk = min(len(data), len(self.buffer) - self.end)
+            self.view[self.end:self.end + chunk] = data[:chunk]
+            self.end += chunk
+            data = data[chunk:]
+
+    def frames(self):
+        while self.end - self.start >= HEADER_SIZE:
+            frame_length = FRAME_HEADER.unpack_from(self.buffer, self.start)[0]
+            if self.max_frame_size is not None and frame_length > self.max_frame_size:
+                raise FrameTooLargeError(f'Frame of {frame_length} bytes exceeds the {self.max_frame_size} byte limit')
+            if self.end - self.start < HEADER_SIZE + frame_length:
+                return
+
+            begin = self.start + HEADER_SIZE
+            self.start = begin + frame_length
+            yield self.view[begin:self.start]
+
+    def unread(self, frames):
+        # Puts back the last frames handed out, to be read again by frames()
+        self.start -= sum(HEADER_SIZE + len(frame) for frame in frames)
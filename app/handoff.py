@@ -0,0 +1,100 @@
+# handoff.py
+import os
+import json
+import socket
+
+# Sockets go over a Unix SOCK_SEQPACKET connection with SCM_RIGHTS, so every
+# message keeps its boundaries and its descriptors. The kernel caps the
+# descriptors of one message, so clients are sent in batches.
+MAX_FDS_PER_MESSAGE = 128
+MAX_MESSAGE_BYTES = 1 << 20
+CHUNK_BYTES = 64 << 10  # buffered client bytes follow their batch in pieces this big
+HANDOFF_TIMEOUT = 10  # seconds
+
+
+class HandoffError(ConnectionError):
+    pass
+
+
+def send_message(channel, message, fds=()):
+    socket.send_fds(channel, [json.dumps(message).encode('utf-8')], list(fds))
+
+
+def receive_message(channel):
+    data, fds, flags, _ = socket.recv_fds(channel, MAX_MESSAGE_BYTES, MAX_FDS_PER_MESSAGE)
+    if not data or flags & (socket.MSG_TRUNC | socket.MSG_CTRUNC):
+        for fd in fds:
+            os.close(fd)
+        raise HandoffError("Hand-off message truncated or connection closed")
+    return json.loads(data), fds
+
+
+def receive_bytes(channel, length):
+    data = bytearray()
+    while len(data) < length:
+        chunk = channel.recv(CHUNK_BYTES)
+        if not chunk:
+            raise HandoffError("Hand-off connection closed mid-transfer")
+        data += chunk
+    return bytes(data)
+
+
+def send_handoff(path, listener, clients=(), timeout=HANDOFF_TIMEOUT):
+    # Gives the listening socket, and every (socket, state, buffered bytes) in
+    # clients, to the process waiting in receive_handoff. state is anything
+    # JSON can carry. Returns once the other side has them all; the caller
+    # then closes its own copies, which leaves the connections open.
+    clients = list(clients)
+    channel = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    channel.settimeout(timeout)
+    with channel:
+        channel.connect(path)
+        send_message(channel, {"listener": True}, [listener.fileno()])
+        for start in range(0, len(clients), MAX_FDS_PER_MESSAGE):
+            batch = clients[start:start + MAX_FDS_PER_MESSAGE]
+            send_message(channel, {"clients": [dict(state, buffered=len(data)) for _, state, data in batch]},
+                         [client_socket.fileno() for client_socket, _, _ in batch])
+            data = b''.join(data for _, _, data in batch)
+            for offset in range(0, len(data), CHUNK_BYTES):
+                channel.sendall(data[offset:offset + CHUNK_BYTES])
+        send_message(channel, {"done": True})
+        if channel.recv(16) != b'ok':
+            raise HandoffError("Hand-off was not acknowledged")
+
+
+def receive_handoff(path, timeout=None):
+    # Waits at path for a server to hand its sockets over. Returns the
+    # listening socket and (socket, state, buffered bytes) of every client.
+    if os.path.exists(path):
+        os.unlink(path)
+    waiting = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    try:
+        waiting.bind(path)
+        waiting.listen(1)
+        waiting.settimeout(timeout)
+        channel, _ = waiting.accept()
+    finally:
+        waiting.close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+    listener, clients = None, []
+    with channel:
+        channel.settimeout(HANDOFF_TIMEOUT)
+        while True:
+            message, fds = receive_message(channel)
+            if message.get("done"):
+                break
+            if message.get("listener"):
+                listener = socket.socket(fileno=fds[0])
+                continue
+            states = message["clients"]
+            data = receive_bytes(channel, sum(state["buffered"] for state in states))
+            offset = 0
+            for fd, state in zip(fds, states):
+                clients.append((socket.socket(fileno=fd), state, data[offset:offset + state["buffered"]]))
+                offset += state["buffered"]
+        channel.sendall(b'ok')
+    if listener is None:
+        raise HandoffError("No listening socket was handed over")
+    return listener, clients
@@ -0,0 +1,65 @@
+from collections import deque
+from itertools import islice
+
+DEFAULT_MAX_MESSAGES = 200
+DEFAULT_MAX_TOKENS = 2000
+
+
+def estimate_tokens(text):
+    # About four characters per token for English text, no tokenizer needed
+    return len(text) // 4 + 1
+
+
+class ConversationHistory:
+    # Ring buffer of recent chat messages bounded by a message count and an
+    # estimated token budget. Messages pushed out are kept for summarization
+    # when keep_evicted is set, until take_evicted() collects them.
+    def __init__(self, max_messages=DEFAULT_MAX_MESSAGES, max_tokens=DEFAULT_MAX_TOKENS, keep_evicted=False):
+        self.max_messages = max_messages
+        self.max_tokens = max_tokens
+        self.messages = deque()
+        self.costs = deque()
+        self.tokens = 0
+        self.evicted = deque(maxlen=max_messages) if keep_evicted else None
+        self.evicted_messages = 0
+        self.summary = None  # rolling summary of evicted messages, set by the owner
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def append(self, message):
+        cost = estimate_tokens(message)
+        self.messages.append(message)
+        self.costs.append(cost)
+        self.tokens += cost
+        # The newest message always stays, even if it alone is over the budget
+        while len(self.messages) > self.max_messages or (self.tokens > self.max_tokens and len(self.messages) > 1):
+            evicted = self.messages.popleft()
+            self.tokens -= self.costs.popleft()
+            self.evicted_messages += 1
+            if self.evicted is not None:
+                self.evicted.append(evicted)
+
+    def recent(self, count):
+        # The last count messages, oldest first, without touching the rest
+        window = list(islice(reversed(self.messages), count))
+        window.reverse()
+        return window
+
+    def take_evicted(self):
+        if not self.evicted:
+            return []
+        evicted = list(self.evicted)
+        self.evicted.clear()
+        return evicted
+
+    def clear(self):
+        self.messages.clear()
+        self.costs.clear()
+        self.tokens = 0
+        self.summary = None
+        if self.evicted is not None:
+            self.evicted.clear()
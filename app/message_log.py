@@ -0,0 +1,220 @@
+import os
+import mmap
+import bisect
+import struct
+import threading
+from array import array
+from framing import FRAME_HEADER, HEADER_SIZE
+
+DEFAULT_SEGMENT_BYTES = 64 << 20
+DEFAULT_FSYNC_INTERVAL = 1.0  # seconds between fsyncs of newly written records
+# A record is its log id and room name length, the room name, then the v2
+# frame as it was broadcast (length included)
+RECORD_HEADER = struct.Struct('!QB')
+SEGMENT_SUFFIX = '.log'
+
+
+class Segment:
+    # One append-only file named after the id of its first record. Reads go
+    # through a memory map that is renewed when the file has grown.
+    def __init__(self, path, first_id):
+        self.path = path
+        self.first_id = first_id
+        self.file = open(path, 'a+b')
+        self.size = os.path.getsize(path)
+        self.offsets = array('Q')  # start of every record, in id order
+        self.map = None
+        self.mapped = 0
+
+    def view(self):
+        if self.mapped < self.size:
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ)
+            self.mapped = self.size
+        return self.map
+
+    def scan(self):
+        # (offset, room) of every complete record. A record torn by a crash
+        # ends the segment and is cut off.
+        if self.size == 0:
+            return
+        view = self.view()
+        offset = 0
+        while offset + RECORD_HEADER.size <= self.size:
+            log_id, room_length = RECORD_HEADER.unpack_from(view, offset)
+            frame_start = offset + RECORD_HEADER.size + room_length
+            if frame_start + HEADER_SIZE > self.size or log_id != self.first_id + len(self.offsets):
+                break
+            end = frame_start + HEADER_SIZE + FRAME_HEADER.unpack_from(view, frame_start)[0]
+            if end > self.size:
+                break
+            self.offsets.append(offset)
+            yield log_id, view[offset + RECORD_HEADER.size:frame_start]
+            offset = end
+        if offset < self.size:
+            self.map.close()
+            self.map, self.mapped = None, 0
+            self.file.truncate(offset)
+            self.size = offset
+
+    def frame(self, index):
+        start = self.offsets[index]
+        end = self.offsets[index + 1] if index + 1 < len(self.offsets) else self.size
+        view = self.view()
+        _, room_length = RECORD_HEADER.unpack_from(view, start)
+        return view[start + RECORD_HEADER.size + room_length:end]
+
+    def write(self, data):
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+
+class MessageLog:
+    # Append-only log of broadcast frames split into segment files, with an
+    # in-memory index by room and id. append() only buffers the record; the
+    # owner calls flush() once per loop tick to write the batch and a
+    # background thread fsyncs written segments every fsync_interval seconds.
+    def __init__(self, directory, segment_bytes=DEFAULT_SEGMENT_BYTES, fsync_interval=DEFAULT_FSYNC_INTERVAL,
+                 max_segments=None):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.segments = []
+        self.first_ids = []  # first id of each segment, for bisect
+        self.rooms = {}  # room name -> ids of its records, ascending
+        self.pending = bytearray()  # records appended since the last flush
+        self.next_id = 1
+
+        os.makedirs(directory, exist_ok=True)
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit():
+                self.load_segment(os.path.join(directory, name), int(name[:-len(SEGMENT_SUFFIX)]))
+        if not self.segments:
+            self.add_segment()
+
+        self.lock = threading.Lock()
+        self.unsynced = set()  # segments written to since their last fsync
+        self.stopped = threading.Event()
+        self.syncer = threading.Thread(target=self.sync_forever, args=(fsync_interval,), name='message-log-fsync',
+                                       daemon=True)
+        self.syncer.start()
+
+    def load_segment(self, path, first_id):
+        segment = Segment(path, first_id)
+        for log_id, room in segment.scan():
+            self.rooms.setdefault(bytes(room), array('Q')).append(log_id)
+        self.segments.append(segment)
+        self.first_ids.append(first_id)
+        self.next_id = first_id + len(segment.offsets)
+
+    def add_segment(self):
+        path = os.path.join(self.directory, f"{self.next_id:020d}{SEGMENT_SUFFIX}")
+        self.segments.append(Segment(path, self.next_id))
+        self.first_ids.append(self.next_id)
+        if self.max_segments and len(self.segments) > self.max_segments:
+            self.drop_oldest_segment()
+
+    def drop_oldest_segment(self):
+        segment = self.segments.pop(0)
+        self.first_ids.pop(0)
+        with self.lock:
+            self.unsynced.discard(segment)
+        segment.close()
+        os.unlink(segment.path)
+        for room, ids in list(self.rooms.items()):
+            del ids[:bisect.bisect_left(ids, self.first_ids[0])]
+            if not ids:
+                del self.rooms[room]
+
+    def append(self, room, frame):
+        # Buffers the record and returns its id; nothing touches the disk here
+        log_id = self.next_id
+        self.next_id += 1
+        segment = self.segments[-1]
+        segment.offsets.append(segment.size + len(self.pending))
+        self.pending += RECORD_HEADER.pack(log_id, len(room))
+        self.pending += room
+        self.pending += frame
+        self.rooms.setdefault(room, array('Q')).append(log_id)
+        return log_id
+
+    def flush(self):
+        # One write for everything appended since the last call
+        if not self.pending:
+            return
+        segment = self.segments[-1]
+        segment.write(self.pending)
+        self.pending.clear()
+        with self.lock:
+            self.unsynced.add(segment)
+        if segment.size >= self.segment_bytes:
+            self.add_segment()
+
+    def sync(self):
+        with self.lock:
+            segments, self.unsynced = self.unsynced, set()
+        for segment in segments:
+            try:
+                os.fsync(segment.file.fileno())
+            except (OSError, ValueError):  # dropped meanwhile
+                pass
+
+    def sync_forever(self, interval):
+        while not self.stopped.wait(interval):
+            self.sync()
+
+    def frame(self, log_id):
+        index = bisect.bisect_right(self.first_ids, log_id) - 1
+        segment = self.segments[index]
+        return segment.frame(log_id - segment.first_id)
+
+    def read_frames(self, ids, max_bytes):
+        # Frames of ids in the order given, stopping before they pass max_bytes
+        frames = []
+        size = 0
+        for log_id in ids:
+            frame = self.frame(log_id)
+            size += len(frame)
+            if max_bytes is not None and size > max_bytes:
+                break
+            frames.append(frame)
+        return frames
+
+    def last(self, room, count, max_bytes=None):
+        # Frames of the last count messages in the room, oldest first. With
+        # max_bytes, the newest of them that fit.
+        ids = self.rooms.get(room)
+        if not ids or count <= 0:
+            return []
+        self.flush()
+        frames = self.read_frames(reversed(ids[-count:]), max_bytes)
+        frames.reverse()
+        return frames
+
+    def since(self, room, log_id, limit, max_bytes=None):
+        # Frames of up to limit messages in the room after log_id, and no more
+        # than max_bytes of them; the rest is there to ask for again
+        ids = self.rooms.get(room)
+        if not ids or limit <= 0:
+            return []
+        self.flush()
+        start = bisect.bisect_right(ids, log_id)
+        return self.read_frames(ids[start:start + limit], max_bytes)
+
+    def __len__(self):
+        return self.next_id - self.first_ids[0]
+
+    def close(self):
+        self.stopped.set()
+        self.syncer.join()
+        self.flush()
+        self.sync()
+        for segment in self.segments:
+            segment.close()
@@ -0,0 +1,288 @@
+# model_gateway.py
+import os
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import threading
+from openai import AsyncOpenAI
+from framing import FRAME_HEADER, HEADER_SIZE, encode_frame
+from response_cache import prompt_key, is_cacheable
+
+DEFAULT_GATEWAY_PATH = os.path.join(tempfile.gettempdir(), 'chat_model_gateway.sock')
+DEFAULT_MAX_CONCURRENCY = 16
+
+
+class GatewayError(Exception):
+    pass
+
+
+async def read_frame(reader):
+    header = await reader.readexactly(HEADER_SIZE)
+    return await reader.readexactly(FRAME_HEADER.unpack(header)[0])
+
+
+def write_message(writer, message):
+    writer.write(encode_frame(json.dumps(message).encode('utf-8')))
+
+
+class OpenAIBackend:
+    # A single AsyncOpenAI client, so everything calling through it shares one connection pool
+    def __init__(self, api_key=None, base_url=None):
+        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url)
+
+    async def complete(self, model, messages, temperature):
+        response = await self.client.chat.completions.create(messages=messages, model=model, temperature=temperature)
+        if response.choices:
+            return response.choices[0].message.content.strip()
+        return None
+
+    async def stream(self, model, messages, temperature):
+        # The completion as it is generated, one text delta at a time
+        response = await self.client.chat.completions.create(messages=messages, model=model, temperature=temperature,
+                                                             stream=True)
+        async for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    def close(self):
+        pass
+
+
+class StubBackend:
+    # Offline stand-in for the model. reply is a string or a function of the messages.
+    def __init__(self, reply="stub reply", delay=0):
+        self.reply = reply
+        self.delay = delay
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+
+    async def complete(self, model, messages, temperature):
+        self.requests.append({"model": model, "messages": messages, "temperature": temperature})
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.active -= 1
+        return self.reply(messages) if callable(self.reply) else self.reply
+
+    async def stream(self, model, messages, temperature):
+        # The reply word by word, delay apart
+        reply = await self.complete(model, messages, temperature)
+        words = reply.split(' ')
+        for i, word in enumerate(words):
+            if i:
+                await asyncio.sleep(self.delay)
+            yield word if i == len(words) - 1 else word + ' '
+
+    def close(self):
+        pass
+
+
+class RateLimiter:
+    # Token bucket: rate requests per second on average, bursts of up to burst
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class ModelGateway:
+    # Local service every AIClient on the host sends its model calls to. It owns
+    # the one backend (and its connection pool), caps concurrent calls, applies
+    # a global rate limit and lets concurrent identical deterministic requests
+    # share one backend call. Requests and replies are JSON frames carrying an
+    # id, so a bot can have several calls outstanding on its connection.
+    def __init__(self, backend, path=DEFAULT_GATEWAY_PATH, max_concurrency=DEFAULT_MAX_CONCURRENCY, rate=None,
+                 burst=None):
+        self.backend = backend
+        self.path = path
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.limiter = RateLimiter(rate, burst) if rate else None
+        self.in_flight = {}  # prompt key -> backend call shared by identical requests
+        self.loop = None
+        self.stopped = None
+        self.ready = threading.Event()
+        self.requests = 0
+        self.backend_calls = 0
+        self.deduplicated = 0
+        self.errors = 0
+
+    async def complete(self, request):
+        model, messages, temperature = request["model"], request["messages"], request["temperature"]
+        if not is_cacheable(temperature):
+            return await self.call_backend(model, messages, temperature)
+
+        key = prompt_key(model, json.dumps(messages), '', temperature)
+        call = self.in_flight.get(key)
+        if call is not None:
+            self.deduplicated += 1
+        else:
+            call = asyncio.ensure_future(self.call_backend(model, messages, temperature))
+            self.in_flight[key] = call
+            call.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        # One waiting bot going away must not cancel the call for the others
+        return await asyncio.shield(call)
+
+    async def call_backend(self, model, messages, temperature):
+        async with self.slots:
+            if self.limiter:
+                await self.limiter.acquire()
+            self.backend_calls += 1
+            return await self.backend.complete(model, messages, temperature)
+
+    async def answer(self, request, writer):
+        self.requests += 1
+        try:
+            reply = {"id": request["id"], "content": await self.complete(request)}
+        except Exception as e:
+            self.errors += 1
+            reply = {"id": request["id"], "error": f"{type(e).__name__}: {e}"}
+        if not writer.is_closing():
+            write_message(writer, reply)
+
+    async def handle_connection(self, reader, writer):
+        answers = set()
+        try:
+            while True:
+                request = json.loads(await read_frame(reader))
+                answer = asyncio.ensure_future(self.answer(request, writer))
+                answers.add(answer)
+                answer.add_done_callback(answers.discard)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            for answer in answers:
+                answer.cancel()
+            writer.close()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = self.loop.create_future()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self.handle_connection, self.path)
+        self.ready.set()
+        try:
+            async with server:
+                await self.stopped
+        finally:
+            self.backend.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    def wait_ready(self, timeout=10):
+        return self.ready.wait(timeout)
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(lambda: self.stopped.done() or self.stopped.set_result(None))
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "backend_calls": self.backend_calls,
+            "deduplicated": self.deduplicated,
+            "errors": self.errors,
+            "in_flight": len(self.in_flight),
+        }
+
+
+class GatewayClient:
+    # A bot's connection to the gateway, opened on first use. Replies are
+    # matched to waiting calls by request id.
+    def __init__(self, path=DEFAULT_GATEWAY_PATH):
+        self.path = path
+        self.writer = None
+        self.connecting = None
+        self.pending = {}  # request id -> future for its reply
+        self.next_id = 0
+
+    async def connect(self):
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        asyncio.ensure_future(self.read_replies(reader, writer))
+        self.writer = writer
+
+    async def read_replies(self, reader, writer):
+        try:
+            while True:
+                reply = json.loads(await read_frame(reader))
+                future = self.pending.pop(reply["id"], None)
+                if future is None or future.done():
+                    continue
+                if "error" in reply:
+                    future.set_exception(GatewayError(reply["error"]))
+                else:
+                    future.set_result(reply["content"])
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+            if self.writer is writer:
+                self.writer = None
+            pending, self.pending = self.pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Lost the connection to the model gateway"))
+
+    async def complete(self, model, messages, temperature):
+        if self.writer is None:
+            # Calls racing to open the connection wait for the same attempt
+            if self.connecting is None:
+                self.connecting = asyncio.ensure_future(self.connect())
+            try:
+                await asyncio.shield(self.connecting)
+            finally:
+                if self.connecting is not None and self.connecting.done():
+                    self.connecting = None
+
+        self.next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[self.next_id] = future
+        write_message(self.writer, {"id": self.next_id, "model": model, "messages": messages,
+                                    "temperature": temperature})
+        return await future
+
+    async def stream(self, model, messages, temperature):
+        # The gateway answers with whole completions, so this is a single delta
+        yield await self.complete(model, messages, temperature)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Model gateway shared by the AI clients on this host")
+    parser.add_argument('--path', default=DEFAULT_GATEWAY_PATH, help="Unix socket the AI clients connect to")
+    parser.add_argument('--max-concurrency', type=int, default=DEFAULT_MAX_CONCURRENCY)
+    parser.add_argument('--rate', type=float, help="model calls per second across all bots")
+    parser.add_argument('--burst', type=int, help="calls allowed at once before the rate applies")
+    parser.add_argument('--base-url', help="OpenAI compatible endpoint, OPENAI_BASE_URL by default")
+    parser.add_argument('--stub', action='store_true', help="answer with a canned reply instead of calling a model")
+    args = parser.parse_args()
+
+    backend = StubBackend() if args.stub else OpenAIBackend(base_url=args.base_url)  # key from OPENAI_API_KEY
+    gateway = ModelGateway(backend, args.path, args.max_concurrency, args.rate, args.burst)
+    print(f"Model gateway listening on {args.path}")
+    try:
+        gateway.run()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,122 @@
+import os
+from itertools import islice
+from collections import deque
+
+DROP_OLDEST = 'drop-oldest'
+DISCONNECT = 'disconnect'
+BLOCK = 'block'
+POLICIES = (DROP_OLDEST, DISCONNECT, BLOCK)
+
+# Most buffers a single sendmsg call accepts
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+class OutboundQueue:
+    __slots__ = ('max_bytes', 'policy', 'frames', 'offset', 'queued_bytes', 'sent_bytes', 'dropped_frames',
+                 'dropped_bytes', 'sent_frames', 'send_calls', 'waiting_senders')
+
+    def __init__(self, max_bytes=1 << 20, policy=DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown slow consumer policy: {policy}, supporting only {", ".join(POLICIES)}')
+
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.frames = deque()
+        self.offset = 0  # bytes of frames[0] already written
+        self.queued_bytes = 0
+        self.sent_bytes = 0
+        self.dropped_frames = 0
+        self.dropped_bytes = 0
+        self.sent_frames = 0
+        self.send_calls = 0
+        self.waiting_senders = set()
+
+    def __len__(self):
+        return len(self.frames)
+
+    def is_full(self):
+        return self.queued_bytes > self.max_bytes
+
+    def put(self, frame):
+        # Returns False when the consumer is too slow and should be disconnected.
+        # An empty queue always takes the frame so large messages still go out.
+        if self.frames and self.queued_bytes + len(frame) > self.max_bytes:
+            if self.policy == DISCONNECT:
+                return False
+            if self.policy == DROP_OLDEST:
+                self.drop_oldest(len(frame))
+
+        self.frames.append(frame)
+        self.queued_bytes += len(frame)
+        return True
+
+    def drop_oldest(self, incoming_length):
+        # A partially written frame has to be finished or the stream loses framing
+        head = self.frames.popleft() if self.offset else None
+        while self.frames and self.queued_bytes + incoming_length > self.max_bytes:
+            frame = self.frames.popleft()
+            self.queued_bytes -= len(frame)
+            self.dropped_frames += 1
+            self.dropped_bytes += len(frame)
+        if head is not None:
+            self.frames.appendleft(head)
+
+    def flush(self, client_socket):
+        # Write as much as the socket accepts without blocking; True once empty.
+        # All queued frames go out in one scatter-gather sendmsg where available.
+        if not hasattr(client_socket, 'sendmsg'):
+            return self.flush_each(client_socket)
+
+        while self.frames:
+            buffers = [memoryview(self.frames[0])[self.offset:]]
+            buffers.extend(islice(self.frames, 1, IOV_MAX))
+            try:
+                sent = client_socket.sendmsg(buffers)
+            except (BlockingIOError, InterruptedError):
+                return False
+
+            self.send_calls += 1
+            self.consume(sent)
+            if self.offset:
+                return False
+        return True
+
+    def flush_each(self, client_socket):
+        while self.frames:
+            try:
+                sent = client_socket.send(memoryview(self.frames[0])[self.offset:])
+            except (BlockingIOError, InterruptedError):
+                return False
+
+            self.send_calls += 1
+            self.consume(sent)
+            if self.offset:
+                return False
+        return True
+
+    def consume(self, sent):
+        self.queued_bytes -= sent
+        self.sent_bytes += sent
+        while sent:
+            remaining = len(self.frames[0]) - self.offset
+            if sent < remaining:
+                self.offset += sent
+                return
+            sent -= remaining
+            self.frames.popleft()
+            self.offset = 0
+            self.sent_frames += 1
+
+    def stats(self):
+        return {
+            "queued_frames": len(self.frames),
+            "queued_bytes": self.queued_bytes,
+            "sent_bytes": self.sent_bytes,
+            "dropped_frames": self.dropped_frames,
+            "dropped_bytes": self.dropped_bytes,
+            "sent_frames": self.sent_frames,
+            "send_calls": self.send_calls,
+        }
@@ -0,0 +1,254 @@
+# pipeline.py
+import re
+import time
+import logging
+import importlib
+import multiprocessing
+from queue import SimpleQueue, Empty
+from functools import partial
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from protocol import TEXT, STREAM, STREAM_END, DIRECT
+
+THREAD = 'thread'
+PROCESS = 'process'
+EXECUTORS = (THREAD, PROCESS)
+STAGE_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+# Messages whose text goes through the stages; the others only keep their place in line
+STAGED_TYPES = frozenset((TEXT, STREAM, STREAM_END, DIRECT))
+
+logger = logging.getLogger('chat.pipeline')
+
+
+class Stage:
+    # One step every text message goes through before it is sent on: chat
+    # messages, each part of a streamed message and the text of direct
+    # messages. process() returns the text to send on, or None to drop it.
+    # Stages with blocking set run in the pipeline's worker pool, and so does
+    # every stage after them; the others run on the server loop and must be
+    # quick. Stages of a process pool must be picklable. The name shows in the
+    # metrics; without one the class name is used.
+    name = None
+    blocking = False
+
+    def process(self, text, sender):
+        return text
+
+
+class WordFilter(Stage):
+    # Masks whole words, ignoring case
+    name = 'word_filter'
+
+    def __init__(self, words, mask='***'):
+        self.pattern = re.compile(r'\b(?:%s)\b' % '|'.join(map(re.escape, words)), re.IGNORECASE)
+        self.mask = mask
+
+    def process(self, text, sender):
+        return self.pattern.sub(self.mask, text)
+
+
+def load_stage(spec):
+    # A stage plugin from "package.module:ClassName", made without arguments
+    module_name, _, class_name = spec.partition(':')
+    if not class_name:
+        raise ValueError(f'Stage plugins are given as module:ClassName, got {spec}')
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+def staged_text(message):
+    # (bytes kept as they are, text for the stages): the recipients of a
+    # direct message are not text to filter
+    data = bytes(message['data'])
+    if message['type'] == DIRECT:
+        names, space, text = data.partition(b' ')
+        return names + space, str(text, 'utf-8', 'replace')
+    return b'', str(data, 'utf-8', 'replace')
+
+
+def staged_data(kind, kept, text):
+    # The data to send after the stages, None when the message is dropped
+    if text is not None:
+        return kept + text.encode('utf-8')
+    # The end of a stream is still sent, empty, so receivers close the message
+    return b'' if kind == STREAM_END else None
+
+
+def stage_names(stages):
+    # One metric name per stage, in snake case with only the characters
+    # Prometheus allows, numbered when several stages would share one
+    names = []
+    for stage in stages:
+        name = stage.name or re.sub(r'(?<=[a-z0-9])(?=[A-Z])', '_', type(stage).__name__)
+        name = re.sub(r'[^a-z0-9_]', '_', name.lower())
+        unique, count = name, 1
+        while unique in names:
+            count += 1
+            unique = f'{name}_{count}'
+        names.append(unique)
+    return names
+
+
+def run_stages(stages, text, sender):
+    # The text after every stage, or None once one drops it, and the seconds
+    # each stage that ran took, in order
+    timings = []
+    for stage in stages:
+        started = time.perf_counter()
+        text = stage.process(text, sender)
+        timings.append(time.perf_counter() - started)
+        if text is None:
+            break
+    return text, timings
+
+
+# The stages of a process pool worker, sent once when it starts
+worker_stages = ()
+
+
+def install_stages(stages):
+    global worker_stages
+    worker_stages = stages
+
+
+def run_worker_stages(text, sender):
+    return run_stages(worker_stages, text, sender)
+
+
+class Job:
+    # A message waiting for its turn: messages of one sender leave the
+    # pipeline in the order they came in, even when a later one is done first
+    __slots__ = ('message', 'done')
+
+    def __init__(self, message, done):
+        self.message = message
+        self.done = done
+
+
+class MessagePipeline:
+    # Runs message text through the stages between reading and sending on.
+    # The server loop hands every message that sends to others, changes
+    # rooms or asks for history to submit(). Text needing the worker pool is
+    # queued per sender, collect() passes finished messages to deliver in
+    # order, and whatever else that sender sends meanwhile waits behind them.
+    # A sender that disconnects still has its queue delivered.
+    def __init__(self, stages, executor=THREAD, workers=None):
+        if executor not in EXECUTORS:
+            raise ValueError(f'Unknown pipeline executor: {executor}, supporting only {", ".join(EXECUTORS)}')
+        self.stages = list(stages)
+        split = next((index for index, stage in enumerate(self.stages) if stage.blocking), len(self.stages))
+        self.inline, self.offloaded = self.stages[:split], self.stages[split:]
+        self.executor = executor
+        self.workers = workers
+        self.pool = None
+        self.pending = {}  # connection -> deque of Jobs, oldest first
+        self.completed = SimpleQueue()  # (connection, job, future) from the workers
+        self.deliver = None
+        self.wake = None
+        self.names = stage_names(self.stages)
+        self.stage_seconds = []  # a histogram per stage
+        self.dropped = None
+        self.errors = None
+
+    def attach(self, deliver, wake, metrics):
+        # deliver(connection, message) sends a message on; wake() interrupts
+        # the loop from a worker so finished messages are collected promptly
+        self.deliver = deliver
+        self.wake = wake
+        self.stage_seconds = [metrics.histogram(f'chat_pipeline_{name}_seconds',
+                                                f"Time the {name} stage takes per message", STAGE_BUCKETS)
+                              for name in self.names]
+        self.dropped = metrics.counter('chat_pipeline_dropped_total', "Messages a pipeline stage dropped")
+        self.errors = metrics.counter('chat_pipeline_errors_total', "Messages dropped because a stage failed")
+        metrics.gauge('chat_pipeline_pending', "Messages waiting in the pipeline",
+                      lambda: sum(len(queue) for queue in list(self.pending.values())))
+        if self.offloaded:
+            if self.executor == PROCESS:
+                # Spawned, not forked, so workers do not hold copies of the server's sockets
+                self.pool = ProcessPoolExecutor(self.workers, multiprocessing.get_context('spawn'),
+                                                initializer=install_stages, initargs=(self.offloaded,))
+            else:
+                self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix='chat-pipeline')
+
+    def submit(self, connection, message):
+        queue = self.pending.get(connection)
+        if message['type'] in STAGED_TYPES and self.stages:
+            kept, text = staged_text(message)
+            try:
+                text, timings = run_stages(self.inline, text, connection.name)
+            except Exception:
+                logger.exception("pipeline stage failed user=%s", connection.name)
+                self.errors.inc()
+                text = None
+            else:
+                self.observe(timings)
+                if text is None:
+                    self.dropped.inc()
+                elif self.offloaded:
+                    job = Job(message, False)
+                    message['data'] = kept  # until the workers are done
+                    if self.executor == PROCESS:
+                        future = self.pool.submit(run_worker_stages, text, connection.name)
+                    else:
+                        future = self.pool.submit(run_stages, self.offloaded, text, connection.name)
+                    self.pending.setdefault(connection, deque()).append(job)
+                    future.add_done_callback(partial(self.finished, connection, job))
+                    return
+            message['data'] = staged_data(message['type'], kept, text)
+            if message['data'] is None:
+                return
+        elif queue is not None:
+            message['data'] = bytes(message['data'])  # the view dies with the next read
+        if queue is None:
+            self.deliver(connection, message)
+        else:
+            queue.append(Job(message, True))
+
+    def finished(self, connection, job, future):
+        # On a worker thread
+        self.completed.put((connection, job, future))
+        self.wake()
+
+    def collect(self):
+        # On the loop, once per iteration
+        while True:
+            try:
+                connection, job, future = self.completed.get_nowait()
+            except Empty:
+                return
+            try:
+                text, timings = future.result()
+                self.observe(timings, len(self.inline))
+            except Exception as e:
+                logger.warning("pipeline stage failed user=%s error=%s", connection.name, e)
+                self.errors.inc()
+                text = None
+            else:
+                if text is None:
+                    self.dropped.inc()
+            job.message['data'] = staged_data(job.message['type'], job.message['data'], text)
+            job.done = True
+            self.release(connection)
+
+    def release(self, connection):
+        queue = self.pending.get(connection)
+        if queue is None:
+            return  # nothing waiting
+        while queue and queue[0].done:
+            message = queue.popleft().message
+            if message['data'] is not None:
+                self.deliver(connection, message)
+        if not queue:
+            self.pending.pop(connection, None)
+
+    def observe(self, timings, first=0):
+        # timings of the stages from index first on
+        for histogram, seconds in zip(self.stage_seconds[first:], timings):
+            histogram.observe(seconds)
+
+    def stats(self):
+        return {name: {"count": histogram.count, "seconds": histogram.sum}
+                for name, histogram in zip(self.names, self.stage_seconds)}
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,253 @@
+import time
+import zlib
+import struct
+from framing import FRAME_HEADER, HEADER_SIZE
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional, zlib is always there
+    zstandard = None
+
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+
+# A v2 client's first frame is this, optionally ";" and the compression codecs
+# it can read, then NUL and its username. A v1 client's first frame is the bare
+# username, which never starts with a NUL byte.
+HELLO_V2 = b'\x00chat/2'
+
+# A v2 frame keeps the 4-byte length of v1 and starts its body with a fixed
+# header: type, flags, message id, sender id, monotonic send time in ns
+V2_HEADER = struct.Struct('!BBIIQ')
+V2_HEADER_SIZE = V2_HEADER.size
+
+# Message types
+TEXT = 1
+JOIN = 2
+LEAVE = 3
+DISCONNECT = 4
+STREAM = 5
+STREAM_END = 6
+HELLO = 7
+HISTORY = 8  # from a client: "last <count> [room]" or "since <id> [room]"; back: the logged frames in one frame
+PING = 9  # answered with PONG by either side
+PONG = 10
+RECONNECT = 11  # from a server going away: the seconds over which clients should spread their reconnects
+DIRECT = 12  # from a client: "<name>[,<name>...] text"; to the recipients: "sender: text"
+
+# v1 spells the control messages as text
+V1_DISCONNECT = b'__DISCONNECT__'
+V1_PREFIXES = {
+    JOIN: b'__JOIN__ ',
+    LEAVE: b'__LEAVE__ ',
+    STREAM: b'__STREAM__ ',
+    STREAM_END: b'__STREAM_END__ ',
+    HISTORY: b'__HISTORY__ ',
+    RECONNECT: b'__RECONNECT__ ',
+    DIRECT: b'__DM__ ',
+}
+# Flags: the payload is compressed with this codec
+FLAG_ZLIB = 0x01
+FLAG_ZSTD = 0x02
+COMPRESSION_FLAGS = FLAG_ZLIB | FLAG_ZSTD
+DEFAULT_COMPRESS_THRESHOLD = 1024  # payload bytes; smaller messages are not worth compressing
+
+MAX_ID = 0xFFFFFFFF
+MAX_ID_DIGITS = len(str(MAX_ID))
+
+
+class CompressionError(ValueError):
+    pass
+
+
+def now():
+    return time.monotonic_ns()
+
+
+def zlib_decompress(data, limit):
+    decompressor = zlib.decompressobj()
+    try:
+        data = decompressor.decompress(data, limit)
+    except zlib.error as e:
+        raise CompressionError(str(e))
+    if decompressor.unconsumed_tail:
+        raise CompressionError(f"Compressed payload expands beyond {limit} bytes")
+    if not decompressor.eof:
+        raise CompressionError("Truncated compressed payload")
+    return data
+
+
+def zstd_decompress(data, limit):
+    size = zstandard.frame_content_size(data)
+    if size < 0 or size > limit:
+        raise CompressionError(f"Compressed payload expands beyond {limit} bytes")
+    try:
+        return zstandard.ZstdDecompressor().decompress(data)
+    except zstandard.ZstdError as e:
+        raise CompressionError(str(e))
+
+
+# name -> (flag, compress, decompress), in order of preference
+CODECS = {}
+if zstandard is not None:
+    CODECS['zstd'] = (FLAG_ZSTD, zstandard.ZstdCompressor(level=3).compress, zstd_decompress)
+CODECS['zlib'] = (FLAG_ZLIB, lambda data: zlib.compress(data, 6), zlib_decompress)
+
+
+def hello_offer(username, codecs=()):
+    # First frame of a v2 client
+    options = b';' + ','.join(codecs).encode('ascii') if codecs else b''
+    return HELLO_V2 + options + b'\x00' + username
+
+
+def parse_hello(data):
+    # (protocol, codecs offered that we know, username) from a login frame
+    data = bytes(data)
+    if not data.startswith(HELLO_V2):
+        return PROTOCOL_V1, [], data
+    options, _, username = data[len(HELLO_V2):].partition(b'\x00')
+    offered = str(options[1:], 'ascii', 'replace').split(',') if options[:1] == b';' else []
+    return PROTOCOL_V2, [codec for codec in offered if codec in CODECS], username
+
+
+def encode_v2(kind, payload=b'', message_id=0, sender_id=0, timestamp=None, flags=0):
+    return encode_v2_parts(kind, (payload,), message_id, sender_id, timestamp, flags)
+
+
+def encode_v2_parts(kind, parts, message_id=0, sender_id=0, timestamp=None, flags=0):
+    # One frame from several payload pieces, e.g. the sender prefix and the text
+    header = V2_HEADER.pack(kind, flags, message_id & MAX_ID, sender_id & MAX_ID,
+                            now() if timestamp is None else timestamp)
+    length = V2_HEADER_SIZE + sum(len(part) for part in parts)
+    return b''.join((FRAME_HEADER.pack(length), header) + tuple(parts))
+
+
+def decode_v2(frame):
+    # frame is a v2 frame body (without the length). Returns
+    # (type, flags, message id, sender id, timestamp, payload view).
+    frame = memoryview(frame)
+    return V2_HEADER.unpack_from(frame) + (frame[V2_HEADER_SIZE:],)
+
+
+def encode_v1(kind, payload=b'', message_id=0):
+    # The v1 spelling of a client message, length included
+    if kind == DISCONNECT:
+        payload = V1_DISCONNECT
+    elif kind in (STREAM, STREAM_END):
+        payload = V1_PREFIXES[kind] + b'%d ' % message_id + payload
+    elif kind in V1_PREFIXES:
+        payload = V1_PREFIXES[kind] + payload
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+def decode_v1(data):
+    # Classifies a v1 frame: (type, message id, payload view)
+    data = memoryview(data)
+    if data == V1_DISCONNECT:
+        return DISCONNECT, 0, data[len(data):]
+    for kind, prefix in V1_PREFIXES.items():
+        if data[:len(prefix)] != prefix:
+            continue
+        body = data[len(prefix):]
+        if kind not in (STREAM, STREAM_END):
+            return kind, 0, body
+        # "<id> text"; a part without a valid id goes out as plain text
+        stream_id, space, _ = bytes(body[:MAX_ID_DIGITS + 1]).partition(b' ')
+        if stream_id.isdigit() and (space or len(stream_id) == len(body)) and int(stream_id) <= MAX_ID:
+            return kind, int(stream_id), body[len(stream_id) + 1:]
+        break
+    return TEXT, 0, data
+
+
+def reserved_username(username):
+    # A name v1 clients would read as a control prefix at the start of every
+    # message it sends, e.g. "__RECONNECT__ 0"
+    username = bytes(username)
+    return username.startswith(b'__') or any(username.startswith(prefix) for prefix in V1_PREFIXES.values())
+
+
+def history_request(last=None, since=None, room=None):
+    request = f"last {last}" if since is None else f"since {since}"
+    return request if room is None else f"{request} {room}"
+
+
+def parse_history_request(payload):
+    # (mode, number, room or None), or None when the request makes no sense
+    parts = str(payload, 'utf-8', 'replace').split(' ', 2)
+    if len(parts) < 2 or parts[0] not in ('last', 'since') or not parts[1].isdigit():
+        return None
+    return parts[0], int(parts[1]), parts[2].encode('utf-8') if len(parts) > 2 else None
+
+
+def reconnect_hint(window):
+    return b'%g' % window
+
+
+def parse_reconnect_hint(payload):
+    # The reconnect window in seconds, or None when the hint makes no sense
+    try:
+        window = float(bytes(payload))
+    except ValueError:
+        return None
+    return window if 0 <= window < float('inf') else None
+
+
+def direct_message(recipients, text):
+    return f"{','.join(recipients)} {text}"
+
+
+def parse_direct(payload):
+    # (recipient usernames, text), or None when nobody is addressed
+    names, space, text = bytes(payload).partition(b' ')
+    recipients = [name for name in names.split(b',') if name]
+    if not space or not recipients:
+        return None
+    return recipients, text
+
+
+def split_frames(payload):
+    # The frames packed into a HISTORY payload, each without its length
+    payload = memoryview(payload)
+    offset = 0
+    while offset + HEADER_SIZE <= len(payload):
+        end = offset + HEADER_SIZE + FRAME_HEADER.unpack_from(payload, offset)[0]
+        yield payload[offset + HEADER_SIZE:end]
+        offset = end
+
+
+def compress_v2(frame, codec):
+    # The same v2 frame (length included) with its payload compressed, or None
+    # when that does not make it smaller
+    flag, compress, _ = CODECS[codec]
+    kind, flags, message_id, sender_id, timestamp = V2_HEADER.unpack_from(frame, HEADER_SIZE)
+    payload = memoryview(frame)[HEADER_SIZE + V2_HEADER_SIZE:]
+    compressed = compress(payload)
+    if len(compressed) >= len(payload):
+        return None
+    return encode_v2(kind, compressed, message_id, sender_id, timestamp, flags | flag)
+
+
+def decompress_payload(flags, payload, limit):
+    # The plain payload of a decoded v2 frame, at most limit bytes
+    if not flags & COMPRESSION_FLAGS:
+        return payload
+    for flag, _, decompress in CODECS.values():
+        if flags & flag:
+            return decompress(payload, limit)
+    raise CompressionError("Payload compressed with an unsupported codec")
+
+
+def v2_to_v1(frame):
+    # The v1 frame for a whole v2 broadcast frame (length included), or None
+    # for types v1 clients never receive
+    kind, _, message_id, _, _ = V2_HEADER.unpack_from(frame, HEADER_SIZE)
+    payload = memoryview(frame)[HEADER_SIZE + V2_HEADER_SIZE:]
+    if kind == TEXT:
+        return b''.join((FRAME_HEADER.pack(len(payload)), payload))
+    if kind in (STREAM, STREAM_END):
+        head = V1_PREFIXES[kind] + b'%d ' % message_id
+        return b''.join((FRAME_HEADER.pack(len(head) + len(payload)), head, payload))
+    if kind == DIRECT:
+        head = V1_PREFIXES[kind]
+        return b''.join((FRAME_HEADER.pack(len(head) + len(payload)), head, payload))
+    return None
@@ -0,0 +1,62 @@
+# rate_limit.py
+
+# What the server does with a client over its limit
+DELAY = 'delay'  # stop reading its socket until its bucket refills; TCP slows the sender down
+DROP = 'drop'  # read and discard its messages
+DISCONNECT = 'disconnect'
+FLOOD_ACTIONS = (DELAY, DROP, DISCONNECT)
+
+
+class TokenBucket:
+    # Message and byte tokens, refilled together from one timestamp. A message
+    # is let in while there is a message token and any byte token left, and
+    # its whole size is taken: bytes may go below zero, so a frame bigger than
+    # the burst still passes and the average rate holds.
+    __slots__ = ('messages', 'bytes', 'updated')
+
+    def __init__(self, messages, size, now):
+        self.messages = messages
+        self.bytes = size
+        self.updated = now
+
+
+class RateLimit:
+    # Messages and bytes per second with their bursts; a rate of 0 is not limited
+    def __init__(self, messages_per_second=0, bytes_per_second=0, message_burst=None, byte_burst=None):
+        if messages_per_second < 0 or bytes_per_second < 0:
+            raise ValueError("Rates cannot be negative")
+        self.message_rate = messages_per_second
+        self.byte_rate = bytes_per_second
+        # One second of traffic by default
+        self.message_burst = max(message_burst or messages_per_second, 1)
+        self.byte_burst = byte_burst or max(bytes_per_second, 1)
+
+    def __bool__(self):
+        return bool(self.message_rate or self.byte_rate)
+
+    def bucket(self, now):
+        return TokenBucket(self.message_burst, self.byte_burst, now)
+
+    def admit(self, bucket, now):
+        # Refills the bucket; True when it has tokens for another message
+        elapsed = now - bucket.updated
+        bucket.updated = now
+        if self.message_rate:
+            bucket.messages = min(self.message_burst, bucket.messages + elapsed * self.message_rate)
+        if self.byte_rate:
+            bucket.bytes = min(self.byte_burst, bucket.bytes + elapsed * self.byte_rate)
+        return (not self.message_rate or bucket.messages >= 1) and (not self.byte_rate or bucket.bytes > 0)
+
+    def spend(self, bucket, size):
+        # Takes one message of size bytes from a bucket admit() just refilled.
+        # Returns the seconds until it has tokens again, 0 if it still has.
+        wait = 0
+        if self.message_rate:
+            bucket.messages -= 1
+            if bucket.messages < 1:
+                wait = (1 - bucket.messages) / self.message_rate
+        if self.byte_rate:
+            bucket.bytes -= size
+            if bucket.bytes <= 0:
+                wait = max(wait, -bucket.bytes / self.byte_rate)
+        return wait
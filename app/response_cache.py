@@ -0,0 +1,159 @@
+import json
+import time
+import sqlite3
+import asyncio
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_TTL = 600  # seconds
+
+
+def prompt_key(model, system_prompt, user_prompt, temperature):
+    # Prompts that only differ in whitespace share an entry
+    normalized = [model, ' '.join(system_prompt.split()), ' '.join(user_prompt.split()), temperature]
+    return hashlib.sha256(json.dumps(normalized).encode('utf-8')).hexdigest()
+
+
+def is_cacheable(temperature):
+    # Only a deterministic request can be answered with an earlier response
+    return temperature == 0
+
+
+class ResponseCache:
+    # get() returns None on a miss; subclasses store the entries
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        value = self.lookup(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    # What the bots call from the client loop; a cache that blocks runs them elsewhere
+    async def fetch(self, key):
+        return self.get(key)
+
+    async def store(self, key, value):
+        self.put(key, value)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class MemoryCache(ResponseCache):
+    # LRU over an OrderedDict: hits move to the end, evictions pop the front
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL, clock=time.monotonic):
+        super().__init__(max_entries, ttl)
+        self.clock = clock
+        self.entries = OrderedDict()  # key -> (expires, value)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires <= self.clock():
+            del self.entries[key]
+            self.expirations += 1
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = (self.clock() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+
+class SqliteCache(ResponseCache):
+    # Same LRU/TTL rules kept in a sqlite file, so responses survive restarts
+    # and can be shared by bots on one host. Times are wall clock for that reason.
+    # The bots' calls run on a thread of the cache's own, as every query may
+    # wait on the disk. Entries are counted as they come and go, and counted
+    # again every max_entries inserts to take in what other processes did.
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL, clock=time.time):
+        super().__init__(max_entries, ttl)
+        self.clock = clock
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # A crash may lose the last writes but not corrupt the file; a cache can afford that
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS responses "
+                        "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL, used REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used)")
+        self.count = len(self)
+        self.inserts = 0  # since the last count
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='response-cache')
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def lookup(self, key):
+        row = self.db.execute("SELECT value, expires FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        now = self.clock()
+        if row[1] <= now:
+            self.count -= self.db.execute("DELETE FROM responses WHERE key = ?", (key,)).rowcount
+            self.expirations += 1
+            return None
+        self.db.execute("UPDATE responses SET used = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def put(self, key, value):
+        now = self.clock()
+        if not self.db.execute("UPDATE responses SET value = ?, expires = ?, used = ? WHERE key = ?",
+                               (value, now + self.ttl, now, key)).rowcount:
+            self.db.execute("INSERT OR REPLACE INTO responses (key, value, expires, used) VALUES (?, ?, ?, ?)",
+                            (key, value, now + self.ttl, now))
+            self.count += 1
+            self.inserts += 1
+            if self.inserts >= self.max_entries:
+                self.count = len(self)
+                self.inserts = 0
+        excess = self.count - self.max_entries
+        if excess > 0:
+            evicted = self.db.execute("DELETE FROM responses WHERE key IN "
+                                      "(SELECT key FROM responses ORDER BY used LIMIT ?)", (excess,)).rowcount
+            self.count -= evicted
+            self.evictions += evicted
+
+    async def fetch(self, key):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.get, key)
+
+    async def store(self, key, value):
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.put, key, value)
+
+    def clear(self):
+        self.db.execute("DELETE FROM responses")
+        self.count = 0
+
+    def close(self):
+        self.executor.shutdown()
+        self.db.close()
@@ -1,99 +1,1165 @@
 # server.py
 import socket
 import select
+import selectors
+import time
 import struct
+import logging
+import argparse
+import signal
+import itertools
+import logging.handlers
+from queue import SimpleQueue
+from outbound import OutboundQueue, DROP_OLDEST, BLOCK, POLICIES
+from connection import Connection, ConnectionRegistry
+from framing import FrameDecoder, FrameTooLargeError, HEADER_SIZE, DEFAULT_MAX_FRAME_SIZE
+from protocol import (PROTOCOL_V1, PROTOCOL_V2, TEXT, JOIN, LEAVE, DISCONNECT, STREAM, STREAM_END, HELLO, HISTORY,
+                      PING, PONG, RECONNECT, DIRECT, CODECS, DEFAULT_COMPRESS_THRESHOLD, V2_HEADER_SIZE, CompressionError, now,
+                      parse_hello, reserved_username, parse_history_request, parse_direct, reconnect_hint, encode_v1, encode_v2, encode_v2_parts, decode_v1,
+                      decode_v2, v2_to_v1, compress_v2, decompress_payload)
+from message_log import MessageLog, DEFAULT_SEGMENT_BYTES, DEFAULT_FSYNC_INTERVAL
+from metrics import MetricsRegistry, MetricsServer, SIZE_BUCKETS
+from timer_wheel import TimerWheel
+from handoff import send_handoff, receive_handoff
+from rate_limit import RateLimit, DELAY, DROP, FLOOD_ACTIONS
+from pipeline import MessagePipeline, WordFilter, load_stage, EXECUTORS, THREAD
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# Everyone starts in the default room; its messages keep the plain "username: " prefix
+DEFAULT_ROOM = b'lobby'
+MAX_ROOM_NAME = 64
+MAX_HISTORY = 1000  # messages sent back for one history request
+MAX_HISTORY_BYTES = 1 << 20  # of logged frames in one reply, and never more than max_frame_size allows
+MAX_DIRECT_RECIPIENTS = 100  # usernames one direct message can address
+MAX_LOGGED_STREAMS = 16  # unfinished streams per client collected for the log; more are only relayed
+# Messages that go through the pipeline, if there is one, so they keep their order
+PIPELINE_TYPES = frozenset((TEXT, STREAM, STREAM_END, DIRECT, JOIN, LEAVE, HISTORY))
+# A v2 client silent for half of idle_timeout is pinged and one silent for all
+# of it is disconnected. v1 clients cannot answer pings and rely on TCP keepalive.
+DEFAULT_IDLE_TIMEOUT = 60  # seconds
+KEEPALIVE_IDLE = 60  # seconds of silence before the kernel starts probing
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 5
+# A draining server tells clients to come back within the reconnect window,
+# each at a random point of it, and gives their queues drain_timeout to empty
+DEFAULT_DRAIN_TIMEOUT = 10  # seconds
+DEFAULT_RECONNECT_WINDOW = 5  # seconds
+
+logger = logging.getLogger('chat.server')
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # QueueHandler formats each record on the calling thread before queueing
+    # it. The queue stays in this process, so the record can go as it is,
+    # arguments and exception included, for the listener to format.
+    def prepare(self, record):
+        return record
+
+
+def configure_logging(level=logging.INFO):
+    # Records are formatted and written by a listener thread, so a slow
+    # terminal or disk never stalls the server loop. Log arguments must not
+    # change after the call. Returns the listener.
+    records = SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    chat_logger = logging.getLogger('chat')
+    chat_logger.addHandler(DeferredQueueHandler(records))
+    chat_logger.setLevel(level)
+    chat_logger.propagate = False
+    return listener
+
+def raise_fd_limit():
+    # Allow as many open sockets as the hard limit permits
+    if resource is None:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    return soft
+
 
 class ChatServer:
-    def __init__(self, host='localhost', port=8080):
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server_socket.bind((host, port))
-        self.server_socket.listen(5)
-        
+    def __init__(self, host='localhost', port=8080, backlog=5, max_queue_bytes=1 << 20, slow_consumer_policy=DROP_OLDEST,
+                 max_frame_size=DEFAULT_MAX_FRAME_SIZE, reuse_port=False, compression=tuple(CODECS),
+                 compress_threshold=DEFAULT_COMPRESS_THRESHOLD, message_log=None, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 keepalive=True, listen_socket=None, client_limit=None, global_limit=None, flood_action=DELAY,
+                 pipeline=None):
+        if flood_action not in FLOOD_ACTIONS:
+            raise ValueError(f'Unknown flood action: {flood_action}, supporting only {", ".join(FLOOD_ACTIONS)}')
+
+        if listen_socket is not None:
+            # Handed over by the server this one replaces, already listening
+            self.server_socket = listen_socket
+        else:
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                # Several processes share the port and the kernel spreads connections
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.server_socket.bind((host, port))
+            self.server_socket.listen(backlog)
+        self.listening = True
+
+        # stop() and drain() may come from another thread or a signal handler;
+        # a byte on this pair wakes the loop out of select
+        self.waker, self.wake_socket = socket.socketpair()
+        self.waker.setblocking(False)
+        self.wake_socket.setblocking(False)
+
         self.running = True
-        self.sockets_list = [self.server_socket]
-        self.clients = {}
-        print(f"Chat server started on {host}:{port}")
+        self.connections = ConnectionRegistry()  # every accepted socket, including ones still logging in
+        self.client_count = 0  # logged in
+        self.rooms = {}  # room name -> connections of its members
+        self.users = {}  # username -> connections logged in under it; names need not be unique
+        self.max_frame_size = max_frame_size
+        self.user_ids = itertools.count(1)  # sender ids carried in v2 frames
+
+        # Per-client bounded write queues, drained when the socket is writable
+        self.max_queue_bytes = max_queue_bytes
+        self.slow_consumer_policy = slow_consumer_policy
+        self.writing = set()  # waiting for the socket to become writable
+        self.dirty = set()  # got frames this tick, flushed once at its end
+        self.paused = {}  # sender -> recipients whose full queues block it
+        self.slow_consumer_disconnects = 0
+        self.frames_written = 0
+        self.send_calls = 0
+
+        # Large broadcasts are compressed once per codec for the clients that negotiated it
+        self.compression = [codec for codec in compression if codec in CODECS]
+        self.compress_threshold = compress_threshold
+        self.compressed_frames = 0
+        self.compression_bytes_in = 0
+        self.compression_bytes_out = 0
+        self.compression_cpu_ns = 0
+        self.compressed_deliveries = 0
+        self.compression_bytes_saved = 0
+
+        # Every broadcast is appended to the log, if there is one, so clients can ask for history
+        self.message_log = message_log
+
+        # Idle clients are found with a timer wheel instead of scanning everyone
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.now = time.monotonic()  # taken once per loop iteration
+        self.wheel = None
+        self.wheel_tick = None
+        if idle_timeout:
+            self.wheel_tick = min(1.0, idle_timeout / 4)
+            self.wheel = TimerWheel(self.wheel_tick, int(idle_timeout / self.wheel_tick) + 2, self.now)
+        self.pings_sent = 0
+        self.idle_evictions = 0
+
+        # Flood control: token buckets per client and for the whole server,
+        # checked for every message read. Over its limit a client is read no
+        # more until its bucket refills, dropped or disconnected.
+        self.client_limit = client_limit or None
+        self.global_limit = global_limit or None
+        self.global_bucket = global_limit.bucket(self.now) if global_limit else None
+        self.flood_action = flood_action
+        self.throttled = {}  # connection -> loop time its socket is read again
 
-    def receive_message(self, client_socket):
+        # Graceful shutdown: drain() leaves a request that the loop carries out
+        self.drain_request = None
+        self.drain_deadline = None  # set while draining
+        self.closing = set()  # notified and flushed, only waiting for the client to leave
+
+        # Per message work (filters, formatting) between reading and broadcasting
+        self.pipeline = pipeline
+
+        self.bytes_sent = 0
+        self.metrics = MetricsRegistry()
+        self.register_metrics()
+        if pipeline is not None:
+            pipeline.attach(self.dispatch, self.wake, self.metrics)
+        logger.info("server started address=%s:%s", host, port)
+
+    @property
+    def clients(self):
+        # The logged in connections; the loop itself never needs this list
+        return [connection for connection in self.connections if connection.logged_in]
+
+    def register_metrics(self):
+        # Counters the loop updates are plain attribute adds; the rest are
+        # read from existing state only when the metrics are scraped
+        metrics = self.metrics
+        self.logins = metrics.counter('chat_logins_total', "Clients that logged in")
+        self.messages_received = metrics.counter('chat_messages_received_total', "Messages received from clients")
+        self.messages_sent = metrics.counter('chat_messages_sent_total', "Frames queued for clients")
+        self.direct_messages = metrics.counter('chat_direct_messages_total', "Direct messages delivered")
+        self.bytes_received = metrics.counter('chat_bytes_received_total', "Bytes read from clients")
+        self.fan_out_size = metrics.histogram('chat_fan_out_recipients', "Recipients of each broadcast", SIZE_BUCKETS)
+        self.loop_latency = metrics.histogram('chat_loop_iteration_seconds', "Time spent handling one loop wakeup")
+        metrics.counter('chat_bytes_sent_total', "Bytes written to clients", lambda: self.bytes_sent)
+        metrics.counter('chat_frames_written_total', "Frames written to clients", lambda: self.frames_written)
+        metrics.counter('chat_send_calls_total', "Socket send calls", lambda: self.send_calls)
+        metrics.counter('chat_slow_consumer_disconnects_total', "Clients disconnected for a full outbound queue",
+                        lambda: self.slow_consumer_disconnects)
+        metrics.counter('chat_compressed_frames_total', "Broadcast frames compressed", lambda: self.compressed_frames)
+        metrics.counter('chat_compression_cpu_seconds_total', "CPU time spent compressing",
+                        lambda: self.compression_cpu_ns / 1e9)
+        metrics.counter('chat_compression_saved_bytes_total', "Bytes saved by compression",
+                        lambda: self.compression_bytes_saved)
+        metrics.gauge('chat_connections', "Sockets connected, including ones still logging in",
+                      lambda: len(self.connections))
+        metrics.gauge('chat_clients', "Logged in clients", lambda: self.client_count)
+        metrics.gauge('chat_rooms', "Rooms with members", lambda: len(self.rooms))
+        metrics.gauge('chat_outbound_queued_bytes', "Bytes waiting in client outbound queues",
+                      lambda: sum(queue.queued_bytes for _, queue in self.outbound_queues()))
+        metrics.gauge('chat_outbound_queued_bytes_max', "Bytes waiting in the fullest outbound queue",
+                      lambda: max((queue.queued_bytes for _, queue in self.outbound_queues()), default=0))
+        metrics.gauge('chat_paused_senders', "Senders blocked by a full queue", lambda: len(self.paused))
+        metrics.counter('chat_pings_sent_total', "Pings sent to silent clients", lambda: self.pings_sent)
+        metrics.counter('chat_idle_evictions_total', "Clients disconnected for not answering pings",
+                        lambda: self.idle_evictions)
+        self.flood_delays = metrics.counter('chat_flood_delays_total', "Times a client over its rate was read no more")
+        self.flood_drops = metrics.counter('chat_flood_drops_total', "Messages dropped for going over a rate limit")
+        self.flood_disconnects = metrics.counter('chat_flood_disconnects_total',
+                                                 "Clients disconnected for going over their rate limit")
+        metrics.gauge('chat_throttled_clients', "Clients not read until their rate limit allows",
+                      lambda: len(self.throttled))
+        metrics.gauge('chat_connection_memory_bytes', "Python memory held by connection state",
+                      lambda: self.memory_stats()["bytes"])
+
+    def receive_messages(self, connection):
+        # Every complete frame from one read, or False once the connection is gone.
+        # The frames are views into the decoder buffer, valid until the next read.
         try:
-            message_header = client_socket.recv(4)
-            if not len(message_header):
+            received = connection.decoder.recv_into(connection.socket)
+            if not received:
                 return False
-            message_length = struct.unpack('!I', message_header)[0]
-            return {"header": message_header, "data": client_socket.recv(message_length)}
-        except:
+            self.bytes_received.inc(received)
+            connection.bytes_received += received
+            return list(connection.decoder.frames())
+        except (BlockingIOError, InterruptedError):
+            return []
+        except (OSError, FrameTooLargeError) as e:
+            logger.warning("dropping connection error=%s", e)
             return False
-    
-    def remove_client(self, client_socket):
-        self.sockets_list.remove(client_socket)
-        del self.clients[client_socket]
-        client_socket.close()
+
+    def watch(self, connection):
+        # The select loop builds its socket lists from the registry every iteration
+        pass
+
+    def unwatch(self, connection):
+        pass
+
+    def stop_accepting(self):
+        self.listening = False
+
+    def add_connection(self, client_socket, address):
+        connection = Connection(client_socket, address, FrameDecoder(self.max_frame_size))
+        self.connections.add(connection)
+        self.watch(connection)
+        if self.wheel is not None:
+            connection.last_seen = self.now
+            self.wheel.schedule(connection, self.now + self.idle_timeout / 2)
+        return connection
+
+    def add_client(self, connection):
+        connection.outbound = OutboundQueue(self.max_queue_bytes, self.slow_consumer_policy)
+        connection.logged_in = True
+        self.client_count += 1
+        if self.client_limit is not None:
+            connection.bucket = self.client_limit.bucket(self.now)
+        self.users.setdefault(connection.username, []).append(connection)
+
+    def discard_client(self, connection):
+        if not self.connections.remove(connection):
+            return
+        self.unwatch(connection)
+        if connection.logged_in:
+            connection.logged_in = False
+            self.client_count -= 1
+            sessions = self.users[connection.username]
+            sessions.remove(connection)
+            if not sessions:
+                del self.users[connection.username]
+            for room in connection.rooms:
+                self.remove_member(room, connection)
+        connection.last_seen = None
+        self.closing.discard(connection)
+        # What it still has in the pipeline goes out once its stages are done,
+        # with the rooms and prefixes it had, so "bye" and quit loses nothing
+        self.release_client(connection)
+
+    def release_client(self, connection):
+        queue, connection.outbound = connection.outbound, None
+        self.writing.discard(connection)
+        self.dirty.discard(connection)
+        self.paused.pop(connection, None)
+        self.throttled.pop(connection, None)
+        if queue is not None:
+            for sender in queue.waiting_senders:
+                self.resume_sender(sender, connection)
+
+    def remove_client(self, connection):
+        self.discard_client(connection)
+        connection.socket.close()
 
     def stop(self):
         self.running = False
+        self.wake()
+
+    def wake(self):
+        try:
+            self.wake_socket.send(b'\0')
+        except OSError:  # already has a byte waiting, or closed
+            pass
+
+    def clear_wakeup(self):
+        try:
+            while self.waker.recv(4096):
+                pass
+        except OSError:
+            pass
 
-    def broadcast(self, message, sender_socket):
-        sender_username = self.clients[sender_socket]['data'].decode('utf-8')
-        for client_socket in self.clients:
-            if client_socket != sender_socket:
+    def drain(self, timeout=DEFAULT_DRAIN_TIMEOUT, reconnect_window=DEFAULT_RECONNECT_WINDOW, handoff_path=None,
+              handoff_clients=False):
+        # Stops accepting, tells every client to reconnect within
+        # reconnect_window, and stops once their queues are written and they
+        # left, or after timeout. With handoff_path the listening socket goes
+        # to the server waiting there, so new clients are never turned away,
+        # and with handoff_clients the connections go too and nobody has to
+        # reconnect. Safe to call from any thread or a signal handler.
+        self.drain_request = (timeout, reconnect_window, handoff_path, handoff_clients)
+        self.wake()
+
+    def start_drain(self):
+        timeout, reconnect_window, handoff_path, handoff_clients = self.drain_request
+        self.drain_request = None
+        if self.drain_deadline is not None:
+            return
+        self.stop_accepting()
+        if handoff_path:
+            try:
+                self.hand_off(handoff_path, handoff_clients)
+            except OSError as e:
+                logger.error("hand-off failed, draining instead error=%s", e)
+            else:
+                if handoff_clients:
+                    self.running = False
+                    return
+        self.server_socket.close()
+        logger.info("draining clients=%s timeout=%ss", self.client_count, timeout)
+
+        hint = reconnect_hint(reconnect_window)
+        for connection in self.connections:
+            if not connection.logged_in:
+                self.remove_client(connection)
+            elif connection.protocol == PROTOCOL_V2:
+                self.queue_frame(connection, encode_v2(RECONNECT, hint))
+            else:
+                self.queue_frame(connection, encode_v1(RECONNECT, hint))
+        self.drain_deadline = self.now + timeout
+
+    def check_drained(self):
+        # A client whose queue is written gets end-of-stream, which our clients
+        # take as their cue to go; closing outright could reset the connection
+        # before it read everything
+        for connection in self.connections:
+            if not connection.outbound and connection not in self.closing:
+                self.closing.add(connection)
                 try:
-                    # Prepare the new message with the sender's username
-                    full_message = f"{sender_username}: {message['data'].decode('utf-8')}"
-                    full_message = full_message.encode('utf-8')
-                    message_header = struct.pack('!I', len(full_message))
-                    client_socket.send(message_header + full_message)
-                except:
-                    # If sending fails, assume the client has disconnected
-                    print(f"Failed to send message to a client. Removing client.")
-                    self.sockets_list.remove(client_socket)
-                    del self.clients[client_socket]
-                    
+                    connection.socket.shutdown(socket.SHUT_WR)
+                except OSError:
+                    pass
+        if not self.connections or self.now >= self.drain_deadline:
+            logger.info("drained clients_left=%s", self.client_count)
+            self.running = False
+
+    def client_state(self, connection):
+        # What the next server needs to carry on with a connection: the user,
+        # the unfinished frame read so far and the bytes not yet written
+        decoder = connection.decoder
+        inbound = bytes(decoder.view[decoder.start:decoder.end])
+        queue = connection.outbound
+        outbound = b''
+        if queue:
+            outbound = b''.join([bytes(memoryview(queue.frames[0])[queue.offset:])] +
+                                [bytes(frame) for frame in itertools.islice(queue.frames, 1, None)])
+        state = {"address": list(connection.address)[:2], "inbound": len(inbound)}
+        if connection.logged_in:
+            state["user"] = {"data": connection.username.hex(), "id": connection.id, "protocol": connection.protocol,
+                             "codec": connection.codec, "rooms": [room.hex() for room in connection.rooms],
+                             "room": connection.room.hex() if connection.room is not None else None}
+        return connection.socket, state, inbound + outbound
+
+    def hand_off(self, path, clients=False):
+        # The log is closed first so the next server opens it complete
+        if self.message_log is not None:
+            self.message_log.close()
+            self.message_log = None
+        handed = []
+        if clients:
+            for connection in self.clients:
+                self.flush_client(connection)
+            handed = list(self.connections)
+        send_handoff(path, self.server_socket, [self.client_state(connection) for connection in handed])
+        logger.info("handed off listener clients=%s path=%s", len(handed), path)
+        for connection in handed:
+            self.remove_client(connection)  # the connection lives on in the other process
+
+    def adopt_clients(self, clients):
+        # Takes over connections received with receive_handoff; call before run()
+        for client_socket, state, data in clients:
+            client_socket.setblocking(False)
+            connection = self.add_connection(client_socket, tuple(state["address"]))
+            connection.decoder.feed(data[:state["inbound"]])
+            user = state.get("user")
+            if user is None:
+                continue
+            connection.username = bytes.fromhex(user['data'])
+            connection.name = connection.username.decode('utf-8', 'replace')
+            connection.id, connection.protocol, connection.codec = user['id'], user['protocol'], user['codec']
+            self.add_client(connection)
+            for room in user['rooms']:
+                self.join_room(connection, bytes.fromhex(room))
+            connection.room = bytes.fromhex(user['room']) if user['room'] else None
+            if data[state["inbound"]:]:
+                self.queue_frame(connection, data[state["inbound"]:])
+        self.user_ids = itertools.count(max((connection.id for connection in self.connections), default=0) + 1)
+        logger.info("adopted clients=%s", len(clients))
+
+    def update_interest(self, connection):
+        # The select loop rebuilds its socket lists every iteration
+        pass
+
+    def pause_sender(self, sender, connection):
+        self.paused.setdefault(sender, set()).add(connection)
+        connection.outbound.waiting_senders.add(sender)
+        self.update_interest(sender)
+
+    def resume_sender(self, sender, connection):
+        blockers = self.paused.get(sender)
+        if blockers is None:
+            return
+        blockers.discard(connection)
+        if not blockers:
+            del self.paused[sender]
+            self.update_interest(sender)
+
+    def queue_frame(self, connection, frame, sender=None):
+        # Returns False when the slow consumer policy says to disconnect
+        if connection in self.closing:
+            return True  # its end is shut, it only has to leave
+        queue = connection.outbound
+        if not queue.put(frame):
+            return False
+
+        if connection not in self.writing:
+            self.dirty.add(connection)
+
+        if queue.policy == BLOCK and queue.is_full() and sender is not None:
+            self.pause_sender(sender, connection)
+        return True
+
+    def flush_client(self, connection):
+        queue = connection.outbound
+        if queue is None:
+            return
+
+        frames_written, send_calls, sent_bytes = queue.sent_frames, queue.send_calls, queue.sent_bytes
+        try:
+            done = queue.flush(connection.socket)
+        except OSError as e:
+            logger.warning("send failed, removing client error=%s", e)
+            self.remove_client(connection)
+            return
+        self.frames_written += queue.sent_frames - frames_written
+        self.bytes_sent += queue.sent_bytes - sent_bytes
+        self.send_calls += queue.send_calls - send_calls
+
+        if done == (connection in self.writing):
+            if done:
+                self.writing.discard(connection)
+            else:
+                self.writing.add(connection)
+            self.update_interest(connection)
+        if queue.waiting_senders and not queue.is_full():
+            for sender in queue.waiting_senders:
+                self.resume_sender(sender, connection)
+            queue.waiting_senders.clear()
+
+    def flush_dirty(self):
+        # End of a loop tick: everything queued for a client this tick goes
+        # out in one write instead of one send per frame, and the records
+        # logged this tick go to disk in one write
+        if self.message_log is not None:
+            self.message_log.flush()
+        dirty, self.dirty = self.dirty, set()
+        for connection in dirty:
+            self.flush_client(connection)
+
+    def write_stats(self):
+        return {
+            "frames_written": self.frames_written,
+            "send_calls": self.send_calls,
+            "send_calls_per_frame": round(self.send_calls / self.frames_written, 4) if self.frames_written else 0.0,
+        }
+
+    def compression_stats(self):
+        return {
+            "codecs": self.compression,
+            "compressed_frames": self.compressed_frames,
+            "ratio": round(self.compression_bytes_out / self.compression_bytes_in, 4) if self.compressed_frames else 1.0,
+            "cpu_seconds": round(self.compression_cpu_ns / 1e9, 6),
+            "cpu_us_per_frame": round(self.compression_cpu_ns / 1e3 / self.compressed_frames, 2)
+            if self.compressed_frames else 0.0,
+            "compressed_deliveries": self.compressed_deliveries,
+            "bytes_saved": self.compression_bytes_saved,
+        }
+
+    def outbound_queues(self):
+        # (connection, queue) of the logged in clients. Metrics read this on
+        # their own thread, while the loop may be releasing a connection and
+        # clearing its queue, so each queue is read once and checked.
+        queues = []
+        for connection in self.clients:
+            queue = connection.outbound
+            if queue is not None:
+                queues.append((connection, queue))
+        return queues
+
+    def outbound_stats(self):
+        return [dict(username=connection.name, **queue.stats()) for connection, queue in self.outbound_queues()]
+
+    def memory_stats(self):
+        # Python memory held per connection; an idle one is mostly its read buffer
+        sizes = [connection.memory() for connection in self.connections]
+        return {
+            "connections": len(sizes),
+            "bytes": sum(sizes),
+            "bytes_per_connection": round(sum(sizes) / len(sizes)) if sizes else 0,
+        }
+
+    def join_room(self, connection, room):
+        # Joining makes the room current: the client's messages go there
+        if not room or len(room) > MAX_ROOM_NAME:
+            return False
+
+        if room not in connection.rooms:
+            prefix = connection.username + b': '
+            if room != DEFAULT_ROOM:
+                prefix = b'[' + room + b'] ' + prefix
+            # Pre-encoded "username: " that broadcast puts in front of every message
+            connection.rooms[room] = prefix
+            if connection.logged_in:  # not for a client gone with messages left in the pipeline
+                self.rooms.setdefault(room, set()).add(connection)
+        connection.room = room
+        return True
+
+    def leave_room(self, connection, room):
+        if connection.rooms.pop(room, None) is None:
+            return False
+
+        self.remove_member(room, connection)
+        if connection.room == room:
+            connection.room = DEFAULT_ROOM if DEFAULT_ROOM in connection.rooms else next(iter(connection.rooms), None)
+        return True
+
+    def remove_member(self, room, connection):
+        members = self.rooms.get(room)
+        if members is not None:
+            members.discard(connection)
+            if not members:
+                del self.rooms[room]
+
+    def frame_message(self, message, sender):
+        # Frame the message once as v2; every v2 recipient queue shares the same
+        # bytes and fan_out derives the v1 frame from it once
+        return encode_v2_parts(message.get('type', TEXT), (sender.rooms[sender.room], message['data']),
+                               message.get('id', 0), sender.id, message.get('timestamp'))
+
+    def broadcast(self, message, sender):
+        room = sender.room
+        if room is None:
+            return
+        if self.message_log is None:
+            self.fan_out(self.frame_message(message, sender), sender, self.rooms.get(room, ()))
+            return
+        kind = message.get('type', TEXT)
+        if kind == STREAM or kind == STREAM_END:
+            self.fan_out(self.frame_message(message, sender), sender, self.rooms.get(room, ()))
+            self.log_stream_part(sender, message, kind == STREAM_END)
+            return
+        message['id'] = self.message_log.next_id  # clients ask for history since the last id they saw
+        frame = self.frame_message(message, sender)
+        self.message_log.append(room, frame)
+        self.fan_out(frame, sender, self.rooms.get(room, ()))
+
+    def log_stream_part(self, sender, message, end):
+        # A streamed message is logged whole, as one text message, once it
+        # ends: history holds messages, not the parts they were relayed in.
+        # One too large for a frame is not logged.
+        if sender.streams is None:
+            sender.streams = {}
+        stream_id = message.get('id', 0)
+        text = sender.streams.pop(stream_id, None)
+        if text is None:
+            if len(sender.streams) >= MAX_LOGGED_STREAMS:
+                return
+            text = bytearray()
+        limit = (self.max_frame_size or DEFAULT_MAX_FRAME_SIZE) - V2_HEADER_SIZE
+        if text is not False:
+            text += message['data']
+            if len(text) > limit:
+                text = False
+        if not end:
+            sender.streams[stream_id] = text
+            return
+        prefix = sender.rooms[sender.room]
+        if text is not False and len(prefix) + len(text) <= limit:
+            self.message_log.append(sender.room, encode_v2_parts(TEXT, (prefix, text), self.message_log.next_id,
+                                                                 sender.id, message.get('timestamp')))
+
+    def send_direct(self, sender, message):
+        # Only the named users get the message, found through the username
+        # index, and every session logged in under a name gets its own copy.
+        # Unknown names are skipped and direct messages are never logged.
+        request = parse_direct(message['data'])
+        if request is None:
+            return
+        names, text = request
+        recipients = set()
+        for name in names[:MAX_DIRECT_RECIPIENTS]:
+            recipients.update(self.users.get(name, ()))
+        recipients.discard(sender)
+        if not recipients:
+            return
+        self.direct_messages.inc()
+        frame = encode_v2_parts(DIRECT, (sender.username, b': ', text), message.get('id', 0), sender.id,
+                                message.get('timestamp'))
+        self.fan_out(frame, sender, recipients)
+
+    def send_history(self, connection, request):
+        # Logged messages of one of the client's rooms, as a single HISTORY frame
+        # (v1 clients get the plain frames, queued together)
+        request = parse_history_request(request)
+        if request is None or self.message_log is None:
+            return
+        mode, number, room = request
+        room = connection.room if room is None else room
+        if room not in connection.rooms:
+            return
+        budget = min(MAX_HISTORY_BYTES, (self.max_frame_size or DEFAULT_MAX_FRAME_SIZE) - V2_HEADER_SIZE)
+        if mode == 'last':
+            frames = self.message_log.last(room, min(number, MAX_HISTORY), budget)
+        else:
+            frames = self.message_log.since(room, number, MAX_HISTORY, budget)
+
+        if connection.protocol == PROTOCOL_V1:
+            for frame in frames:
+                frame = v2_to_v1(frame)
+                if frame is not None:
+                    self.queue_frame(connection, frame)
+            return
+        bulk = encode_v2(HISTORY, b''.join(frames))
+        if connection.codec and len(bulk) - HEADER_SIZE - V2_HEADER_SIZE >= self.compress_threshold:
+            bulk = self.compress_frame(bulk, connection.codec)
+        self.queue_frame(connection, bulk)
+
+    def fan_out(self, frame, sender=None, recipients=None):
+        # Cost is proportional to the recipients, the room members by default
+        targets = self.clients if recipients is None else recipients
+        count = len(targets) - (sender in targets)
+        self.fan_out_size.observe(count)
+        self.messages_sent.inc(count)
+        failed = []
+        v1_frame = None
+        compressed = {} if len(frame) - HEADER_SIZE - V2_HEADER_SIZE >= self.compress_threshold else None
+        for connection in targets:
+            if connection is not sender:
+                if connection.protocol == PROTOCOL_V1:
+                    if v1_frame is None:
+                        v1_frame = v2_to_v1(frame)
+                    client_frame = v1_frame
+                elif compressed is not None and connection.codec:
+                    client_frame = compressed.get(connection.codec)
+                    if client_frame is None:
+                        client_frame = compressed[connection.codec] = self.compress_frame(frame, connection.codec)
+                    if client_frame is not frame:
+                        self.compressed_deliveries += 1
+                        self.compression_bytes_saved += len(frame) - len(client_frame)
+                else:
+                    client_frame = frame
+                if not self.queue_frame(connection, client_frame, sender):
+                    self.slow_consumer_disconnects += 1
+                    failed.append(connection)
+
+        for connection in failed:
+            logger.warning("slow client exceeded its outbound queue, removing client user=%s", connection.name)
+            self.remove_client(connection)
+
+    def compress_frame(self, frame, codec):
+        # Once per broadcast and codec; the frame itself when compressing does not pay
+        started = time.thread_time_ns()
+        compressed = compress_v2(frame, codec)
+        self.compression_cpu_ns += time.thread_time_ns() - started
+        self.compressed_frames += 1
+        self.compression_bytes_in += len(frame)
+        self.compression_bytes_out += len(compressed or frame)
+        return compressed or frame
+
+    def accept_client(self):
+        client_socket, client_address = self.server_socket.accept()
+        client_socket.setblocking(False)
+        if self.keepalive:
+            self.enable_keepalive(client_socket)
+        self.add_connection(client_socket, client_address)
+
+    def enable_keepalive(self, client_socket):
+        # Lets the kernel find peers that vanished without closing the connection
+        try:
+            client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            for option, value in (('TCP_KEEPIDLE', KEEPALIVE_IDLE), ('TCP_KEEPINTVL', KEEPALIVE_INTERVAL),
+                                  ('TCP_KEEPCNT', KEEPALIVE_COUNT)):
+                if hasattr(socket, option):
+                    client_socket.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+        except OSError:
+            pass
+
+    def expire_idle(self):
+        # Only the connections due this tick are looked at. One that was heard
+        # from since it was scheduled just moves to its new due time.
+        for connection in self.wheel.advance(self.now):
+            seen = connection.last_seen
+            if seen is None:
+                continue  # already gone
+            if connection.logged_in and connection.protocol == PROTOCOL_V1:
+                connection.last_seen = None  # left to TCP keepalive
+                continue
+            if connection in self.paused or connection in self.throttled:
+                seen = connection.last_seen = self.now  # we are the ones not reading
+            idle = self.now - seen
+            if idle >= self.idle_timeout:
+                self.idle_evictions += 1
+                logger.info("evicting idle client user=%s idle=%.1fs",
+                            connection.name if connection.logged_in else None, idle)
+                self.remove_client(connection)
+            elif idle >= self.idle_timeout / 2 and connection.logged_in:
+                self.pings_sent += 1
+                self.queue_frame(connection, encode_v2(PING))
+                self.wheel.schedule(connection, seen + self.idle_timeout)
+            else:
+                self.wheel.schedule(connection, seen + (self.idle_timeout / 2 if connection.logged_in
+                                                        else self.idle_timeout))
+
+    def login_client(self, connection, username):
+        protocol, offered, username = parse_hello(username)
+        if reserved_username(username):
+            logger.warning("rejecting reserved username address=%s:%s user=%r", connection.address[0],
+                           connection.address[1], username)
+            self.remove_client(connection)
+            return None
+        connection.codec = next((codec for codec in offered if codec in self.compression), None)
+        connection.id = next(self.user_ids)
+        connection.username = username
+        connection.name = username.decode('utf-8', 'replace')
+        connection.protocol = protocol
+        self.add_client(connection)
+        self.join_room(connection, DEFAULT_ROOM)
+        if protocol == PROTOCOL_V2:
+            # Accepting the hello tells the client to speak v2, gives it its
+            # sender id and names the codec large messages will come in
+            self.queue_frame(connection, encode_v2(HELLO, (connection.codec or '').encode('ascii'),
+                                                   sender_id=connection.id))
+        self.logins.inc()
+        logger.info("accepted connection address=%s:%s user=%s protocol=%s codec=%s", connection.address[0],
+                    connection.address[1], connection.name, protocol, connection.codec)
+        return connection
+
+    def parse_message(self, connection, frame):
+        # Both protocols end up as the same message dict
+        if connection.protocol == PROTOCOL_V2:
+            kind, flags, message_id, _, timestamp, data = decode_v2(frame)
+            data = decompress_payload(flags, data, self.max_frame_size or DEFAULT_MAX_FRAME_SIZE)
+            return {"type": kind, "id": message_id, "timestamp": timestamp, "data": data}
+        kind, message_id, data = decode_v1(frame)
+        return {"type": kind, "id": message_id, "timestamp": now(), "data": data}
+
+    def handle_client_message(self, connection):
+        if connection not in self.connections:
+            # Removed earlier in this wakeup, e.g. by a failed broadcast
+            return
+
+        frames = self.receive_messages(connection)
+        if frames is False:
+            if connection.logged_in:
+                logger.info("closed connection user=%s", connection.name)
+            self.remove_client(connection)
+            return
+
+        if connection.last_seen is not None:
+            connection.last_seen = self.now
+        self.handle_frames(connection, frames)
+
+    def handle_frames(self, connection, frames):
+        for index, frame in enumerate(frames):
+            if connection in self.throttled:
+                # Over its rate: the rest waits in the decoder until resume_throttled
+                connection.decoder.unread(frames[index:])
+                return
+            if not connection.logged_in:
+                if self.login_client(connection, frame) is None:
+                    return
+                continue
+
+            try:
+                message = self.parse_message(connection, frame)
+            except (struct.error, CompressionError):
+                logger.warning("dropping connection: malformed frame")
+                self.remove_client(connection)
+                return
+
+            self.messages_received.inc()
+            connection.messages_received += 1
+            kind = message['type']
+            if kind == DISCONNECT:
+                logger.info("disconnect user=%s", connection.name)
+                self.remove_client(connection)
+                return
+            if kind != PING and kind != PONG and (self.client_limit or self.global_limit):
+                action = self.check_flood(connection, len(frame))
+                if action == DROP:
+                    self.flood_drops.inc()
+                    continue
+                if action is not None:
+                    self.flood_disconnects.inc()
+                    logger.warning("client over its rate limit, removing client user=%s", connection.name)
+                    self.remove_client(connection)
+                    return
+            if self.pipeline is not None and kind in PIPELINE_TYPES:
+                self.pipeline.submit(connection, message)
+            elif kind == JOIN:
+                self.join_room(connection, bytes(message['data']))
+            elif kind == LEAVE:
+                self.leave_room(connection, bytes(message['data']))
+            elif kind == HISTORY:
+                self.send_history(connection, message['data'])
+            elif kind == DIRECT:
+                self.send_direct(connection, message)
+            elif kind == PING:
+                self.queue_frame(connection, encode_v2(PONG))
+            elif kind == STREAM or kind == STREAM_END:
+                # Parts of a streamed message are relayed as they come; the log gets the whole message
+                self.broadcast(message, connection)
+            elif kind == TEXT:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("message user=%s text=%r", connection.name, str(message['data'], 'utf-8', 'replace'))
+                self.broadcast(message, connection)
+
+    def dispatch(self, connection, message):
+        # A message out of the pipeline, in the order its sender sent it
+        kind = message['type']
+        if kind == JOIN:
+            self.join_room(connection, bytes(message['data']))
+        elif kind == LEAVE:
+            self.leave_room(connection, bytes(message['data']))
+        elif kind == DIRECT:
+            self.send_direct(connection, message)
+        elif kind == HISTORY:
+            if connection.logged_in:
+                self.send_history(connection, message['data'])
+        else:
+            self.broadcast(message, connection)
+
+    def check_flood(self, connection, size):
+        # None lets the message through, otherwise the action to take. An empty
+        # global bucket only ever drops or delays: it is not this client's fault.
+        # A delayed client owes the tokens of the message that went over and
+        # the rest of what it sent is handled once it is resumed.
+        client_limit, global_limit = self.client_limit, self.global_limit
+        client_ok = client_limit is None or client_limit.admit(connection.bucket, self.now)
+        global_ok = global_limit is None or global_limit.admit(self.global_bucket, self.now)
+        if self.flood_action != DELAY:
+            if not client_ok:
+                return self.flood_action
+            if not global_ok:
+                return DROP
+
+        wait = 0
+        if client_limit is not None:
+            wait = client_limit.spend(connection.bucket, size)
+        if global_limit is not None:
+            wait = max(wait, global_limit.spend(self.global_bucket, size))
+        if wait and self.flood_action == DELAY:
+            self.throttle(connection, self.now + wait)
+        return None
+
+    def throttle(self, connection, until):
+        if connection not in self.throttled:
+            self.flood_delays.inc()
+        self.throttled[connection] = max(until, self.throttled.get(connection, until))
+        self.update_interest(connection)
+
+    def resume_throttled(self):
+        for connection, until in list(self.throttled.items()):
+            if until <= self.now and self.throttled.pop(connection, None) is not None:
+                self.update_interest(connection)
+                if len(connection.decoder):
+                    self.handle_frames(connection, list(connection.decoder.frames()))
+
+    def select_timeout(self):
+        # The wheel tick, or less when a throttled client is due to be read again
+        if not self.throttled:
+            return self.wheel_tick
+        wait = max(0, min(self.throttled.values()) - time.monotonic())
+        return wait if self.wheel_tick is None else min(wait, self.wheel_tick)
+
+    def close_all(self):
+        logger.info("server stopping")
+        # Close all client sockets
+        for connection in self.connections:
+            connection.socket.close()
+        self.server_socket.close()
+        self.waker.close()
+        self.wake_socket.close()
+        if self.pipeline is not None:
+            self.pipeline.close()
+        if self.message_log is not None:
+            self.message_log.close()
+        logger.info("server stopped")
+
     def run(self):
         while self.running:
             try:
-                read_sockets, _, exception_sockets = select.select(self.sockets_list, [], self.sockets_list)
-                
+                connections = list(self.connections)
+                sockets = [connection.socket for connection in connections]
+                if self.paused or self.throttled:
+                    read_list = [connection.socket for connection in connections
+                                 if connection not in self.paused and connection not in self.throttled]
+                else:
+                    read_list = sockets[:]
+                read_list.append(self.waker)
+                if self.listening:
+                    read_list.append(self.server_socket)
+                read_sockets, write_sockets, exception_sockets = select.select(
+                    read_list, [connection.socket for connection in self.writing], sockets, self.select_timeout())
+                self.now = time.monotonic()
+
+                for notified_socket in write_sockets:
+                    connection = self.connections.get(notified_socket.fileno())
+                    if connection is not None:
+                        self.flush_client(connection)
+
                 for notified_socket in read_sockets:
-                    if notified_socket == self.server_socket:
-                        client_socket, client_address = self.server_socket.accept()
-                        user = self.receive_message(client_socket)
-                        if user is False:
-                            continue
-                        
-                        self.sockets_list.append(client_socket)
-                        self.clients[client_socket] = user
-                        print(f"Accepted new connection from {client_address[0]}:{client_address[1]} username:{user['data'].decode('utf-8')}")
+                    if notified_socket is self.server_socket:
+                        self.accept_client()
+                    elif notified_socket is self.waker:
+                        self.clear_wakeup()
                     else:
-                        message = self.receive_message(notified_socket)
-                        if message is False:
-                            print(f"Closed connection from {self.clients[notified_socket]['data'].decode('utf-8')}")
-                            self.remove_client(notified_socket)
-                            continue
+                        connection = self.connections.get(notified_socket.fileno())
+                        if connection is not None:
+                            self.handle_client_message(connection)
+
+                for notified_socket in exception_sockets:
+                    connection = self.connections.get(notified_socket.fileno())
+                    if connection is not None:
+                        self.discard_client(connection)
 
-                        if message['data'].decode('utf-8') == "__DISCONNECT__":
-                            print(f"Received disconnect message from {self.clients[notified_socket]['data'].decode('utf-8')}")
-                            self.remove_client(notified_socket)
-                            continue
+                self.end_tick()
+            except Exception as e:
+                logger.exception("server error: %s", e)
+                break
 
-                        user = self.clients[notified_socket]
-                        print(f"Received message from {user['data'].decode('utf-8')}: {message['data'].decode('utf-8')}")
-                        self.broadcast(message, notified_socket)
+        self.close_all()
 
-                for notified_socket in exception_sockets:
-                    self.sockets_list.remove(notified_socket)
-                    del self.clients[notified_socket]
+    def end_tick(self):
+        if self.throttled:
+            self.resume_throttled()
+        if self.wheel is not None:
+            self.expire_idle()
+        if self.drain_request is not None:
+            self.start_drain()
+        if self.pipeline is not None:
+            self.pipeline.collect()
+        self.flush_dirty()
+        if self.drain_deadline is not None:
+            self.check_drained()
+        self.loop_latency.observe(time.monotonic() - self.now)
+
+
+class SelectorChatServer(ChatServer):
+    # Same protocol and bookkeeping as ChatServer, but readiness comes from
+    # selectors.DefaultSelector (epoll/kqueue) so each wakeup only reports the
+    # sockets that are actually ready and there is no FD_SETSIZE cap.
+    def __init__(self, host='localhost', port=8080, backlog=socket.SOMAXCONN, **kwargs):
+        raise_fd_limit()
+        super().__init__(host, port, backlog, **kwargs)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server_socket, selectors.EVENT_READ, self.accept_socket)
+        self.selector.register(self.waker, selectors.EVENT_READ, lambda *_: self.clear_wakeup())
+
+    def accept_socket(self, _, mask):
+        self.accept_client()
+
+    def handle_client_event(self, connection, mask):
+        if mask & selectors.EVENT_WRITE:
+            self.flush_client(connection)
+        if mask & selectors.EVENT_READ:
+            self.handle_client_message(connection)
+
+    def watch(self, connection):
+        # The key carries the connection itself, so an event needs no lookup
+        self.selector.register(connection.socket, selectors.EVENT_READ, connection)
+
+    def unwatch(self, connection):
+        try:
+            self.selector.unregister(connection.socket)
+        except (KeyError, ValueError):
+            pass
+
+    def stop_accepting(self):
+        super().stop_accepting()
+        self.selector.unregister(self.server_socket)
+
+    def update_interest(self, connection):
+        if not connection.logged_in:
+            return
+
+        events = 0
+        if connection not in self.paused and connection not in self.throttled:
+            events |= selectors.EVENT_READ
+        if connection in self.writing:
+            events |= selectors.EVENT_WRITE
+
+        try:
+            key = self.selector.get_key(connection.socket)
+        except KeyError:
+            key = None
+
+        if key is None:
+            if events:
+                self.selector.register(connection.socket, events, connection)
+        elif not events:
+            self.selector.unregister(connection.socket)
+        elif key.events != events:
+            self.selector.modify(connection.socket, events, connection)
+
+    def close_all(self):
+        self.selector.close()
+        super().close_all()
+
+    def run(self):
+        while self.running:
+            try:
+                events = self.selector.select(self.select_timeout())
+                self.now = time.monotonic()
+                for key, mask in events:
+                    target = key.data
+                    if target.__class__ is Connection:
+                        self.handle_client_event(target, mask)
+                    else:
+                        target(key.fileobj, mask)  # the listener, the waker or a subclass's own socket
+                self.end_tick()
             except Exception as e:
-                print(f"Server error: {str(e)}")
+                logger.exception("server error: %s", e)
                 break
-        
-        print("server stop")
-        # Close all client sockets
-        for client_socket in self.sockets_list[1:]:
-            client_socket.close()
-        self.server_socket.close()
-        print("Server stopped")
+
+        self.close_all()
+
+
+ENGINES = {
+    'select': ChatServer,
+    'selectors': SelectorChatServer,
+}
+
+
+def create_server(engine='select', **kwargs):
+    if engine not in ENGINES:
+        raise ValueError(f'Unknown server engine: {engine}, supporting only {", ".join(ENGINES)}')
+    return ENGINES[engine](**kwargs)
+
 
 if __name__ == "__main__":
-    server = ChatServer()
-    server.run()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Chat server")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='select')
+    parser.add_argument('--max-queue-bytes', type=int, default=1 << 20)
+    parser.add_argument('--slow-consumer-policy', choices=POLICIES, default=DROP_OLDEST)
+    parser.add_argument('--max-frame-size', type=int, default=DEFAULT_MAX_FRAME_SIZE)
+    parser.add_argument('--compression', default=','.join(CODECS),
+                        help="codecs offered to v2 clients, comma separated, empty to disable")
+    parser.add_argument('--compress-threshold', type=int, default=DEFAULT_COMPRESS_THRESHOLD,
+                        help="messages with at least this many bytes are compressed")
+    parser.add_argument('--log-dir', help="keep every message in this directory so clients can ask for history")
+    parser.add_argument('--segment-bytes', type=int, default=DEFAULT_SEGMENT_BYTES)
+    parser.add_argument('--fsync-interval', type=float, default=DEFAULT_FSYNC_INTERVAL)
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help="DEBUG also logs every message")
+    parser.add_argument('--metrics-port', type=int, help="serve Prometheus metrics at http://host:port/metrics")
+    parser.add_argument('--idle-timeout', type=float, default=DEFAULT_IDLE_TIMEOUT,
+                        help="disconnect v2 clients that answer no ping for this many seconds, 0 to never")
+    parser.add_argument('--drain-timeout', type=float, default=DEFAULT_DRAIN_TIMEOUT,
+                        help="on SIGTERM, seconds to let clients take their last messages before exiting")
+    parser.add_argument('--reconnect-window', type=float, default=DEFAULT_RECONNECT_WINDOW,
+                        help="seconds over which draining clients are told to spread their reconnects")
+    parser.add_argument('--handoff-path', help="Unix socket path for restarts: on SIGUSR2 the listening socket is "
+                                               "handed to the server started with --takeover on the same path")
+    parser.add_argument('--handoff-clients', action='store_true',
+                        help="hand off live connections too instead of asking clients to reconnect")
+    parser.add_argument('--client-rate', type=float, default=0,
+                        help="messages per second each client may send, 0 for no limit")
+    parser.add_argument('--client-byte-rate', type=float, default=0,
+                        help="bytes per second each client may send, 0 for no limit")
+    parser.add_argument('--client-burst', type=float, help="messages a client may send at once, default one second's")
+    parser.add_argument('--global-rate', type=float, default=0,
+                        help="messages per second from all clients together, 0 for no limit")
+    parser.add_argument('--global-byte-rate', type=float, default=0,
+                        help="bytes per second from all clients together, 0 for no limit")
+    parser.add_argument('--flood-action', choices=FLOOD_ACTIONS, default=DELAY,
+                        help="what happens to a client over its limit")
+    parser.add_argument('--filter-words', help="comma separated words masked in every message")
+    parser.add_argument('--plugin', action='append', default=[], metavar='MODULE:CLASS',
+                        help="message pipeline stage, in order; may be given several times")
+    parser.add_argument('--pipeline-executor', choices=EXECUTORS, default=THREAD,
+                        help="pool for pipeline stages that block")
+    parser.add_argument('--pipeline-workers', type=int, help="workers in that pool, default per CPU")
+    parser.add_argument('--takeover', action='store_true',
+                        help="take the sockets of the running server at --handoff-path instead of binding")
+    args = parser.parse_args()
+
+    logging_listener = configure_logging(args.log_level)
+
+    listen_socket, adopted = None, []
+    if args.takeover:
+        if not args.handoff_path:
+            parser.error("--takeover needs --handoff-path")
+        logger.info("waiting for hand-off path=%s", args.handoff_path)
+        listen_socket, adopted = receive_handoff(args.handoff_path)
+
+    message_log = MessageLog(args.log_dir, args.segment_bytes, args.fsync_interval) if args.log_dir else None
+    stages = [WordFilter(args.filter_words.split(','))] if args.filter_words else []
+    stages += [load_stage(spec) for spec in args.plugin]
+    pipeline = MessagePipeline(stages, args.pipeline_executor, args.pipeline_workers) if stages else None
+
+    server = create_server(args.engine, host=args.host, port=args.port,
+                           max_queue_bytes=args.max_queue_bytes, slow_consumer_policy=args.slow_consumer_policy,
+                           max_frame_size=args.max_frame_size, compression=args.compression.split(','),
+                           compress_threshold=args.compress_threshold, message_log=message_log,
+                           idle_timeout=args.idle_timeout, listen_socket=listen_socket,
+                           client_limit=RateLimit(args.client_rate, args.client_byte_rate, args.client_burst),
+                           global_limit=RateLimit(args.global_rate, args.global_byte_rate),
+                           flood_action=args.flood_action, pipeline=pipeline)
+    if adopted:
+        server.adopt_clients(adopted)
+    signal.signal(signal.SIGTERM, lambda *_: server.drain(args.drain_timeout, args.reconnect_window))
+    if args.handoff_path and hasattr(signal, 'SIGUSR2'):
+        signal.signal(signal.SIGUSR2, lambda *_: server.drain(args.drain_timeout, args.reconnect_window,
+                                                              args.handoff_path, args.handoff_clients))
+    if args.metrics_port is not None:
+        MetricsServer(server.metrics, args.host, args.metrics_port).start()
+    server.run()
+    logging_listener.stop()  # writes out the records of the shutdown
@@ -0,0 +1,244 @@
+# sharded_server.py
+import os
+import time
+import shutil
+import socket
+import logging
+import argparse
+import selectors
+import tempfile
+import threading
+import multiprocessing
+from server import SelectorChatServer, configure_logging
+from framing import FrameDecoder, FRAME_HEADER
+from outbound import OutboundQueue, BLOCK
+
+# The bus must never drop a frame, it only holds them until the peer reads
+BUS_QUEUE_BYTES = 64 << 20
+
+logger = logging.getLogger('chat.sharded')
+
+
+class BroadcastBus:
+    # Relays every frame a shard publishes to all the other shards. Each shard
+    # has one ordered stream to the bus and one back, so messages from a sender
+    # reach every shard in the order the sender's shard published them.
+    def __init__(self, path):
+        self.path = path
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen()
+        self.listener.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.peers = {}  # shard socket -> (decoder, outbound queue)
+        self.dirty_peers = set()
+        self.running = True
+        self.relayed_frames = 0
+
+    def accept_peer(self):
+        peer_socket, _ = self.listener.accept()
+        peer_socket.setblocking(False)
+        self.peers[peer_socket] = (FrameDecoder(max_frame_size=None), OutboundQueue(BUS_QUEUE_BYTES, BLOCK))
+        self.selector.register(peer_socket, selectors.EVENT_READ)
+
+    def remove_peer(self, peer_socket):
+        self.selector.unregister(peer_socket)
+        del self.peers[peer_socket]
+        self.dirty_peers.discard(peer_socket)
+        peer_socket.close()
+
+    def relay(self, source_socket, frame):
+        header = FRAME_HEADER.pack(len(frame))
+        for peer_socket, (_, queue) in self.peers.items():
+            if peer_socket is source_socket:
+                continue
+            if not queue:
+                self.dirty_peers.add(peer_socket)
+            queue.put(header)
+            queue.put(frame)
+        self.relayed_frames += 1
+
+    def flush_dirty(self):
+        # Everything relayed to a shard in one pass goes out in one write
+        dirty_peers, self.dirty_peers = self.dirty_peers, set()
+        for peer_socket in dirty_peers:
+            try:
+                if not self.peers[peer_socket][1].flush(peer_socket):
+                    self.selector.modify(peer_socket, selectors.EVENT_READ | selectors.EVENT_WRITE)
+            except OSError:
+                self.remove_peer(peer_socket)
+
+    def handle_peer(self, peer_socket, mask):
+        decoder, queue = self.peers[peer_socket]
+        try:
+            if mask & selectors.EVENT_WRITE and queue.flush(peer_socket):
+                self.selector.modify(peer_socket, selectors.EVENT_READ)
+            if mask & selectors.EVENT_READ and not decoder.recv_into(peer_socket):
+                self.remove_peer(peer_socket)
+                return
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.remove_peer(peer_socket)
+            return
+
+        for frame in decoder.frames():
+            self.relay(peer_socket, bytes(frame))
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        while self.running:
+            for key, mask in self.selector.select(timeout=0.5):
+                if key.fileobj is self.listener:
+                    self.accept_peer()
+                elif key.fileobj in self.peers:
+                    self.handle_peer(key.fileobj, mask)
+            self.flush_dirty()
+
+        for peer_socket in list(self.peers):
+            self.remove_peer(peer_socket)
+        self.selector.close()
+        self.listener.close()
+
+
+class ShardChatServer(SelectorChatServer):
+    # One worker of a ShardedChatServer. It serves its own clients like a
+    # SelectorChatServer and publishes every broadcast frame on the bus, then
+    # delivers the frames other shards publish to its local clients.
+    def __init__(self, bus_path, host='localhost', port=8080, **kwargs):
+        super().__init__(host, port, reuse_port=True, **kwargs)
+        self.bus_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.bus_socket.connect(bus_path)
+        self.bus_socket.setblocking(False)
+        self.bus_decoder = FrameDecoder(max_frame_size=None)
+        self.bus_queue = OutboundQueue(BUS_QUEUE_BYTES, BLOCK)
+        self.bus_dirty = False
+        self.selector.register(self.bus_socket, selectors.EVENT_READ, self.handle_bus_event)
+
+    def broadcast(self, message, sender):
+        room = sender.room
+        if room is None:
+            return
+        frame = self.frame_message(message, sender)
+        self.fan_out(frame, sender, self.rooms[room])
+        self.publish(room, frame)
+
+    def publish(self, room, frame):
+        # Bus payload: room name length, room name, then the client frame
+        self.bus_dirty = self.bus_dirty or not self.bus_queue
+        self.bus_queue.put(FRAME_HEADER.pack(1 + len(room) + len(frame)) + bytes((len(room),)) + room)
+        self.bus_queue.put(frame)
+
+    def flush_dirty(self):
+        super().flush_dirty()
+        if self.bus_dirty:
+            self.bus_dirty = False
+            if not self.bus_queue.flush(self.bus_socket):
+                self.selector.modify(self.bus_socket, selectors.EVENT_READ | selectors.EVENT_WRITE, self.handle_bus_event)
+
+    def handle_bus_event(self, bus_socket, mask):
+        if mask & selectors.EVENT_WRITE and self.bus_queue.flush(bus_socket):
+            self.selector.modify(bus_socket, selectors.EVENT_READ, self.handle_bus_event)
+        if mask & selectors.EVENT_READ:
+            try:
+                received = self.bus_decoder.recv_into(bus_socket)
+            except (BlockingIOError, InterruptedError):
+                return
+            if not received:
+                logger.warning("broadcast bus closed, stopping shard")
+                self.stop()
+                return
+            for payload in self.bus_decoder.frames():
+                room_end = 1 + payload[0]
+                members = self.rooms.get(bytes(payload[1:room_end]))
+                if members:
+                    self.fan_out(bytes(payload[room_end:]), None, members)
+
+    def close_all(self):
+        self.bus_socket.close()
+        super().close_all()
+
+
+def run_shard(bus_path, host, port, server_kwargs, quiet=False):
+    configure_logging(logging.WARNING if quiet else logging.INFO)
+    server = ShardChatServer(bus_path, host, port, **server_kwargs)
+    server.run()
+
+
+class ShardedChatServer:
+    # Runs `workers` ShardChatServer processes on the same port (SO_REUSEPORT)
+    # so the kernel spreads connections over cores, joined by a BroadcastBus
+    def __init__(self, host='localhost', port=8080, workers=None, quiet=False, **server_kwargs):
+        if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(socket, 'AF_UNIX'):
+            raise RuntimeError('Sharded mode needs SO_REUSEPORT and Unix domain sockets')
+
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.quiet = quiet
+        self.server_kwargs = server_kwargs
+        self.bus_dir = tempfile.mkdtemp(prefix='chat-bus-')
+        self.bus = BroadcastBus(os.path.join(self.bus_dir, 'bus.sock'))
+        self.bus_thread = None
+        self.processes = []
+
+    def start(self):
+        self.bus_thread = threading.Thread(target=self.bus.run)
+        self.bus_thread.daemon = True
+        self.bus_thread.start()
+        for _ in range(self.workers):
+            process = multiprocessing.Process(
+                target=run_shard,
+                args=(self.bus.path, self.host, self.port, self.server_kwargs, self.quiet),
+            )
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+        logger.info("sharded server started address=%s:%s workers=%s", self.host, self.port, self.workers)
+
+    def wait_ready(self, timeout=10):
+        # A shard connects to the bus only after its listening socket is bound
+        deadline = time.time() + timeout
+        while len(self.bus.peers) < self.workers:
+            if time.time() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def run(self):
+        self.start()
+        try:
+            for process in self.processes:
+                process.join()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join(timeout=5)
+        self.processes = []
+        self.bus.stop()
+        if self.bus_thread:
+            self.bus_thread.join(timeout=5)
+        shutil.rmtree(self.bus_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sharded chat server")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--quiet', action='store_true', help="only log warnings in the workers")
+    args = parser.parse_args()
+
+    configure_logging()
+
+    server = ShardedChatServer(args.host, args.port, args.workers, args.quiet)
+    server.run()
@@ -0,0 +1,35 @@
+class TimerWheel:
+    # Hashed timing wheel: an item scheduled for time t goes in the slot of the
+    # tick t falls in, and advance() only visits the slots of ticks that have
+    # passed. Scheduling is an append and each tick costs the items due in it,
+    # however many items the wheel holds. Items due more than a full turn
+    # ahead wait in their slot until their round comes.
+    def __init__(self, tick, slots, now):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = self.tick_of(now)
+
+    def tick_of(self, when):
+        return int(when // self.tick)
+
+    def __len__(self):
+        return sum(len(slot) for slot in self.slots)
+
+    def schedule(self, item, when):
+        due = max(self.tick_of(when), self.current + 1)
+        self.slots[due % len(self.slots)].append((due, item))
+
+    def advance(self, now):
+        # Items whose time has come, oldest tick first
+        expired = []
+        target = self.tick_of(now)
+        while self.current < target:
+            self.current += 1
+            slot = self.slots[self.current % len(self.slots)]
+            if not slot:
+                continue
+            waiting = [(due, item) for due, item in slot if due > self.current]
+            if len(waiting) < len(slot):
+                expired.extend(item for due, item in slot if due <= self.current)
+                slot[:] = waiting
+        return expired
@@ -1,15 +1,165 @@
 import unittest
+import asyncio
 import time
-from app.server import ChatServer
+import socket
+import struct
+import random
+from app.server import ChatServer, SelectorChatServer, configure_logging
 from app.client import ChatClient
-from app.ai_client import AIClient
+from app.async_client import AsyncChatClient
+from app import protocol
+from app.protocol import (PROTOCOL_V1, PROTOCOL_V2, TEXT, JOIN, STREAM, STREAM_END, FLAG_ZLIB, CODECS, PING, PONG,
+                          CompressionError, encode_v1, encode_v2, decode_v1, decode_v2, v2_to_v1, compress_v2,
+                          decompress_payload, hello_offer, parse_hello, direct_message, parse_direct)
+from app.ai_client import AIClient, retry
+from app.bot_host import BotHost, load_personas
+from app.pipeline import MessagePipeline, Stage, WordFilter
+from app.outbound import OutboundQueue, DROP_OLDEST, DISCONNECT, BLOCK
+from app.history import ConversationHistory, estimate_tokens
+from app.response_cache import MemoryCache, SqliteCache, prompt_key
+from app.model_gateway import ModelGateway, GatewayClient, StubBackend
+from app.message_log import MessageLog
+from app.metrics import MetricsRegistry, MetricsServer
+from app.timer_wheel import TimerWheel
+from app.connection import Connection, ConnectionRegistry
+from app.handoff import receive_handoff
+from app import rate_limit
+from app.rate_limit import RateLimit
+from app.framing import FrameDecoder, FrameTooLargeError, encode_frame
+from app.sharded_server import BroadcastBus, ShardChatServer, ShardedChatServer
+from app.benchmark import run_benchmark, idle_memory, room_members, percentile
+import os
+import shutil
+import tempfile
 import threading
+import logging
+import json
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def start_server(server_class, port, **kwargs):
+    server = server_class(port=port, **kwargs)
+    server_thread = threading.Thread(target=server.run)
+    server_thread.daemon = True
+    server_thread.start()
+    return server
+
+
+def stop_server(server, port):
+    server.stop()
+    # Wake the loop up so it notices it was stopped
+    try:
+        socket.create_connection(('localhost', port)).close()
+    except OSError:
+        pass
+
+
+def connect_raw_client(username, port, rcvbuf=None):
+    raw_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if rcvbuf:
+        raw_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    raw_socket.connect(('localhost', port))
+    send_raw_message(raw_socket, username)
+    return raw_socket
+
+
+def send_raw_message(raw_socket, message):
+    message = message.encode('utf-8')
+    raw_socket.sendall(struct.pack('!I', len(message)) + message)
+
+
+def receive_raw_message(raw_socket):
+    header = b''
+    while len(header) < 4:
+        chunk = raw_socket.recv(4 - len(header))
+        if not chunk:
+            return None
+        header += chunk
+    message_length = struct.unpack('!I', header)[0]
+    data = b''
+    while len(data) < message_length:
+        chunk = raw_socket.recv(message_length - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data.decode('utf-8')
+
+def split_raw_frames(data):
+    # Whole frames (length included) at the start of data
+    frames = []
+    while len(data) >= 4 and len(data) >= 4 + struct.unpack('!I', data[:4])[0]:
+        end = 4 + struct.unpack('!I', data[:4])[0]
+        frames.append(data[:end])
+        data = data[end:]
+    return frames
+
+class FakeCompletionServer:
+    # Local stand-in for the OpenAI chat completions endpoint
+    def __init__(self, reply="fake reply", delay=0):
+        self.reply = reply
+        self.delay = delay
+        self.chunk_delay = 0.1
+        self.requests = []
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                fake.requests.append(body)
+                time.sleep(fake.delay)
+                if body.get("stream"):
+                    self.stream_reply(body)
+                    return
+                payload = json.dumps({
+                    "id": f"fake-{len(fake.requests)}", "object": "chat.completion", "created": 0,
+                    "model": body["model"],
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": fake.reply}}],
+                }).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def stream_reply(self, body):
+                # Server-sent events, one word per chunk, chunk_delay apart
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.end_headers()
+                words = fake.reply.split(' ')
+                for i, word in enumerate(words):
+                    chunk = json.dumps({
+                        "id": f"fake-{len(fake.requests)}", "object": "chat.completion.chunk", "created": 0,
+                        "model": body["model"],
+                        "choices": [{"index": 0, "finish_reason": None,
+                                     "delta": {"content": word if i == len(words) - 1 else word + ' '}}],
+                    })
+                    self.wfile.write(f"data: {chunk}\n\n".encode('utf-8'))
+                    self.wfile.flush()
+                    time.sleep(fake.chunk_delay)
+                self.wfile.write(b"data: [DONE]\n\n")
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('localhost', 0), Handler)
+        self.base_url = f"http://localhost:{self.httpd.server_address[1]}/v1"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
 
 class TestChatSystem(unittest.TestCase):
+    server_class = ChatServer
+    port = 12346
     
     @classmethod
     def setUpClass(cls):
-        cls.server = ChatServer(port=12346)
+        cls.server = cls.server_class(port=cls.port)
         cls.server_thread = threading.Thread(target=cls.server.run)
         cls.server_thread.daemon = True
         cls.server_thread.start()
@@ -33,15 +183,17 @@ class TestChatSystem(unittest.TestCase):
 
 
     def get_server_clients_usernames(self):
-        return [username['data'].decode('utf-8') for _, username in self.server.clients.items()]
+        return [connection.name for connection in self.server.clients]
     
 
-    def create_test_client(self, username, port=12346):
+    def create_test_client(self, username, port=None):
+        port = port or self.port
         test_client = ChatClient(username, port=port, test_mode=True)
         self.test_clients.append(test_client)
         return test_client
     
-    def create_test_ai_client(self, username, port=12346, interval=2, mode='lines'):
+    def create_test_ai_client(self, username, port=None, interval=2, mode='lines'):
+        port = port or self.port
         test_client = AIClient(username, mode=mode, interval=interval, api_key='', port=port, test_mode=True)
         self.test_clients.append(test_client)
         return test_client
@@ -220,6 +372,211 @@ class TestChatSystem(unittest.TestCase):
         self.assertIn(client.username, self.get_server_clients_usernames())  # Client should still be connected
         self.assertIn(str(None), received_message[0])  # message should be 'None'
 
+    def test_unicode_message_broadcast(self):
+        client1 = self.create_test_client("Zoë")
+        client2 = self.create_test_client("Renée")
+        client1.start()
+        client2.start()
+        time.sleep(1)
+
+        client1.send_message("héllo wörld ✓")
+        time.sleep(1)
+
+        self.assertEqual(client2.received_messages[0], "Zoë: héllo wörld ✓")
+
+    def test_fragmented_and_batched_frames(self):
+        receiver = self.create_test_client("FragmentReceiver")
+        receiver.start()
+        sender = connect_raw_client("FragmentSender", self.port)
+        time.sleep(0.5)
+
+        try:
+            frame = encode_frame(b"split " * 1000)
+            for i in range(0, len(frame), 1500):
+                sender.sendall(frame[i:i + 1500])
+                time.sleep(0.05)
+            sender.sendall(encode_frame(b"first") + encode_frame(b"second"))
+            time.sleep(1)
+        finally:
+            sender.close()
+
+        self.assertEqual(receiver.received_messages, [
+            "FragmentSender: " + "split " * 1000,
+            "FragmentSender: first",
+            "FragmentSender: second",
+        ])
+
+    def test_oversized_frame_disconnects(self):
+        sender = connect_raw_client("Oversized", self.port)
+        try:
+            time.sleep(0.5)
+            self.assertIn("Oversized", self.get_server_clients_usernames())
+
+            sender.sendall(struct.pack('!I', 64 << 20) + b"x" * 1000)
+            sender.settimeout(5)
+            self.assertEqual(sender.recv(1), b'')
+            self.assertNotIn("Oversized", self.get_server_clients_usernames())
+        finally:
+            sender.close()
+
+    def test_rooms(self):
+        alice = self.create_test_client("RoomAlice")
+        bob = self.create_test_client("RoomBob")
+        carol = self.create_test_client("RoomCarol")
+        for client in (alice, bob, carol):
+            client.start()
+        time.sleep(0.5)
+
+        bob.join_room("dev")
+        carol.join_room("dev")
+        time.sleep(0.5)
+        bob.send_message("hi dev")
+        alice.send_message("hi lobby")
+        time.sleep(0.5)
+
+        self.assertCountEqual(carol.received_messages, ["[dev] RoomBob: hi dev", "RoomAlice: hi lobby"])
+        self.assertEqual(alice.received_messages, [])
+        self.assertEqual(bob.received_messages, ["RoomAlice: hi lobby"])
+
+        carol.leave_room("lobby")
+        time.sleep(0.5)
+        alice.send_message("anyone?")
+        time.sleep(0.5)
+
+        self.assertNotIn("RoomAlice: anyone?", carol.received_messages)
+        self.assertIn("RoomAlice: anyone?", bob.received_messages)
+
+    def test_invalid_utf8_does_not_disconnect_others(self):
+        alice = self.create_test_client("Utf8Alice")
+        alice.start()
+        raw_socket = connect_raw_client("Utf8Raw", self.port)
+        try:
+            time.sleep(0.3)
+            raw_socket.sendall(encode_frame(b'\xff\xfe bad'))
+            time.sleep(0.2)
+            send_raw_message(raw_socket, "still here")
+            time.sleep(0.3)
+        finally:
+            raw_socket.close()
+
+        self.assertEqual(alice.received_messages, ["Utf8Raw: \ufffd\ufffd bad", "Utf8Raw: still here"])
+        self.assertEqual(alice.reconnects, 0)
+
+    def test_control_prefix_usernames_are_rejected(self):
+        legacy = ChatClient("PrefixLegacy", port=self.port, test_mode=True, protocol=PROTOCOL_V1)
+        self.test_clients.append(legacy)
+        legacy.start()
+        spoofers = [connect_raw_client(name, self.port) for name in ("__RECONNECT__ 0", "__DM__ PrefixLegacy", "__x")]
+        try:
+            time.sleep(0.3)
+            for spoofer in spoofers:
+                try:
+                    send_raw_message(spoofer, "hello")
+                except OSError:
+                    pass
+            time.sleep(0.3)
+            for spoofer in spoofers:
+                spoofer.settimeout(1)
+                self.assertEqual(spoofer.recv(1), b'')  # closed by the server
+        finally:
+            for spoofer in spoofers:
+                spoofer.close()
+
+        self.assertEqual(legacy.received_messages, [])
+        self.assertEqual(legacy.reconnects, 0)
+        with self.assertRaises(ValueError):
+            ChatClient("__STREAM__ 1", port=self.port)
+
+    def test_direct_messages(self):
+        alice = self.create_test_client("DmAlice")
+        bob = self.create_test_client("DmBob")
+        carol = self.create_test_client("DmCarol")
+        ai_client = self.create_test_ai_client("DmAI")
+        for client in (alice, bob, carol, ai_client):
+            client.start()
+        time.sleep(0.5)
+
+        alice.send_direct("DmBob", "just for you")
+        alice.send_direct(["DmBob", "DmCarol", "DmNobody"], "for both of you")
+        bob.send_direct("DmAI", "hello bot")
+        time.sleep(0.5)
+
+        self.assertEqual(bob.received_messages, ["DmAlice: just for you", "DmAlice: for both of you",
+                                                 "DmAI: direct reply"])
+        self.assertTrue(all(message.direct for message in bob.received_messages))
+        self.assertEqual(carol.received_messages, ["DmAlice: for both of you"])
+        self.assertEqual(alice.received_messages, [])
+        self.assertEqual(ai_client.message_count, 0)
+        self.assertIn("DmBob", ai_client.direct_conversations)
+
+    def test_ai_client_answers_in_its_room(self):
+        user = self.create_test_client("RoomUser")
+        lobby_user = self.create_test_client("LobbyUser")
+        ai_client = AIClient("RoomAI", mode='lines', interval=2, api_key='', port=self.port, test_mode=True, rooms=["support"])
+        self.test_clients.append(ai_client)
+        user.start()
+        lobby_user.start()
+        ai_client.start()
+        time.sleep(0.5)
+
+        user.join_room("support")
+        time.sleep(0.2)
+        user.send_message("question one")
+        user.send_message("question two")
+        time.sleep(0.5)
+
+        self.assertEqual(user.received_messages, ["[support] RoomAI: related message by lines"])
+        self.assertEqual(lobby_user.received_messages, [])
+
+    def test_streamed_message_parts(self):
+        receiver = self.create_test_client("StreamReceiver")
+        receiver.start()
+        raw_receiver = connect_raw_client("StreamRawReceiver", self.port)
+        sender = self.create_test_client("StreamSender")
+        sender.start()
+        time.sleep(0.5)
+
+        try:
+            chunks = []
+            receiver.client.on_chunk(lambda sender_prefix, stream_id, text: chunks.append(text))
+            stream_id = sender.start_stream()
+            sender.send_chunk(stream_id, "Hel")
+            sender.send_chunk(stream_id, "lo ")
+            sender.send_message("in between")
+            sender.end_stream(stream_id, "wörld")
+            time.sleep(0.5)
+
+            self.assertEqual(receiver.received_messages, ["StreamSender: in between", "StreamSender: Hello wörld"])
+            self.assertEqual(chunks, ["Hel", "lo ", "wörld"])
+            raw_receiver.settimeout(5)
+            self.assertEqual([receive_raw_message(raw_receiver) for _ in range(4)], [
+                f"__STREAM__ {stream_id} StreamSender: Hel",
+                f"__STREAM__ {stream_id} StreamSender: lo ",
+                "StreamSender: in between",
+                f"__STREAM_END__ {stream_id} StreamSender: wörld",
+            ])
+        finally:
+            raw_receiver.close()
+
+    def test_send_many_coalesced(self):
+        client1 = self.create_test_client("BatchSender")
+        client2 = self.create_test_client("BatchReceiver")
+        client1.start()
+        client2.start()
+        time.sleep(1)
+
+        before = self.server.write_stats()
+        send_calls = client1.send_calls
+        messages = [f"batched {i}" for i in range(50)]
+        client1.send_many(messages)
+        time.sleep(1)
+        after = self.server.write_stats()
+
+        self.assertEqual(client1.send_calls - send_calls, 1)
+        self.assertEqual(client2.received_messages, [f"BatchSender: {message}" for message in messages])
+        self.assertEqual(after["frames_written"] - before["frames_written"], 50)
+        self.assertLess(after["send_calls"] - before["send_calls"], 10)
+
     def test_concurrent_message_sending(self):
         clients = [self.create_test_client(f"User{i}") for i in range(5)]
         for client in clients:
@@ -376,5 +733,1890 @@ class TestChatSystem(unittest.TestCase):
         self.assertNotIn("Charlie: Is anyone still here?", bob.received_messages)
         self.assertNotIn("Alice: I'm back!", bob.received_messages)
 
+
+class TestSelectorChatSystem(TestChatSystem):
+    server_class = SelectorChatServer
+    port = 12347
+
+    def test_many_idle_clients(self):
+        # More connections than select() can watch (FD_SETSIZE is 1024); plain
+        # sockets keep the test process itself cheap
+        raw_sockets = []
+        try:
+            for i in range(1100):
+                raw_sockets.append(connect_raw_client(f"Idle{i}", self.port))
+            sender = connect_raw_client("Active1", self.port)
+            receiver = connect_raw_client("Active2", self.port)
+            raw_sockets += [sender, receiver]
+            time.sleep(1)
+
+            send_raw_message(sender, "still responsive")
+            receiver.settimeout(5)
+
+            self.assertIn("Idle1099", self.get_server_clients_usernames())
+            self.assertEqual(receive_raw_message(receiver), "Active1: still responsive")
+        finally:
+            for raw_socket in raw_sockets:
+                raw_socket.close()
+            time.sleep(1)
+
+
+class TestAsyncChatClient(unittest.TestCase):
+    port = 12353
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = start_server(SelectorChatServer, cls.port)
+
+    @classmethod
+    def tearDownClass(cls):
+        stop_server(cls.server, cls.port)
+
+    def test_callbacks_and_async_iterator(self):
+        async def scenario():
+            alice = AsyncChatClient("AsyncAlice", port=self.port)
+            bob = AsyncChatClient("AsyncBob", port=self.port)
+            seen = []
+            bob.on_message(seen.append)
+            await alice.connect()
+            await bob.connect()
+            await asyncio.sleep(0.2)
+
+            alice.send_many(["one", "two"])
+            received = []
+            async for message in bob.messages():
+                received.append(message)
+                if len(received) == 2:
+                    break
+            alice.close()
+            bob.close()
+            await bob.wait_closed()
+            return received, seen
+
+        received, seen = asyncio.run(asyncio.wait_for(scenario(), 5))
+        self.assertEqual(received, ["AsyncAlice: one", "AsyncAlice: two"])
+        self.assertEqual(seen, received)
+
+    def test_timers_run_on_the_loop(self):
+        async def scenario():
+            client = AsyncChatClient("AsyncTimer", port=self.port)
+            await client.connect()
+            ticks = []
+            began = client.loop.time()
+            timer = client.call_every(0.05, lambda: ticks.append(client.loop.time() - began))
+            await asyncio.sleep(0.28)
+            timer.cancel()
+            client.close()
+            return ticks
+
+        ticks = asyncio.run(scenario())
+        self.assertEqual(len(ticks), 5)
+        self.assertLess(ticks[0], 0.1)
+
+    def test_sync_clients_share_one_loop(self):
+        clients = [ChatClient(f"SharedLoop{i}", port=self.port, test_mode=True) for i in range(3)]
+        try:
+            for client in clients:
+                client.start()
+            self.assertEqual(len({client.loop_thread for client in clients}), 1)
+            time.sleep(0.2)
+            clients[0].send_message("hello")
+            time.sleep(0.3)
+            self.assertEqual(clients[1].received_messages, ["SharedLoop0: hello"])
+            self.assertEqual(clients[2].received_messages, ["SharedLoop0: hello"])
+        finally:
+            for client in clients:
+                client.close()
+
+    def test_v1_and_v2_clients_interoperate(self):
+        async def scenario():
+            new = AsyncChatClient("V2Client", port=self.port)
+            old = AsyncChatClient("V1Client", port=self.port, protocol=PROTOCOL_V1)
+            received = {new: [], old: []}
+            new.on_message(received[new].append)
+            old.on_message(received[old].append)
+            await new.connect()
+            await old.connect()
+            await asyncio.sleep(0.2)
+            new.send_message("from v2")
+            old.send_message("from v1")
+            await asyncio.sleep(0.3)
+            new.close()
+            old.close()
+            return new, old, received[old], received[new]
+
+        new, old, (from_v2,), (from_v1,) = asyncio.run(asyncio.wait_for(scenario(), 5))
+        self.assertEqual((new.version, old.version), (PROTOCOL_V2, PROTOCOL_V1))
+        self.assertIsNotNone(new.sender_id)
+        self.assertEqual(from_v2, "V2Client: from v2")
+        self.assertIsNone(from_v2.timestamp)
+        self.assertEqual(from_v1, "V1Client: from v1")
+        self.assertNotEqual(from_v1.sender_id, new.sender_id)
+        self.assertGreaterEqual(from_v1.latency(), 0)
+        self.assertLess(from_v1.latency(), 5)
+
+    def test_large_messages_arrive_compressed(self):
+        async def scenario():
+            sender = AsyncChatClient("ZipSender", port=self.port)
+            receiver = AsyncChatClient("ZipReceiver", port=self.port)
+            received = []
+            receiver.on_message(received.append)
+            await sender.connect()
+            await receiver.connect()
+            await asyncio.sleep(0.2)
+            sender.send_message("long " * 1000)
+            await asyncio.sleep(0.3)
+            sender.close()
+            receiver.close()
+            return receiver, received
+
+        before = self.server.compression_stats()["compressed_deliveries"]
+        receiver, received = asyncio.run(asyncio.wait_for(scenario(), 5))
+        self.assertEqual(receiver.codec, next(iter(CODECS)))
+        self.assertEqual(received, ["ZipSender: " + "long " * 1000])
+        self.assertGreater(self.server.compression_stats()["compressed_deliveries"], before)
+
+    def test_falls_back_to_v1_without_a_hello(self):
+        # A server that never answers the v2 offer, like one from before v2
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('localhost', 12356))
+        listener.listen(2)
+        listener.settimeout(5)
+
+        async def scenario():
+            client = AsyncChatClient("OldServerUser", port=12356)
+            await client.connect()
+            client.close()
+            return client
+
+        try:
+            client = asyncio.run(asyncio.wait_for(scenario(), 5))
+            self.assertEqual(client.version, PROTOCOL_V1)
+            offers = [receive_raw_message(listener.accept()[0]) for _ in range(2)]
+            self.assertEqual(offers, [str(hello_offer(b"OldServerUser", CODECS), 'utf-8'), "OldServerUser"])
+        finally:
+            listener.close()
+
+
+class TestProtocol(unittest.TestCase):
+
+    def test_v2_round_trip(self):
+        frame = encode_v2(TEXT, 'héllo'.encode('utf-8'), message_id=7, sender_id=3, timestamp=123, flags=1)
+        self.assertEqual(struct.unpack('!I', frame[:4])[0], len(frame) - 4)
+        kind, flags, message_id, sender_id, timestamp, payload = decode_v2(frame[4:])
+        self.assertEqual((kind, flags, message_id, sender_id, timestamp), (TEXT, 1, 7, 3, 123))
+        self.assertEqual(str(payload, 'utf-8'), 'héllo')
+
+    def test_v1_round_trip(self):
+        for kind, payload, message_id in [(TEXT, b'hi', 0), (JOIN, b'dev', 0), (protocol.DISCONNECT, b'', 0),
+                                          (STREAM, b'a: part', 12), (STREAM_END, b'', 12)]:
+            frame = encode_v1(kind, payload, message_id)
+            decoded_kind, decoded_id, decoded = decode_v1(frame[4:])
+            self.assertEqual((decoded_kind, decoded_id, bytes(decoded)), (kind, message_id, payload))
+
+    def test_v1_stream_without_an_id_is_text(self):
+        self.assertEqual(decode_v1(b'__STREAM__ x hi')[0], TEXT)
+
+    def test_hello_offer(self):
+        self.assertEqual(parse_hello(hello_offer(b'Ann', ['zlib', 'brotli'])), (PROTOCOL_V2, ['zlib'], b'Ann'))
+        self.assertEqual(parse_hello(hello_offer(b'Ann')), (PROTOCOL_V2, [], b'Ann'))
+        self.assertEqual(parse_hello(b'Ann'), (PROTOCOL_V1, [], b'Ann'))
+
+    def test_compressed_round_trip(self):
+        text = b'Bot: ' + b'all work and no play ' * 100
+        frame = encode_v2(TEXT, text, 4, 2, 99)
+        compressed = compress_v2(frame, 'zlib')
+        self.assertLess(len(compressed), len(frame) // 4)
+        kind, flags, message_id, sender_id, timestamp, payload = decode_v2(compressed[4:])
+        self.assertEqual((kind, flags, message_id, sender_id, timestamp), (TEXT, FLAG_ZLIB, 4, 2, 99))
+        self.assertEqual(decompress_payload(flags, payload, len(text)), text)
+        with self.assertRaises(CompressionError):
+            decompress_payload(flags, payload, len(text) - 1)
+        self.assertIsNone(compress_v2(encode_v2(TEXT, os.urandom(64)), 'zlib'))
+
+    def test_v2_to_v1(self):
+        self.assertEqual(v2_to_v1(encode_v2(TEXT, b'Ann: hi', 5)), encode_frame(b'Ann: hi'))
+        self.assertEqual(v2_to_v1(encode_v2(STREAM, b'Ann: hi', 5)), encode_frame(b'__STREAM__ 5 Ann: hi'))
+        self.assertIsNone(v2_to_v1(encode_v2(JOIN, b'dev')))
+        self.assertEqual(v2_to_v1(encode_v2(protocol.DIRECT, b'Ann: psst')), encode_frame(b'__DM__ Ann: psst'))
+
+    def test_direct_message(self):
+        request = direct_message(['Ann', 'Bo'], 'meet at noon').encode('utf-8')
+        self.assertEqual(parse_direct(request), ([b'Ann', b'Bo'], b'meet at noon'))
+        self.assertEqual(decode_v1(encode_v1(protocol.DIRECT, request)[4:])[0], protocol.DIRECT)
+        self.assertIsNone(parse_direct(b'Ann'))
+        self.assertIsNone(parse_direct(b', hi'))
+
+
+class TestConversationHistory(unittest.TestCase):
+
+    def test_bounded_by_message_count(self):
+        history = ConversationHistory(max_messages=3, max_tokens=1000)
+        for i in range(10):
+            history.append(f"message {i}")
+
+        self.assertEqual(list(history), ["message 7", "message 8", "message 9"])
+        self.assertEqual(history.evicted_messages, 7)
+        self.assertEqual(history.tokens, sum(estimate_tokens(m) for m in history))
+
+    def test_bounded_by_token_budget(self):
+        history = ConversationHistory(max_messages=100, max_tokens=30)
+        for i in range(10):
+            history.append(f"{i}" * 40)  # 11 tokens each
+
+        self.assertEqual(len(history), 2)
+        self.assertLessEqual(history.tokens, 30)
+        history.append("x" * 400)
+        self.assertEqual(list(history), ["x" * 400])
+
+    def test_recent_window(self):
+        history = ConversationHistory()
+        for i in range(5):
+            history.append(f"message {i}")
+
+        self.assertEqual(history.recent(2), ["message 3", "message 4"])
+        self.assertEqual(history.recent(10), [f"message {i}" for i in range(5)])
+
+    def test_evicted_kept_for_summarization(self):
+        history = ConversationHistory(max_messages=3, keep_evicted=True)
+        for i in range(5):
+            history.append(f"message {i}")
+
+        self.assertEqual(history.take_evicted(), ["message 0", "message 1"])
+        for i in range(5, 12):
+            history.append(f"message {i}")
+        # Unsummarized messages are bounded too, the oldest go first
+        self.assertEqual(history.take_evicted(), ["message 6", "message 7", "message 8"])
+        self.assertEqual(history.take_evicted(), [])
+        self.assertIsNone(ConversationHistory(max_messages=1).evicted)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def caches(self, clock, **kwargs):
+        return [MemoryCache(clock=clock, **kwargs),
+                SqliteCache(os.path.join(self.temp_dir, f'cache{len(os.listdir(self.temp_dir))}.db'), clock=clock, **kwargs)]
+
+    def test_prompt_key_normalizes_whitespace(self):
+        self.assertEqual(prompt_key("m", "hello  there\n", "go", 0), prompt_key("m", "hello there", " go ", 0))
+        self.assertNotEqual(prompt_key("m", "hello", "go", 0), prompt_key("m", "hello", "go", 0.5))
+        self.assertNotEqual(prompt_key("m", "hello", "go", 0), prompt_key("other", "hello", "go", 0))
+
+    def test_lru_eviction(self):
+        clock = FakeClock()
+        for cache in self.caches(clock, max_entries=2):
+            cache.put("a", "1")
+            clock.now += 1
+            cache.put("b", "2")
+            clock.now += 1
+            self.assertEqual(cache.get("a"), "1")  # b is now least recently used
+            clock.now += 1
+            cache.put("c", "3")
+
+            self.assertIsNone(cache.get("b"))
+            self.assertEqual(cache.get("a"), "1")
+            self.assertEqual(cache.get("c"), "3")
+            self.assertEqual(cache.stats()["evictions"], 1)
+            self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+    def test_ttl_expiry(self):
+        clock = FakeClock()
+        for cache in self.caches(clock, ttl=10):
+            cache.put("a", "1")
+            clock.now += 9
+            self.assertEqual(cache.get("a"), "1")
+            clock.now += 2
+            self.assertIsNone(cache.get("a"))
+            self.assertEqual(cache.stats()["expirations"], 1)
+            self.assertEqual(len(cache), 0)
+
+    def test_sqlite_cache_survives_reopening(self):
+        path = os.path.join(self.temp_dir, 'shared.db')
+        cache = SqliteCache(path)
+        cache.put("a", "persisted")
+        cache.close()
+
+        self.assertEqual(SqliteCache(path).get("a"), "persisted")
+
+    def test_sqlite_cache_works_off_the_loop(self):
+        cache = SqliteCache(os.path.join(self.temp_dir, 'threads.db'), max_entries=2)
+        threads = []
+        lookup = cache.lookup
+        cache.lookup = lambda key: threads.append(threading.current_thread()) or lookup(key)
+
+        async def scenario():
+            await cache.store("a", "1")
+            await cache.store("a", "2")  # replaced, still one entry
+            await cache.store("b", "3")
+            await cache.store("c", "4")
+            return await cache.fetch("a"), await cache.fetch("c")
+
+        try:
+            self.assertEqual(asyncio.run(scenario()), (None, "4"))
+            self.assertEqual([thread.name.startswith('response-cache') for thread in threads], [True, True])
+            self.assertEqual((cache.count, len(cache), cache.evictions), (2, 2, 1))
+            self.assertEqual(cache.db.execute("PRAGMA synchronous").fetchone()[0], 1)  # NORMAL
+        finally:
+            cache.close()
+
+
+class TestAIClientModelCalls(unittest.TestCase):
+    port = 12354
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = start_server(SelectorChatServer, cls.port)
+
+    @classmethod
+    def tearDownClass(cls):
+        stop_server(cls.server, cls.port)
+
+    def setUp(self):
+        self.clients = []
+        self.completions = FakeCompletionServer(delay=0.5)
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.completions.stop()
+
+    def start_clients(self, interval, **kwargs):
+        user = ChatClient("ModelUser", port=self.port, test_mode=True)
+        ai_client = AIClient("ModelAI", mode='lines', interval=interval, api_key='sk-fake', port=self.port,
+                             base_url=self.completions.base_url, **kwargs)
+        self.clients += [user, ai_client]
+        user.start()
+        ai_client.start()
+        time.sleep(0.3)
+        return user, ai_client
+
+    def test_messages_are_read_while_a_call_is_pending(self):
+        user, ai_client = self.start_clients(interval=2)
+        user.send_message("one")
+        user.send_message("two")
+        time.sleep(0.2)
+        user.send_message("three")
+        time.sleep(0.1)
+
+        self.assertEqual(ai_client.message_count, 3)
+        self.assertEqual(user.received_messages, [])
+        time.sleep(0.6)
+        self.assertEqual(user.received_messages, ["ModelAI: fake reply"])
+
+    def test_direct_message_is_answered_privately(self):
+        user, ai_client = self.start_clients(interval=1)
+        user.send_direct("ModelAI", "are you there?")
+        time.sleep(0.8)
+
+        self.assertEqual(user.received_messages, ["ModelAI: fake reply"])
+        self.assertTrue(user.received_messages[0].direct)
+        self.assertEqual(ai_client.message_count, 0)
+        self.assertIn("are you there?", self.completions.requests[0]["messages"][0]["content"])
+
+    def test_triggers_during_a_call_are_coalesced(self):
+        user, ai_client = self.start_clients(interval=1)
+        for i in range(5):
+            user.send_message(f"message {i}")
+        time.sleep(1.5)
+
+        self.assertEqual(len(self.completions.requests), 2)
+        self.assertEqual(ai_client.coalesced_triggers, 4)
+        self.assertEqual(user.received_messages, ["ModelAI: fake reply"] * 2)
+        self.assertIn("message 4", self.completions.requests[1]["messages"][0]["content"])
+
+    def test_evicted_messages_are_summarized(self):
+        self.completions.reply = "they said hello"
+        self.completions.delay = 0
+        user, ai_client = self.start_clients(interval=100, history_messages=2, summarize=True)
+        for i in range(4):
+            user.send_message(f"hello {i}")
+        time.sleep(0.5)
+
+        history = ai_client.conversation_history
+        self.assertEqual(list(history), ["ModelUser: hello 2", "ModelUser: hello 3"])
+        self.assertEqual(history.summary, "they said hello")
+        prompts = '\n'.join(request["messages"][0]["content"] for request in self.completions.requests)
+        self.assertIn("ModelUser: hello 0", prompts)
+        self.assertIn("ModelUser: hello 1", prompts)
+        self.assertEqual(history.take_evicted(), [])
+
+    def test_identical_prompts_are_served_from_the_cache(self):
+        self.completions.delay = 0
+        cache = MemoryCache()
+        user, ai_client = self.start_clients(interval=1, cache=cache)
+        for _ in range(3):
+            user.send_message("hello")
+            time.sleep(0.3)
+        user.send_message("something new")
+        time.sleep(0.3)
+
+        self.assertEqual(len(self.completions.requests), 2)
+        self.assertEqual(len(user.received_messages), 4)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+    def test_streamed_reply_arrives_in_parts(self):
+        self.completions.reply = "one two three"
+        self.completions.delay = 0
+        user, ai_client = self.start_clients(interval=1, stream=True)
+        chunks = []
+        user.client.on_chunk(lambda sender, stream_id, text: chunks.append((time.monotonic(), text)))
+        user.send_message("tell me something")
+        time.sleep(1)
+
+        self.assertTrue(self.completions.requests[0]["stream"])
+        self.assertEqual(user.received_messages, ["ModelAI: one two three"])
+        self.assertEqual([text for _, text in chunks], ["one ", "two ", "three", ""])
+        # The first words were relayed before the model had finished
+        self.assertGreater(chunks[-1][0] - chunks[0][0], 0.15)
+
+    def test_backoff_does_not_block_the_loop(self):
+        attempts = []
+
+        @retry(retry_count=2, initial_delay=0.2)
+        async def flaky():
+            attempts.append(time.monotonic())
+            if len(attempts) == 1:
+                raise ConnectionError("model unavailable")
+            return "ok"
+
+        async def scenario():
+            ticks = 0
+            call = asyncio.ensure_future(flaky())
+            while not call.done():
+                ticks += 1
+                await asyncio.sleep(0.01)
+            return call.result(), ticks
+
+        result, ticks = asyncio.run(scenario())
+        self.assertEqual(result, "ok")
+        self.assertEqual(len(attempts), 2)
+        self.assertGreater(ticks, 10)
+
+    def test_backoff_frees_the_model_slot(self):
+        failed = []
+
+        def reply(messages):
+            if messages[0]["content"] == "flaky" and not failed:
+                failed.append(True)
+                raise ConnectionError("model unavailable")
+            return "ok"
+
+        backend = StubBackend(reply)
+        slots = asyncio.Semaphore(1)
+        flaky = AIClient("FlakyAI", "lines", 2, "", test_mode=True, model_backend=backend, call_slots=slots)
+        steady = AIClient("SteadyAI", "lines", 2, "", test_mode=True, model_backend=backend, call_slots=slots)
+
+        async def scenario():
+            retrying = asyncio.ensure_future(flaky.run_calls('reply', lambda: flaky.call_open_ai_api("flaky", "hi")))
+            await asyncio.sleep(0.1)  # the first attempt failed and the retry waits 20 seconds
+            await asyncio.wait_for(steady.run_calls('reply', lambda: steady.call_open_ai_api("steady", "hi")), 1)
+            retrying.cancel()
+
+        asyncio.run(scenario())
+        self.assertEqual([request["messages"][0]["content"] for request in backend.requests], ["flaky", "steady"])
+
+
+class TestBotHost(unittest.TestCase):
+    port = 12375
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = start_server(SelectorChatServer, cls.port)
+
+    @classmethod
+    def tearDownClass(cls):
+        stop_server(cls.server, cls.port)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.user = ChatClient("HostUser", port=self.port, test_mode=True)
+        self.user.start()
+
+    def tearDown(self):
+        self.user.close()
+        shutil.rmtree(self.directory)
+
+    def write_config(self, config):
+        path = os.path.join(self.directory, 'bots.json')
+        with open(path, 'w', encoding='utf-8') as config_file:
+            json.dump(config, config_file)
+        return path
+
+    def test_time_bots_share_one_scheduler(self):
+        personas = [{"name": f"Timed{i}", "mode": "time", "interval": 0.5} for i in range(20)]
+        host = BotHost(personas, port=self.port, api_key='sk-fake', test_mode=True)
+        try:
+            host.start()
+            time.sleep(1.2)
+            self.assertEqual(len(host.scheduler), 20)
+            posts = [message.partition(':')[0] for message in self.user.received_messages]
+            for i in range(20):
+                self.assertGreaterEqual(posts.count(f"Timed{i}"), 2)
+        finally:
+            host.close()
+        self.assertIsNone(host.scheduler.timer)
+
+    def test_personas_from_config_share_the_model_backend(self):
+        completions = FakeCompletionServer()
+        path = self.write_config({"port": self.port, "base_url": completions.base_url, "max_in_flight": 2, "bots": [
+            {"name": "Pirate", "interval": 2, "persona": "You talk like a pirate."},
+            {"name": "Poet", "interval": 2, "persona": "You answer in rhymes."},
+        ]})
+        host = BotHost.from_config(path, 'sk-fake')
+        try:
+            host.start()
+            time.sleep(0.3)
+            self.user.send_message("hello bots")
+            self.user.send_message("anyone here?")
+            time.sleep(1)
+
+            self.assertCountEqual(self.user.received_messages, ["Pirate: fake reply", "Poet: fake reply"])
+            self.assertIs(host.bots[0].model_backend, host.bots[1].model_backend)
+            self.assertIs(host.bots[0].model_slots, host.call_slots)
+            prompts = sorted(request["messages"][0]["content"] for request in completions.requests)
+            self.assertTrue(prompts[0].startswith("You answer in rhymes."))
+            self.assertTrue(prompts[1].startswith("You talk like a pirate."))
+            self.assertEqual(host.stats()["model_requests"], 2)
+        finally:
+            host.close()
+            completions.stop()
+
+    def test_unknown_persona_settings_are_rejected(self):
+        path = self.write_config({"bots": [{"name": "Typo", "intervall": 3}]})
+        with self.assertRaises(ValueError):
+            load_personas(path)
+
+
+class TestModelGateway(unittest.TestCase):
+    port = 12355
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = start_server(SelectorChatServer, cls.port)
+
+    @classmethod
+    def tearDownClass(cls):
+        stop_server(cls.server, cls.port)
+
+    def setUp(self):
+        self.gateway_dir = tempfile.mkdtemp()
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        shutil.rmtree(self.gateway_dir, ignore_errors=True)
+
+    def start_gateway(self, backend, **kwargs):
+        gateway = ModelGateway(backend, os.path.join(self.gateway_dir, 'gateway.sock'), **kwargs)
+        threading.Thread(target=gateway.run, daemon=True).start()
+        self.assertTrue(gateway.wait_ready())
+        self.addCleanup(gateway.stop)
+        return gateway
+
+    def run_requests(self, gateway, prompts, temperature=0):
+        async def scenario():
+            client = GatewayClient(gateway.path)
+            began = time.monotonic()
+            replies = await asyncio.gather(*[
+                client.complete("stub-model", [{"role": "user", "content": prompt}], temperature)
+                for prompt in prompts])
+            client.close()
+            return replies, time.monotonic() - began
+
+        return asyncio.run(scenario())
+
+    def test_replies_reach_the_right_caller(self):
+        gateway = self.start_gateway(StubBackend(reply=lambda messages: messages[-1]["content"].upper(), delay=0.1))
+        prompts = [f"prompt {i}" for i in range(10)]
+        replies, _ = self.run_requests(gateway, prompts)
+
+        self.assertEqual(replies, [prompt.upper() for prompt in prompts])
+        self.assertEqual(gateway.stats()["backend_calls"], 10)
+
+    def test_concurrency_cap(self):
+        backend = StubBackend(delay=0.2)
+        gateway = self.start_gateway(backend, max_concurrency=2)
+        _, elapsed = self.run_requests(gateway, [f"prompt {i}" for i in range(6)])
+
+        self.assertEqual(backend.max_active, 2)
+        self.assertGreaterEqual(elapsed, 0.55)
+
+    def test_rate_limit(self):
+        gateway = self.start_gateway(StubBackend(), rate=5, burst=1)
+        _, elapsed = self.run_requests(gateway, [f"prompt {i}" for i in range(3)], temperature=0.7)
+        self.assertGreaterEqual(elapsed, 0.35)
+
+    def test_identical_requests_from_many_bots_share_one_call(self):
+        backend = StubBackend(delay=0.3)
+        gateway = self.start_gateway(backend)
+        user = ChatClient("GatewayUser", port=self.port, test_mode=True)
+        # interval 3: the bots' replies to each other must not trigger another call
+        bots = [AIClient(f"GatewayBot{i}", mode='lines', interval=3, api_key='', port=self.port, gateway=gateway.path)
+                for i in range(3)]
+        self.clients += [user] + bots
+        for client in self.clients:
+            client.start()
+        time.sleep(0.3)
+
+        for message in ("hello", "anyone here?", "bots?"):
+            user.send_message(message)
+        time.sleep(1)
+
+        self.assertEqual(len(backend.requests), 1)
+        self.assertEqual(gateway.stats()["deduplicated"], 2)
+        self.assertEqual(sorted(user.received_messages), [f"GatewayBot{i}: stub reply" for i in range(3)])
+
+
+class TestMessageLog(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def frame(self, text, message_id=0):
+        return encode_v2(TEXT, text.encode('utf-8'), message_id)
+
+    def test_last_and_since_by_room(self):
+        log = MessageLog(self.directory)
+        try:
+            for i in range(6):
+                log.append(b'lobby' if i % 2 else b'dev', self.frame(f"m{i}", i))
+            self.assertEqual(os.path.getsize(log.segments[0].path), 0)  # nothing written before flush
+            self.assertEqual([decode_v2(frame[4:])[2] for frame in log.last(b'lobby', 2)], [3, 5])
+            self.assertEqual([bytes(decode_v2(frame[4:])[5]) for frame in log.since(b'dev', 1, 10)], [b'm2', b'm4'])
+            self.assertEqual(log.last(b'dev', 0), [])
+            self.assertEqual(log.last(b'nowhere', 5), [])
+            # A byte budget keeps the newest messages that fit, or the first after an id
+            size = len(log.last(b'lobby', 1)[0])
+            self.assertEqual([decode_v2(frame[4:])[2] for frame in log.last(b'lobby', 3, size * 2)], [3, 5])
+            self.assertEqual([decode_v2(frame[4:])[2] for frame in log.since(b'lobby', 0, 10, size * 2 - 1)], [1])
+        finally:
+            log.close()
+
+    def test_reopen_rebuilds_index_and_drops_torn_record(self):
+        log = MessageLog(self.directory)
+        for i in range(3):
+            log.append(b'lobby', self.frame(f"m{i}"))
+        log.close()
+        with open(log.segments[0].path, 'ab') as segment:
+            segment.write(b'\x00\x00\x00')  # a record cut short by a crash
+
+        log = MessageLog(self.directory)
+        try:
+            self.assertEqual(len(log), 3)
+            self.assertEqual(log.next_id, 4)
+            self.assertEqual(log.append(b'lobby', self.frame("m3")), 4)
+            self.assertEqual([bytes(decode_v2(frame[4:])[5]) for frame in log.last(b'lobby', 10)],
+                             [b'm0', b'm1', b'm2', b'm3'])
+        finally:
+            log.close()
+
+    def test_segments_roll_and_oldest_are_dropped(self):
+        log = MessageLog(self.directory, segment_bytes=200, max_segments=2)
+        try:
+            for i in range(20):
+                log.append(b'lobby', self.frame("x" * 50))
+                log.flush()
+            self.assertEqual(len(log.segments), 2)
+            self.assertEqual(len([name for name in os.listdir(self.directory) if name.endswith('.log')]), 2)
+            kept = log.last(b'lobby', 100)
+            self.assertEqual(len(kept), len(log))
+            self.assertLess(len(kept), 20)
+        finally:
+            log.close()
+
+
+class TestMessageHistory(unittest.TestCase):
+    port = 12357
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = start_server(SelectorChatServer, self.port, message_log=MessageLog(self.directory))
+        self.clients = []
+        time.sleep(0.2)
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        stop_server(self.server, self.port)
+        time.sleep(0.2)
+        shutil.rmtree(self.directory)
+
+    def start_client(self, username, cls=ChatClient, **kwargs):
+        client = cls(username, port=self.port, test_mode=True, **kwargs)
+        self.clients.append(client)
+        client.start()
+        return client
+
+    def test_late_joiner_asks_for_the_last_messages(self):
+        early = self.start_client("Early")
+        for i in range(5):
+            early.send_message(f"m{i}")
+        time.sleep(0.2)
+
+        late = self.start_client("Late")
+        late.request_history(last=3)
+        time.sleep(0.3)
+        self.assertEqual(late.received_messages, ["Early: m2", "Early: m3", "Early: m4"])
+        self.assertTrue(all(message.replayed for message in late.received_messages))
+        last_seen = late.client.last_message_id
+
+        early.send_message("m5")
+        time.sleep(0.2)
+        late.request_history(since=last_seen)
+        time.sleep(0.3)
+        self.assertEqual(late.received_messages[3:], ["Early: m5", "Early: m5"])
+        self.assertEqual([message.replayed for message in late.received_messages[3:]], [False, True])
+
+    def test_streamed_message_is_logged_whole(self):
+        early = self.start_client("Early")
+        early.send_message("before")
+        stream_id = early.start_stream()
+        for word in ("one ", "two ", "three ", "four ", "five ", "six ", "seven ", "eight "):
+            early.send_chunk(stream_id, word)
+        early.end_stream(stream_id, "end")
+        early.send_message("after")
+        time.sleep(0.2)
+
+        late = self.start_client("Late")
+        late.request_history(last=3)
+        time.sleep(0.3)
+        self.assertEqual(late.received_messages, ["Early: before", "Early: one two three four five six seven eight end",
+                                                  "Early: after"])
+        self.assertEqual(len(self.server.message_log), 3)
+
+    def test_failed_replay_is_skipped(self):
+        early = self.start_client("Early")
+        early.send_message("poison")
+        early.send_message("after")
+        time.sleep(0.2)
+
+        def fail_on_poison(message):
+            if message.endswith("poison"):
+                raise ValueError("cannot handle this one")
+
+        late = self.start_client("Late")
+        late.client.on_message(fail_on_poison)
+        late.request_history(last=2)
+        time.sleep(0.3)
+        self.assertEqual(late.received_messages, ["Early: poison", "Early: after"])
+        self.assertEqual(late.reconnects, 0)
+        self.assertEqual(late.client.last_message_id, late.received_messages[-1].message_id)
+
+    def test_history_fits_in_one_frame(self):
+        stop_server(self.server, self.port)
+        time.sleep(0.2)
+        self.server = start_server(SelectorChatServer, self.port, message_log=MessageLog(os.path.join(self.directory, 'small')),
+                                   max_frame_size=200)
+        time.sleep(0.2)
+        early = self.start_client("Early")
+        for i in range(8):
+            early.send_message(f"m{i}")
+        time.sleep(0.2)
+
+        late = self.start_client("Late")
+        late.request_history(last=8)
+        time.sleep(0.3)
+        # Each logged frame takes 31 bytes and the reply may carry 200 - 18
+        self.assertEqual(late.received_messages, [f"Early: m{i}" for i in range(3, 8)])
+        self.assertEqual(late.reconnects, 0)
+
+    def test_v1_client_gets_plain_frames(self):
+        early = self.start_client("EarlyV1")
+        early.join_room("dev")
+        early.send_message("in dev")
+        time.sleep(0.2)
+
+        raw_client = connect_raw_client("RawHistory", self.port)
+        try:
+            send_raw_message(raw_client, "__HISTORY__ last 5 dev")  # not a member yet, ignored
+            send_raw_message(raw_client, "__JOIN__ dev")
+            send_raw_message(raw_client, "__HISTORY__ last 5")
+            raw_client.settimeout(5)
+            self.assertEqual(receive_raw_message(raw_client), "[dev] EarlyV1: in dev")
+        finally:
+            raw_client.close()
+
+    def test_bot_loads_context_without_replying(self):
+        user = self.start_client("Talker")
+        for i in range(4):
+            user.send_message(f"earlier {i}")
+        time.sleep(0.2)
+
+        bot = self.start_client("Restarted", AIClient, mode='lines', interval=2, api_key='', replay_history=3)
+        time.sleep(0.3)
+        self.assertEqual(list(bot.conversation_history), ["Talker: earlier 1", "Talker: earlier 2", "Talker: earlier 3"])
+        self.assertEqual(bot.message_count, 0)
+        self.assertEqual(user.received_messages, [])
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_render(self):
+        registry = MetricsRegistry()
+        counter = registry.counter('demo_total', "Things")
+        registry.gauge('demo_live', "Live things", lambda: 3)
+        histogram = registry.histogram('demo_size', "Sizes", (1, 10))
+        counter.inc()
+        counter.inc(2)
+        for value in (1, 5, 50):
+            histogram.observe(value)
+
+        self.assertEqual(registry.render().splitlines(), [
+            "# HELP demo_total Things", "# TYPE demo_total counter", "demo_total 3",
+            "# HELP demo_live Live things", "# TYPE demo_live gauge", "demo_live 3",
+            "# HELP demo_size Sizes", "# TYPE demo_size histogram",
+            'demo_size_bucket{le="1"} 1', 'demo_size_bucket{le="10"} 2', 'demo_size_bucket{le="+Inf"} 3',
+            "demo_size_sum 56", "demo_size_count 3",
+        ])
+        with self.assertRaises(ValueError):
+            registry.counter('demo_total', "Again")
+
+    def test_scrape_skips_a_released_connection(self):
+        # What the metrics thread sees when the loop releases a client mid-scrape
+        server = SelectorChatServer(port=12359)
+        client_socket = socket.socket()
+        try:
+            connection = Connection(client_socket, ('127.0.0.1', 1), FrameDecoder())
+            connection.logged_in = True
+            server.connections.add(connection)
+            values = server.metrics.values()
+            self.assertEqual((values['chat_outbound_queued_bytes'], values['chat_outbound_queued_bytes_max']), (0, 0))
+            self.assertEqual(server.outbound_stats(), [])
+            self.assertEqual(server.memory_stats()["connections"], 1)
+        finally:
+            client_socket.close()
+            server.server_socket.close()
+
+    def test_server_metrics_endpoint(self):
+        port = 12358
+        server = start_server(SelectorChatServer, port)
+        endpoint = MetricsServer(server.metrics, port=0).start()
+        clients = [ChatClient(f"Metered{i}", port=port, test_mode=True) for i in range(3)]
+        try:
+            for client in clients:
+                client.start()
+            time.sleep(0.2)
+            clients[0].send_message("counted")
+            time.sleep(0.2)
+
+            with urllib.request.urlopen(f"http://localhost:{endpoint.port}/metrics", timeout=5) as response:
+                text = response.read().decode('utf-8')
+            values = dict(line.rsplit(' ', 1) for line in text.splitlines() if not line.startswith('#'))
+            self.assertEqual(values['chat_clients'], '3')
+            self.assertEqual(values['chat_messages_received_total'], '1')
+            self.assertEqual(values['chat_messages_sent_total'], '2')
+            self.assertEqual(values['chat_fan_out_recipients_bucket{le="2"}'], '1')
+            self.assertGreater(int(values['chat_bytes_received_total']), 0)
+            self.assertGreater(int(values['chat_loop_iteration_seconds_count']), 0)
+        finally:
+            for client in clients:
+                client.close()
+            endpoint.stop()
+            stop_server(server, port)
+
+
+class TestLogging(unittest.TestCase):
+
+    def test_records_are_formatted_by_the_listener(self):
+        formatted_on = []
+
+        class RecordingFormatter(logging.Formatter):
+            def format(self, record):
+                formatted_on.append((threading.current_thread(), record.args, record.exc_info is not None))
+                return super().format(record)
+
+        chat_logger = logging.getLogger('chat')
+        handlers, level, propagate = list(chat_logger.handlers), chat_logger.level, chat_logger.propagate
+        listener = configure_logging()
+        listener.handlers[0].setFormatter(RecordingFormatter('%(message)s'))
+        listener.handlers[0].setStream(open(os.devnull, 'w'))
+        try:
+            try:
+                raise ValueError("broken")
+            except ValueError:
+                logging.getLogger('chat.test').exception("failed user=%s", 'Ann')
+        finally:
+            listener.stop()
+            listener.handlers[0].stream.close()
+            chat_logger.handlers, chat_logger.level, chat_logger.propagate = handlers, level, propagate
+        # Still unformatted when it reached the listener thread
+        [(thread, args, has_exc_info)] = formatted_on
+        self.assertIsNot(thread, threading.current_thread())
+        self.assertEqual((args, has_exc_info), (('Ann',), True))
+
+
+class TestTimerWheel(unittest.TestCase):
+
+    def test_items_expire_in_their_tick(self):
+        wheel = TimerWheel(tick=1, slots=4, now=0)
+        wheel.schedule('a', 2.5)
+        wheel.schedule('b', 1.2)
+        wheel.schedule('late', 9)  # more than a turn ahead
+        self.assertEqual(wheel.advance(0.9), [])
+        self.assertEqual(wheel.advance(2.0), ['b', 'a'])
+        self.assertEqual(wheel.advance(5), [])
+        self.assertEqual(len(wheel), 1)
+        self.assertEqual(wheel.advance(9), ['late'])
+
+    def test_past_due_goes_in_the_next_tick(self):
+        wheel = TimerWheel(tick=1, slots=4, now=10)
+        wheel.schedule('x', 3)
+        self.assertEqual(wheel.advance(11), ['x'])
+
+
+class TestRateLimit(unittest.TestCase):
+
+    def test_messages_refill_over_time(self):
+        limit = RateLimit(messages_per_second=2, message_burst=2)
+        bucket = limit.bucket(now=0)
+        for _ in range(2):
+            self.assertTrue(limit.admit(bucket, 0))
+            limit.spend(bucket, 10)
+        self.assertEqual(limit.spend(bucket, 10), 1.0)  # a third one went over and is owed
+        self.assertFalse(limit.admit(bucket, 0.9))
+        self.assertTrue(limit.admit(bucket, 1.1))
+
+    def test_big_message_passes_and_is_owed(self):
+        limit = RateLimit(bytes_per_second=100)
+        bucket = limit.bucket(now=0)
+        self.assertTrue(limit.admit(bucket, 0))
+        self.assertEqual(limit.spend(bucket, 300), 2.0)
+        self.assertFalse(limit.admit(bucket, 1.5))
+        self.assertTrue(limit.admit(bucket, 2.1))
+
+    def test_no_rate_is_no_limit(self):
+        self.assertFalse(RateLimit())
+        with self.assertRaises(ValueError):
+            RateLimit(messages_per_second=-1)
+
+
+class TestIdleClients(unittest.TestCase):
+    server_class = ChatServer
+    port = 12363
+
+    def setUp(self):
+        self.server = start_server(self.server_class, self.port, idle_timeout=0.4)
+        time.sleep(0.2)
+
+    def tearDown(self):
+        stop_server(self.server, self.port)
+        time.sleep(0.1)
+
+    def test_silent_clients_are_evicted(self):
+        client = ChatClient("Answers", port=self.port, test_mode=True)
+        client.start()
+        v1_socket = connect_raw_client("QuietV1", self.port)
+        never_logged_in = socket.create_connection(('localhost', self.port))
+        silent_v2 = socket.create_connection(('localhost', self.port))
+        silent_v2.sendall(encode_frame(hello_offer(b'SilentV2')))
+        silent_v2.settimeout(3)
+        try:
+            time.sleep(1.2)
+            self.assertEqual(sorted(connection.username for connection in self.server.clients), [b'Answers', b'QuietV1'])
+            self.assertEqual(self.server.idle_evictions, 2)
+            self.assertGreaterEqual(self.server.pings_sent, 2)
+            received = b''
+            while True:
+                chunk = silent_v2.recv(4096)  # until the server closes it
+                if not chunk:
+                    break
+                received += chunk
+            kinds = [decode_v2(frame[4:])[0] for frame in split_raw_frames(received)]
+            self.assertEqual(kinds[0], protocol.HELLO)
+            self.assertIn(PING, kinds)
+
+            time.sleep(0.6)
+            self.assertEqual(len(self.server.clients), 2)
+        finally:
+            client.close()
+            for raw_socket in (v1_socket, never_logged_in, silent_v2):
+                raw_socket.close()
+
+    def test_ping_is_answered(self):
+        raw_socket = socket.create_connection(('localhost', self.port))
+        raw_socket.sendall(encode_frame(hello_offer(b'Pinger')) + encode_v2(PING))
+        raw_socket.settimeout(3)
+        try:
+            received = b''
+            while len(split_raw_frames(received)) < 2:
+                received += raw_socket.recv(4096)
+            kinds = [decode_v2(frame[4:])[0] for frame in split_raw_frames(received)]
+            self.assertEqual(kinds[:2], [protocol.HELLO, PONG])
+        finally:
+            raw_socket.close()
+
+
+class TestSelectorIdleClients(TestIdleClients):
+    server_class = SelectorChatServer
+    port = 12364
+
+
+class TestFloodControl(unittest.TestCase):
+    server_class = ChatServer
+    port = 12373
+
+    def setUp(self):
+        self.server = None
+        self.sockets = []
+
+    def tearDown(self):
+        for raw_socket in self.sockets:
+            raw_socket.close()
+        self.receiver.close()
+        self.server.stop()
+        self.thread.join(2)
+
+    def start(self, **kwargs):
+        self.server = self.server_class(port=self.port, **kwargs)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.thread.start()
+        self.receiver = ChatClient("FloodReceiver", port=self.port, test_mode=True)
+        self.receiver.start()
+
+    def flood(self, username, count):
+        raw_socket = connect_raw_client(username, self.port)
+        self.sockets.append(raw_socket)
+        raw_socket.sendall(b''.join(encode_frame(b'%d' % i) for i in range(count)))  # arrives in one read
+        return raw_socket
+
+    def test_delay_spreads_a_burst(self):
+        self.start(client_limit=RateLimit(20, message_burst=5))
+        self.flood("Flooder", 20)
+        time.sleep(0.2)
+        self.assertLess(len(self.receiver.received_messages), 20)
+        self.assertEqual(len(self.server.throttled), 1)
+        time.sleep(1.2)
+        self.assertEqual(self.receiver.received_messages, [f"Flooder: {i}" for i in range(20)])
+        self.assertGreater(self.server.flood_delays.value, 0)
+        self.assertEqual(self.server.flood_drops.value, 0)
+
+    def test_drop(self):
+        self.start(client_limit=RateLimit(5, message_burst=5), flood_action=rate_limit.DROP)
+        self.flood("Flooder", 20)
+        time.sleep(0.3)
+        self.assertEqual(self.receiver.received_messages, [f"Flooder: {i}" for i in range(5)])
+        self.assertEqual(self.server.flood_drops.value, 15)
+        self.assertIn(b'Flooder', self.server.users)
+
+    def test_disconnect(self):
+        self.start(client_limit=RateLimit(5, message_burst=5), flood_action=rate_limit.DISCONNECT)
+        raw_socket = self.flood("Flooder", 20)
+        raw_socket.settimeout(3)
+        self.assertEqual(raw_socket.recv(4096), b'')
+        time.sleep(0.2)
+        self.assertEqual(self.receiver.received_messages, [f"Flooder: {i}" for i in range(5)])
+        self.assertEqual(self.server.flood_disconnects.value, 1)
+
+    def test_global_limit_drops_without_disconnecting(self):
+        self.start(global_limit=RateLimit(0.01, message_burst=5), flood_action=rate_limit.DISCONNECT)
+        time.sleep(0.2)
+        self.flood("FirstFlooder", 4)
+        self.flood("SecondFlooder", 4)
+        time.sleep(0.3)
+        self.assertEqual(len(self.receiver.received_messages), 5)
+        self.assertEqual(self.server.flood_drops.value, 3)
+        self.assertEqual(self.server.flood_disconnects.value, 0)
+        self.assertEqual(len(self.server.clients), 3)
+
+
+class TestSelectorFloodControl(TestFloodControl):
+    server_class = SelectorChatServer
+    port = 12374
+
+
+class TestGracefulRestart(unittest.TestCase):
+    server_class = ChatServer
+    port = 12365
+
+    def run_server(self, **kwargs):
+        server = self.server_class(port=self.port, idle_timeout=0, **kwargs)
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        return server, thread
+
+    def usernames(self, server):
+        return sorted(connection.username for connection in server.clients)
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.05)
+        return condition()
+
+    def test_stop_wakes_the_loop(self):
+        server, thread = self.run_server()
+        time.sleep(0.1)
+        server.stop()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+
+    def test_drain_and_reconnect(self):
+        old_server, old_thread = self.run_server()
+        alice = ChatClient("Alice", port=self.port, test_mode=True)
+        bob = ChatClient("Bob", port=self.port, test_mode=True)
+        legacy = ChatClient("Legacy", port=self.port, test_mode=True, protocol=PROTOCOL_V1)
+        for client in (alice, bob, legacy):
+            client.start()
+        alice.join_room("ops")
+        bob.join_room("ops")
+        try:
+            self.assertTrue(self.wait_for(lambda: len(old_server.rooms.get(b'ops', ())) == 2))
+            old_server.drain(timeout=3, reconnect_window=0.3)
+            old_thread.join(3)
+            self.assertFalse(old_thread.is_alive())
+
+            new_server, new_thread = self.run_server()
+            self.assertTrue(self.wait_for(lambda: self.usernames(new_server) == [b'Alice', b'Bob', b'Legacy']))
+            self.assertTrue(self.wait_for(lambda: len(new_server.rooms.get(b'ops', ())) == 2))
+            self.assertEqual((alice.reconnects, bob.reconnects, legacy.reconnects), (1, 1, 1))
+            alice.send_message("after restart")
+            self.assertTrue(self.wait_for(lambda: "[ops] Alice: after restart" in bob.received_messages))
+        finally:
+            for client in (alice, bob, legacy):
+                client.close()
+            new_server.stop()
+            new_thread.join(2)
+
+    def test_hand_off_listener_and_clients(self):
+        path = os.path.join(tempfile.mkdtemp(), 'handoff.sock')
+        old_server, old_thread = self.run_server()
+        alice = ChatClient("Alice", port=self.port, test_mode=True)
+        bob = ChatClient("Bob", port=self.port, test_mode=True)
+        alice.start()
+        bob.start()
+        received = []
+        receiver = threading.Thread(target=lambda: received.append(receive_handoff(path, timeout=5)), daemon=True)
+        receiver.start()
+        try:
+            self.assertTrue(self.wait_for(lambda: os.path.exists(path)))
+            self.assertTrue(self.wait_for(lambda: self.usernames(old_server) == [b'Alice', b'Bob']))
+            bob.join_room("ops")
+            alice.join_room("ops")
+            time.sleep(0.2)
+            old_server.drain(handoff_path=path, handoff_clients=True)
+            receiver.join(5)
+            old_thread.join(3)
+            self.assertFalse(old_thread.is_alive())
+
+            listener, clients = received[0]
+            new_server = self.server_class(port=self.port, idle_timeout=0, listen_socket=listener)
+            new_server.adopt_clients(clients)
+            new_thread = threading.Thread(target=new_server.run, daemon=True)
+            new_thread.start()
+            self.assertEqual(self.usernames(new_server), [b'Alice', b'Bob'])
+
+            carol = ChatClient("Carol", port=self.port, test_mode=True)
+            carol.start()
+            alice.send_message("handed over")
+            self.assertTrue(self.wait_for(lambda: "[ops] Alice: handed over" in bob.received_messages))
+            self.assertTrue(self.wait_for(lambda: self.usernames(new_server) == [b'Alice', b'Bob', b'Carol']))
+            self.assertEqual((alice.reconnects, bob.reconnects), (0, 0))
+            carol.close()
+        finally:
+            alice.close()
+            bob.close()
+            new_server.stop()
+            new_thread.join(2)
+
+
+class TestSelectorGracefulRestart(TestGracefulRestart):
+    server_class = SelectorChatServer
+    port = 12366
+
+
+class FakeSocket:
+    next_fd = 1000
+
+    def __init__(self, accept_bytes):
+        self.accept_bytes = accept_bytes
+        self.written = b''
+        self.fd = FakeSocket.next_fd
+        FakeSocket.next_fd += 1
+
+    def fileno(self):
+        return self.fd
+
+    def send(self, data, flags=0):
+        if not self.accept_bytes:
+            raise BlockingIOError()
+        sent = bytes(data[:self.accept_bytes])
+        self.accept_bytes -= len(sent)
+        self.written += sent
+        return len(sent)
+
+    def close(self):
+        pass
+
+
+class FakeScatterSocket(FakeSocket):
+    def __init__(self, accept_bytes):
+        super().__init__(accept_bytes)
+        self.calls = 0
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        return self.send(b''.join(buffers))
+
+
+class ChunkedSocket:
+    def __init__(self, data, rng):
+        self.data = data
+        self.rng = rng
+
+    def recv_into(self, buffer):
+        size = min(len(buffer), self.rng.randint(1, 5000), len(self.data))
+        buffer[:size] = self.data[:size]
+        self.data = self.data[size:]
+        return size
+
+
+class TestFrameDecoder(unittest.TestCase):
+
+    def test_random_split_points(self):
+        rng = random.Random(4)
+        for _ in range(200):
+            frames = [rng.randbytes(rng.choice([0, 1, 4, 100, rng.randint(0, 20000)]))
+                      for _ in range(rng.randint(1, 30))]
+            stream = b''.join(encode_frame(frame) for frame in frames)
+            decoder = FrameDecoder(buffer_size=rng.choice([4, 64, 4096]))
+            chunked_socket = ChunkedSocket(stream, rng)
+
+            decoded = []
+            while chunked_socket.data:
+                self.assertGreater(decoder.recv_into(chunked_socket), 0)
+                decoded += [bytes(frame) for frame in decoder.frames()]
+
+            self.assertEqual(decoded, frames)
+            self.assertEqual(len(decoder), 0)
+
+    def test_many_frames_from_one_read(self):
+        decoder = FrameDecoder()
+        decoder.feed(b''.join(encode_frame(f'message {i}'.encode('utf-8')) for i in range(50)))
+        self.assertEqual([bytes(frame) for frame in decoder.frames()],
+                         [f'message {i}'.encode('utf-8') for i in range(50)])
+
+    def test_partial_frame_waits_for_more(self):
+        decoder = FrameDecoder()
+        frame = encode_frame(b'hello')
+        decoder.feed(frame[:3])
+        self.assertEqual(list(decoder.frames()), [])
+        decoder.feed(frame[3:7])
+        self.assertEqual(list(decoder.frames()), [])
+        decoder.feed(frame[7:])
+        self.assertEqual([bytes(f) for f in decoder.frames()], [b'hello'])
+
+    def test_max_frame_size(self):
+        decoder = FrameDecoder(max_frame_size=10)
+        decoder.feed(encode_frame(b'x' * 10) + encode_frame(b'x' * 11))
+        frames = decoder.frames()
+        self.assertEqual(bytes(next(frames)), b'x' * 10)
+        with self.assertRaises(FrameTooLargeError):
+            next(frames)
+
+    def test_unread_frames_come_back(self):
+        decoder = FrameDecoder()
+        decoder.feed(b''.join(encode_frame(b'm%d' % i) for i in range(3)))
+        frames = list(decoder.frames())
+        decoder.unread(frames[1:])
+        self.assertEqual([bytes(frame) for frame in decoder.frames()], [b'm1', b'm2'])
+
+
+class TestOutboundQueue(unittest.TestCase):
+
+    def test_drop_oldest(self):
+        queue = OutboundQueue(max_bytes=10, policy=DROP_OLDEST)
+        for frame in [b'aaaa', b'bbbb', b'cccc']:
+            self.assertTrue(queue.put(frame))
+
+        self.assertEqual(list(queue.frames), [b'bbbb', b'cccc'])
+        self.assertEqual(queue.queued_bytes, 8)
+        self.assertEqual(queue.dropped_frames, 1)
+        self.assertEqual(queue.dropped_bytes, 4)
+
+    def test_drop_oldest_keeps_partially_sent_frame(self):
+        queue = OutboundQueue(max_bytes=10, policy=DROP_OLDEST)
+        queue.put(b'aaaa')
+        queue.put(b'bbbb')
+        self.assertFalse(queue.flush(FakeSocket(accept_bytes=2)))
+
+        queue.put(b'cccccc')
+        self.assertEqual(list(queue.frames), [b'aaaa', b'cccccc'])
+        self.assertEqual(queue.queued_bytes, 8)
+
+        client_socket = FakeSocket(accept_bytes=100)
+        self.assertTrue(queue.flush(client_socket))
+        self.assertEqual(client_socket.written, b'aacccccc')
+        self.assertEqual(queue.queued_bytes, 0)
+
+    def test_flush_coalesces_frames_into_one_sendmsg(self):
+        queue = OutboundQueue()
+        frames = [encode_frame(f'frame {i}'.encode('utf-8')) for i in range(10)]
+        for frame in frames:
+            queue.put(frame)
+
+        client_socket = FakeScatterSocket(accept_bytes=1000)
+        self.assertTrue(queue.flush(client_socket))
+        self.assertEqual(client_socket.written, b''.join(frames))
+        self.assertEqual(client_socket.calls, 1)
+        self.assertEqual((queue.send_calls, queue.sent_frames), (1, 10))
+
+    def test_partial_sendmsg_resumes_mid_frame(self):
+        queue = OutboundQueue()
+        for frame in [b'aaaa', b'bbbb', b'cccc']:
+            queue.put(frame)
+
+        client_socket = FakeScatterSocket(accept_bytes=6)
+        self.assertFalse(queue.flush(client_socket))
+        self.assertEqual((queue.offset, queue.sent_frames, queue.queued_bytes), (2, 1, 6))
+
+        client_socket.accept_bytes = 100
+        self.assertTrue(queue.flush(client_socket))
+        self.assertEqual(client_socket.written, b'aaaabbbbcccc')
+
+    def test_disconnect_policy(self):
+        queue = OutboundQueue(max_bytes=6, policy=DISCONNECT)
+        self.assertTrue(queue.put(b'aaaa'))
+        self.assertFalse(queue.put(b'bbbb'))
+
+    def test_block_policy_keeps_everything(self):
+        queue = OutboundQueue(max_bytes=6, policy=BLOCK)
+        self.assertTrue(queue.put(b'aaaa'))
+        self.assertTrue(queue.put(b'bbbb'))
+        self.assertTrue(queue.is_full())
+        self.assertEqual(queue.dropped_frames, 0)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            OutboundQueue(policy='ignore')
+
+
+class TestBroadcast(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ChatServer(port=12352)
+
+    def tearDown(self):
+        self.server.close_all()
+
+    def add_fake_client(self, username):
+        connection = self.server.add_connection(FakeSocket(accept_bytes=0), ('fake', 0))
+        return self.server.login_client(connection, username)
+
+    def test_frame_shared_by_all_recipients(self):
+        sender = self.add_fake_client(b'Sender')
+        recipients = [self.add_fake_client(f'User{i}'.encode('utf-8')) for i in range(5)]
+
+        self.server.broadcast({"data": b'hi all'}, sender)
+
+        frames = [recipient.outbound.frames[0] for recipient in recipients]
+        self.assertEqual(frames[0], struct.pack('!I', 14) + b'Sender: hi all')
+        for frame in frames:
+            self.assertIs(frame, frames[0])
+        self.assertEqual(len(sender.outbound), 0)
+
+    def test_v2_recipients_share_the_v2_frame(self):
+        sender = self.add_fake_client(b'Sender')
+        v1_user = self.add_fake_client(b'Old')
+        v2_users = [self.add_fake_client(b'\x00chat/2\x00New%d' % i) for i in range(2)]
+
+        self.server.broadcast({"type": TEXT, "id": 9, "timestamp": 42, "data": b'hi'}, sender)
+
+        self.assertEqual(v1_user.outbound.frames[0], struct.pack('!I', 10) + b'Sender: hi')
+        frames = [user.outbound.frames[-1] for user in v2_users]  # after the hello
+        self.assertIs(frames[0], frames[1])
+        kind, _, message_id, sender_id, timestamp, payload = decode_v2(frames[0][4:])
+        self.assertEqual((kind, message_id, sender_id, timestamp, bytes(payload)),
+                         (TEXT, 9, sender.id, 42, b'Sender: hi'))
+
+    def test_large_broadcast_compressed_once(self):
+        self.server.compress_threshold = 100
+        sender = self.add_fake_client(b'Sender')
+        v1_user = self.add_fake_client(b'Old')
+        plain_user = self.add_fake_client(hello_offer(b'Plain'))
+        zlib_users = [self.add_fake_client(hello_offer(b'Zip%d' % i, ['zlib'])) for i in range(3)]
+        text = b'lorem ipsum dolor ' * 50
+
+        self.server.broadcast({"data": text}, sender)
+        self.server.broadcast({"data": b'short'}, sender)
+
+        frames = [user.outbound.frames[1] for user in zlib_users]  # after the hello
+        self.assertIs(frames[0], frames[1])
+        self.assertIs(frames[0], frames[2])
+        _, flags, _, _, _, payload = decode_v2(frames[0][4:])
+        self.assertEqual(decompress_payload(flags, payload, 1 << 20), b'Sender: ' + text)
+        self.assertEqual(decode_v2(zlib_users[0].outbound.frames[2][4:])[1], 0)
+        self.assertEqual(decode_v2(plain_user.outbound.frames[1][4:])[1], 0)
+        self.assertEqual(v1_user.outbound.frames[0][4:], b'Sender: ' + text)
+
+        stats = self.server.compression_stats()
+        self.assertEqual(stats["compressed_frames"], 1)
+        self.assertEqual(stats["compressed_deliveries"], 3)
+        self.assertLess(stats["ratio"], 0.2)
+        self.assertGreater(stats["bytes_saved"], 2000)
+
+    def test_room_fan_out_only_reaches_members(self):
+        sender = self.add_fake_client(b'Sender')
+        member = self.add_fake_client(b'Member')
+        outsider = self.add_fake_client(b'Outsider')
+        self.server.join_room(sender, b'dev')
+        self.server.join_room(member, b'dev')
+
+        self.server.broadcast({"data": b'hi dev'}, sender)
+
+        self.assertEqual(self.server.rooms[b'dev'], {sender, member})
+        self.assertEqual(list(member.outbound.frames), [struct.pack('!I', 20) + b'[dev] Sender: hi dev'])
+        self.assertEqual(len(outsider.outbound), 0)
+
+    def test_leaving_last_member_drops_room(self):
+        client = self.add_fake_client(b'Solo')
+        self.server.join_room(client, b'dev')
+        self.assertTrue(self.server.leave_room(client, b'dev'))
+        self.assertNotIn(b'dev', self.server.rooms)
+        self.assertEqual(client.room, b'lobby')
+        self.assertFalse(self.server.leave_room(client, b'dev'))
+
+    def test_direct_messages_use_the_username_index(self):
+        sender = self.add_fake_client(hello_offer(b'Sender'))
+        first = self.add_fake_client(hello_offer(b'Ann'))
+        second = self.add_fake_client(b'Ann')  # the same name twice, over v1
+        outsider = self.add_fake_client(hello_offer(b'Bo'))
+        self.assertEqual(self.server.users[b'Ann'], [first, second])
+
+        self.server.send_direct(sender, {"id": 3, "timestamp": 42, "data": b'Ann,Nobody psst'})
+
+        kind, _, message_id, sender_id, timestamp, payload = decode_v2(first.outbound.frames[-1][4:])
+        self.assertEqual((kind, message_id, sender_id, timestamp, bytes(payload)),
+                         (protocol.DIRECT, 3, sender.id, 42, b'Sender: psst'))
+        self.assertEqual(list(second.outbound.frames), [encode_frame(b'__DM__ Sender: psst')])
+        self.assertEqual(len(outsider.outbound), 1)  # only the hello
+        self.assertEqual(self.server.direct_messages.value, 1)
+
+        self.server.remove_client(first)
+        self.assertEqual(self.server.users[b'Ann'], [second])
+        self.server.remove_client(second)
+        self.assertNotIn(b'Ann', self.server.users)
+
+
+class TestConnectionRegistry(unittest.TestCase):
+
+    def test_add_remove_by_fd(self):
+        registry = ConnectionRegistry()
+        first, second = (Connection(FakeSocket(accept_bytes=0), ('fake', 0), FrameDecoder()) for _ in range(2))
+        registry.add(first)
+        registry.add(second)
+        self.assertEqual(len(registry), 2)
+        self.assertIs(registry.get(second.fd), second)
+        self.assertEqual(list(registry), [first, second])
+
+        self.assertTrue(registry.remove(first))
+        self.assertFalse(registry.remove(first))
+        self.assertNotIn(first, registry)
+        self.assertIsNone(registry.get(first.fd))
+        self.assertIsNone(registry.get(-1))
+        self.assertEqual(list(registry), [second])
+
+        reused = Connection(FakeSocket(accept_bytes=0), ('fake', 0), FrameDecoder())
+        reused.fd = first.fd  # the kernel hands out a closed descriptor again
+        registry.add(reused)
+        self.assertIs(registry.get(first.fd), reused)
+        self.assertNotIn(first, registry)
+
+    def test_server_tracks_connections(self):
+        server = ChatServer(port=12372)
+        try:
+            connections = [server.add_connection(FakeSocket(accept_bytes=0), ('fake', 0)) for _ in range(3)]
+            server.login_client(connections[0], b'Alice')
+            self.assertEqual(len(server.connections), 3)
+            self.assertEqual(server.clients, [connections[0]])
+
+            server.remove_client(connections[0])
+            server.remove_client(connections[0])
+            self.assertEqual((len(server.connections), server.client_count), (2, 0))
+            self.assertEqual(server.rooms, {})
+
+            stats = server.memory_stats()
+            self.assertEqual(stats["connections"], 2)
+            self.assertGreater(stats["bytes_per_connection"], 0)
+            self.assertEqual(server.metrics.values()['chat_connection_memory_bytes'], stats["bytes"])
+        finally:
+            server.close_all()
+
+
+class TestSlowConsumers(unittest.TestCase):
+    server_class = ChatServer
+    port = 12350
+    burst_count = 1000
+
+    def setUp(self):
+        self.raw_sockets = []
+        self.server = None
+
+    def tearDown(self):
+        for raw_socket in self.raw_sockets:
+            raw_socket.close()
+        if self.server is not None:
+            stop_server(self.server, self.port)
+        time.sleep(0.5)
+
+    def start(self, **kwargs):
+        self.server = start_server(self.server_class, self.port, **kwargs)
+        time.sleep(0.5)
+
+    def connect(self, username, rcvbuf=None):
+        raw_socket = connect_raw_client(username, self.port, rcvbuf)
+        self.raw_sockets.append(raw_socket)
+        time.sleep(0.1)
+        return raw_socket
+
+    def send_burst(self, sender, count, size):
+        def send_all():
+            for i in range(count):
+                send_raw_message(sender, f"{i:06d}" + "x" * size)
+        thread = threading.Thread(target=send_all)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def test_disconnect_slow_consumer(self):
+        self.start(max_queue_bytes=64 * 1024, slow_consumer_policy=DISCONNECT)
+        sender = self.connect("Sender")
+        fast = self.connect("Fast")
+        slow = self.connect("Slow", rcvbuf=4096)
+
+        self.send_burst(sender, self.burst_count, 10000)
+        fast.settimeout(5)
+        received = [receive_raw_message(fast) for _ in range(self.burst_count)]
+
+        self.assertEqual(received[-1][:14], f"Sender: {self.burst_count - 1:06d}")
+        time.sleep(0.5)
+        self.assertNotIn(slow, self.server.clients)
+        self.assertEqual(len(self.server.clients), 2)
+        self.assertGreaterEqual(self.server.slow_consumer_disconnects, 1)
+
+    def test_drop_oldest_for_slow_consumer(self):
+        self.start(max_queue_bytes=64 * 1024, slow_consumer_policy=DROP_OLDEST)
+        sender = self.connect("Sender")
+        fast = self.connect("Fast")
+        slow = self.connect("Slow", rcvbuf=4096)
+
+        self.send_burst(sender, self.burst_count, 10000)
+        fast.settimeout(5)
+        received = [receive_raw_message(fast) for _ in range(self.burst_count)]
+        self.assertEqual(received[-1][:14], f"Sender: {self.burst_count - 1:06d}")
+
+        stats = {s['username']: s for s in self.server.outbound_stats()}
+        self.assertEqual(stats['Fast']['dropped_frames'], 0)
+        self.assertGreater(stats['Slow']['dropped_frames'], 0)
+        self.assertLessEqual(stats['Slow']['queued_bytes'], 64 * 1024)
+
+        # The slow client still gets whole frames, ending with the latest one
+        slow.settimeout(5)
+        message = receive_raw_message(slow)
+        while not message.startswith(f"Sender: {self.burst_count - 1:06d}"):
+            self.assertTrue(message.startswith("Sender: "))
+            message = receive_raw_message(slow)
+
+    def test_block_sender(self):
+        self.start(max_queue_bytes=64 * 1024, slow_consumer_policy=BLOCK)
+        sender = self.connect("Sender")
+        fast = self.connect("Fast")
+        slow = self.connect("Slow", rcvbuf=4096)
+
+        burst = self.send_burst(sender, self.burst_count, 10000)
+        time.sleep(1)
+        # The sender is held back while the slow client's queue is full
+        self.assertEqual(len(self.server.paused), 1)
+        self.assertTrue(burst.is_alive())
+
+        slow.settimeout(5)
+        fast.settimeout(5)
+        for i in range(self.burst_count):
+            self.assertEqual(receive_raw_message(slow)[:14], f"Sender: {i:06d}")
+            self.assertEqual(receive_raw_message(fast)[:14], f"Sender: {i:06d}")
+        burst.join(timeout=5)
+        self.assertFalse(burst.is_alive())
+
+
+class TestSelectorSlowConsumers(TestSlowConsumers):
+    server_class = SelectorChatServer
+    port = 12351
+
+
+class SlowUpperStage(Stage):
+    # Blocking stage for the pipeline tests; at module level so a process pool can pickle it
+    name = 'slow_upper'
+    blocking = True
+
+    def process(self, text, sender):
+        if text.startswith('slow'):
+            time.sleep(0.3)
+        if text == 'fail':
+            raise ValueError("cannot process this")
+        return text.upper()
+
+
+class DropSpamStage(Stage):
+    name = 'drop_spam'
+
+    def process(self, text, sender):
+        return None if 'spam' in text else text
+
+
+class TestMessagePipeline(unittest.TestCase):
+    port = 12376
+
+    def setUp(self):
+        self.server = None
+
+    def start(self, pipeline, **kwargs):
+        self.server = SelectorChatServer(port=self.port, pipeline=pipeline, **kwargs)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.thread.start()
+        self.sender = ChatClient("PipeSender", port=self.port, test_mode=True)
+        self.receiver = ChatClient("PipeReceiver", port=self.port, test_mode=True)
+        self.sender.start()
+        self.receiver.start()
+        time.sleep(0.2)
+
+    def tearDown(self):
+        if self.server is None:
+            return
+        self.sender.close()
+        self.receiver.close()
+        self.server.stop()
+        self.thread.join(2)
+
+    def test_word_filter(self):
+        self.assertEqual(WordFilter(['darn']).process("Darn it, darned", 'Ann'), "*** it, darned")
+
+    def test_stage_metric_names_are_unique(self):
+        class LinkExpander(Stage):
+            pass
+
+        pipeline = MessagePipeline([LinkExpander(), LinkExpander(), Stage(), WordFilter(['a']), WordFilter(['b'])])
+        metrics = MetricsRegistry()
+        pipeline.attach(lambda connection, message: None, lambda: None, metrics)
+        self.assertEqual(pipeline.names, ['link_expander', 'link_expander_2', 'stage', 'word_filter',
+                                          'word_filter_2'])
+        self.assertIn('chat_pipeline_word_filter_2_seconds_count', metrics.values())
+        pipeline.close()
+
+    def test_sender_order_survives_the_worker_pool(self):
+        self.start(MessagePipeline([DropSpamStage(), SlowUpperStage()], workers=4))
+        self.sender.send_message("slow one")
+        self.sender.send_message("spam")
+        self.sender.send_message("two")
+        self.sender.send_direct("PipeReceiver", "direct")
+        self.sender.join_room("dev")  # waits behind the messages sent to the lobby
+        self.sender.send_message("slow three")
+        time.sleep(1)
+
+        self.assertEqual(self.receiver.received_messages, ["PipeSender: SLOW ONE", "PipeSender: TWO",
+                                                           "PipeSender: DIRECT"])
+        stats = self.server.pipeline.stats()
+        self.assertEqual(stats["drop_spam"]["count"], 5)
+        self.assertEqual(stats["slow_upper"]["count"], 4)
+        self.assertGreater(stats["slow_upper"]["seconds"], 0.6)
+        values = self.server.metrics.values()
+        self.assertEqual(values['chat_pipeline_dropped_total'], 1)
+        self.assertEqual(values['chat_pipeline_pending'], 0)
+
+    def test_streams_and_direct_messages_are_staged(self):
+        self.start(MessagePipeline([WordFilter(['darn']), DropSpamStage()]))
+        legacy = ChatClient("PipeLegacy", port=self.port, test_mode=True, protocol=PROTOCOL_V1)
+        legacy.start()
+        try:
+            time.sleep(0.2)
+            self.sender.send_direct("PipeReceiver", "darn direct")
+            stream_id = self.sender.start_stream()
+            self.sender.send_chunk(stream_id, "darn ")
+            self.sender.end_stream(stream_id, "it")
+            # A v1 client cannot get around the stages by sending its text as a stream
+            legacy.send_message("__STREAM__ 7 darn ")
+            legacy.send_message("__STREAM_END__ 7 again")
+            # A dropped end still ends the stream, without its text
+            stream_id = self.sender.start_stream()
+            self.sender.send_chunk(stream_id, "kept ")
+            self.sender.end_stream(stream_id, "spam")
+            time.sleep(0.3)
+        finally:
+            legacy.close()
+
+        self.assertEqual(self.receiver.received_messages, ["PipeSender: *** direct", "PipeSender: *** it",
+                                                           "PipeLegacy: *** again", "PipeSender: kept "])
+        self.assertTrue(self.receiver.received_messages[0].direct)
+        self.assertEqual(self.server.pipeline.dropped.value, 1)
+
+    def test_messages_in_flight_go_out_after_the_sender_quits(self):
+        self.start(MessagePipeline([SlowUpperStage()]))
+        self.sender.send_message("slow see you")
+        self.sender.send_message("bye")
+        self.sender.close()
+        time.sleep(0.8)
+        self.assertEqual(self.receiver.received_messages, ["PipeSender: SLOW SEE YOU", "PipeSender: BYE"])
+        self.assertEqual(self.server.pipeline.pending, {})
+
+    def test_history_request_waits_for_the_room_change(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.start(MessagePipeline([SlowUpperStage()]), message_log=MessageLog(directory))
+            self.receiver.join_room("dev")
+            self.receiver.send_message("in dev")
+            time.sleep(0.2)
+            self.sender.send_message("slow wait")
+            self.sender.join_room("dev")
+            self.sender.request_history(last=5)  # answered for dev, after the join
+            time.sleep(0.8)
+            self.assertEqual(self.sender.received_messages, ["[dev] PipeReceiver: IN DEV"])
+            self.assertTrue(self.sender.received_messages[0].replayed)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_failed_stage_drops_the_message(self):
+        self.start(MessagePipeline([SlowUpperStage()]))
+        self.sender.send_message("fail")
+        self.sender.send_message("fine")
+        time.sleep(0.3)
+        self.assertEqual(self.receiver.received_messages, ["PipeSender: FINE"])
+        self.assertEqual(self.server.pipeline.errors.value, 1)
+
+    def test_process_pool(self):
+        self.start(MessagePipeline([SlowUpperStage()], executor='process', workers=1))
+        self.sender.send_message("slow hello")
+        self.sender.send_message("again")
+        time.sleep(1.5)
+        self.assertEqual(self.receiver.received_messages, ["PipeSender: SLOW HELLO", "PipeSender: AGAIN"])
+
+
+class TestShardedServer(unittest.TestCase):
+
+    def setUp(self):
+        self.test_clients = []
+
+    def tearDown(self):
+        for client in self.test_clients:
+            client.close()
+        time.sleep(0.5)
+
+    def create_test_client(self, username, port):
+        client = ChatClient(username, port=port, test_mode=True)
+        self.test_clients.append(client)
+        client.start()
+        return client
+
+    def assert_in_sender_order(self, received_messages, sender, messages):
+        from_sender = [m for m in received_messages if m.startswith(f"{sender}: ")]
+        self.assertEqual(from_sender, [f"{sender}: {m}" for m in messages])
+
+    def test_bus_relays_between_shards(self):
+        bus_dir = tempfile.mkdtemp()
+        bus = BroadcastBus(os.path.join(bus_dir, 'bus.sock'))
+        threading.Thread(target=bus.run, daemon=True).start()
+        shards = [ShardChatServer(bus.path, port=port) for port in (12360, 12361)]
+        for shard in shards:
+            threading.Thread(target=shard.run, daemon=True).start()
+
+        try:
+            alice = self.create_test_client("Alice", 12360)
+            bob = self.create_test_client("Bob", 12361)
+            carol = self.create_test_client("Carol", 12360)
+            time.sleep(0.5)
+
+            alice_messages = [f"alice {i}" for i in range(20)]
+            for message in alice_messages:
+                alice.send_message(message)
+            bob.send_message("hi from the other shard")
+            carol.join_room("dev")
+            bob.join_room("dev")
+            time.sleep(0.5)
+            bob.send_message("dev only")
+            time.sleep(1)
+
+            self.assertIn("[dev] Bob: dev only", carol.received_messages)
+            self.assertNotIn("[dev] Bob: dev only", alice.received_messages)
+
+            self.assert_in_sender_order(bob.received_messages, "Alice", alice_messages)
+            self.assert_in_sender_order(carol.received_messages, "Alice", alice_messages)
+            self.assertIn("Bob: hi from the other shard", alice.received_messages)
+            self.assertIn("Bob: hi from the other shard", carol.received_messages)
+            self.assertNotIn("Bob: hi from the other shard", bob.received_messages)
+            self.assertEqual(bus.relayed_frames, 22)
+        finally:
+            bus.stop()
+            shutil.rmtree(bus_dir, ignore_errors=True)
+
+    def test_sharded_server_processes(self):
+        server = ShardedChatServer(port=12362, workers=2, quiet=True)
+        server.start()
+        try:
+            self.assertTrue(server.wait_ready())
+            clients = [self.create_test_client(f"User{i}", 12362) for i in range(6)]
+            time.sleep(1)
+
+            messages = [f"message {i}" for i in range(10)]
+            for client in clients:
+                for message in messages:
+                    client.send_message(message)
+            time.sleep(1)
+
+            for i, client in enumerate(clients):
+                self.assertEqual(len(client.received_messages), 50)
+                for j in range(6):
+                    if i != j:
+                        self.assert_in_sender_order(client.received_messages, f"User{j}", messages)
+        finally:
+            server.stop()
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_room_members(self):
+        self.assertEqual(room_members(5, 2), [2, 2, 2, 2, 1])
+        self.assertEqual(room_members(3, 0), [3, 3, 3])
+
+    def test_percentile(self):
+        values = list(range(1, 1001))
+        self.assertEqual(percentile(values, 0.5), 500)
+        self.assertEqual(percentile(values, 0.99), 990)
+        self.assertEqual(percentile(values, 0.999), 999)
+        self.assertIsNone(percentile([], 0.5))
+
+    def test_load_run_reports_latency_and_throughput(self):
+        result = run_benchmark('selectors', clients=20, messages=5, rate=20, room_size=5, processes=2, port=12370)
+
+        self.assertEqual(result["sent"], 100)
+        self.assertEqual(result["delivered"], result["expected"])
+        self.assertEqual(result["expected"], 20 * 4 * 5)
+        self.assertGreater(result["delivered_per_sec"], 0)
+        self.assertLessEqual(result["latency_ms"]["p50"], result["latency_ms"]["p99"])
+        self.assertLessEqual(result["latency_ms"]["p99"], result["latency_ms"]["p999"])
+        self.assertGreater(result["server"]["rss_bytes"], 0)
+
+    def test_idle_memory_per_client(self):
+        result = idle_memory('selectors', clients=200, port=12371, settle=0.5)
+
+        self.assertEqual(result["clients"], 200)
+        self.assertGreater(result["server"]["rss_bytes_after"], 0)
+        self.assertIn("rss_bytes_per_client", result["server"])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file